@@ -0,0 +1,218 @@
+r"""
+Process every LAPD run in a directory without prompts, one Mach dataset per run.
+
+Usage: python batch.py DATA_DIRECTORY CONFIG_FILE [--workers N] [--force]
+
+CONFIG_FILE is a JSON file with the same parameters as main.py, for example
+    {"mach_face_bcs": [{"2": [3, 1], "5": [3, 3]}, {"2": [3, 4], "5": [3, 5]}],
+     "mach_receptacles": [3, 4],
+     "mach_face_resistances": [{"2": 14.9, "5": 15.0}, {"2": 14.9, "5": 15.0}],
+     "steady_state_times_ms": [6, 15],
+     "langmuir_directory": "/path/to/lang_nc",
+     "output_directory": "/path/to/mach_nc"}
+Each run NAME.hdf5 is paired with the Langmuir dataset NAME_lang.nc (or the first .nc file whose name starts with
+NAME) in langmuir_directory, which defaults to DATA_DIRECTORY, and is saved to output_directory as NAME_mach.nc.
+An optional "mach_isat_options" object is passed to get_mach_isat as keyword arguments; its "time_window" is a
+[start, stop] pair of frame indices, or a [start, stop, unit] triple of times such as [6, 15, "ms"].
+Set "profile" to true to save the time, data read and array sizes of each stage of each run to output_directory as
+NAME_profile.json.
+An optional "output_options" object is passed to files.write_netcdf, for example {"compression_level": 4,
+"dtype": "float32"} to save compressed single-precision datasets. An optional "spectra_options" object (which may be
+empty) also saves isat spectra from spectra.get_isat_spectra, with those keyword arguments, as NAME_spectra.nc.
+Runs whose Mach dataset (and spectra and summary datasets, if requested) are newer than the run, its Langmuir dataset
+and the config file are skipped.
+An optional "figure_directory" also saves a summary of shot means and steady-state profiles of each run as
+NAME_summary.nc, and, once all runs are processed, contour and linear profile figures of every run (see figures.py)
+to figure_directory; figures whose data have not changed since they were last saved are not drawn again.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import astropy.units as u
+import xarray as xr
+
+from experimental import get_exp_params
+from figures import summary_dataset, figure_jobs, render_figures
+from files import search_folder, make_path, write_netcdf
+from getMachIsat import get_mach_isat
+from profiling import start_profile, stop_profile
+from session import LapdSession
+from radial import linear_profile
+from spectra import get_isat_spectra
+from velocity import get_velocity_profiles
+
+
+def load_batch_config(config_path):
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    missing_keys = [key for key in ("mach_face_bcs", "mach_receptacles", "mach_face_resistances",
+                                    "steady_state_times_ms", "output_directory") if key not in config]
+    if missing_keys:
+        raise ValueError("Batch config file " + repr(config_path) + " is missing " + ", ".join(missing_keys))
+    # JSON object keys are strings; face numbers are integers and board, channel pairs are tuples
+    config["mach_face_bcs"] = [{int(face): tuple(bc) for face, bc in probe_bcs.items()}
+                               for probe_bcs in config["mach_face_bcs"]]
+    config["mach_face_resistances"] = [{int(face): resistance for face, resistance in probe_resistances.items()}
+                                       for probe_resistances in config["mach_face_resistances"]]
+    if "time_window" in config.get("mach_isat_options", {}):
+        config["mach_isat_options"]["time_window"] = parse_time_window(config["mach_isat_options"]["time_window"])
+    return config
+
+
+def parse_time_window(time_window):
+    # JSON time window as get_mach_isat takes it: [start, stop] frame indices as a slice, [start, stop, unit] as a
+    # pair of astropy Quantities, or null
+    if time_window is None:
+        return None
+    if len(time_window) == 2 and all(isinstance(frame, int) for frame in time_window):
+        return slice(*time_window)
+    if len(time_window) == 3 and isinstance(time_window[2], str):
+        return time_window[0] * u.Unit(time_window[2]), time_window[1] * u.Unit(time_window[2])
+    raise ValueError("Time window " + repr(time_window) + " is not a [start, stop] pair of frame indices or a "
+                     "[start, stop, unit] triple of times")
+
+
+def find_batch_runs(data_directory, langmuir_directory, output_directory):
+    # Pair each HDF5 run with its Langmuir dataset by name; runs without a Langmuir dataset are returned unpaired
+    langmuir_names = {os.path.splitext(os.path.basename(path))[0]: path
+                      for path in sorted(search_folder(langmuir_directory, "nc"))}
+    runs = []
+    for hdf5_path in sorted(search_folder(data_directory, "hdf5")):
+        run_name = os.path.splitext(os.path.basename(hdf5_path))[0]
+        langmuir_path = langmuir_names.get(run_name + "_lang",
+                                           next((path for name, path in langmuir_names.items()
+                                                 if name.startswith(run_name)), None))
+        runs.append((run_name, hdf5_path, langmuir_path, make_path(output_directory, run_name + "_mach", "nc")))
+    return runs
+
+
+def is_up_to_date(output_paths, *input_paths):
+    if not all(os.path.isfile(output_path) for output_path in output_paths):
+        return False
+    return (min(os.path.getmtime(output_path) for output_path in output_paths)
+            >= max(os.path.getmtime(path) for path in input_paths))
+
+
+def run_output_paths(output_path, config):
+    # Mach dataset of a run, and its spectra and summary datasets if the config requests them
+    return ([output_path] + ([spectra_dataset_path(output_path)] if "spectra_options" in config else [])
+            + ([summary_dataset_path(output_path)] if "figure_directory" in config else []))
+
+
+def process_run(hdf5_path, langmuir_path, output_path, config):
+    # Runs in a worker process; exceptions are returned as text so one failed run does not stop the batch
+    start_time = time.perf_counter()
+    if config.get("profile", False):
+        start_profile(os.path.basename(hdf5_path))
+    try:
+        steady_state_times = [time_ms * u.ms for time_ms in config["steady_state_times_ms"]]
+        with xr.open_dataset(langmuir_path) as diagnostic_dataset:
+            linear_electron_temperature = linear_profile(diagnostic_dataset['T_e'].load(), *steady_state_times)
+        with LapdSession(hdf5_path) as lapd_session:
+            lapd_parameters = get_exp_params(lapd_session)
+            mach_isat = get_mach_isat(lapd_session, config["mach_face_bcs"], config["mach_receptacles"],
+                                      config["mach_face_resistances"], **config.get("mach_isat_options", {}))
+        mach_ds = get_velocity_profiles(mach_isat, linear_electron_temperature).assign_attrs(
+            {parameter: str(value) for parameter, value in lapd_parameters.items()})
+        write_netcdf(mach_ds, output_path, mode="w", **config.get("output_options", {}))
+        if "spectra_options" in config:
+            write_netcdf(get_isat_spectra(mach_isat, **config["spectra_options"]).assign_attrs(mach_ds.attrs),
+                         spectra_dataset_path(output_path), mode="w", **config.get("output_options", {}))
+        if "figure_directory" in config:
+            write_netcdf(summary_dataset(mach_ds, *steady_state_times), summary_dataset_path(output_path), mode="w")
+        return time.perf_counter() - start_time, None
+    except Exception:
+        return time.perf_counter() - start_time, traceback.format_exc()
+    finally:
+        if config.get("profile", False):
+            stop_profile(os.path.splitext(output_path)[0][:-len("_mach")] + "_profile.json")
+
+
+def spectra_dataset_path(output_path):
+    return os.path.splitext(output_path)[0][:-len("_mach")] + "_spectra.nc"
+
+
+def summary_dataset_path(output_path):
+    return os.path.splitext(output_path)[0][:-len("_mach")] + "_summary.nc"
+
+
+def render_batch_figures(runs, results, config, max_workers=None, force=False):
+    # Figures of every processed run are drawn in one process pool, from the small summary dataset of each run
+    steady_state_times = [time_ms * u.ms for time_ms in config["steady_state_times_ms"]]
+    jobs = []
+    for run_name, _, _, output_path in runs:
+        if results[run_name][0] == "failed":
+            continue
+        summary_path = summary_dataset_path(output_path)
+        if not os.path.isfile(summary_path):
+            # Runs processed before figures were requested have no summary yet
+            with xr.open_dataset(output_path) as mach_ds:
+                write_netcdf(summary_dataset(mach_ds, *steady_state_times), summary_path, mode="w")
+        with xr.open_dataset(summary_path) as summary_ds:
+            jobs += figure_jobs(summary_ds.load(), config["figure_directory"], run_name)
+    return render_figures(jobs, max_workers, force)
+
+
+def run_batch(data_directory, config_path, max_workers=None, force=False):
+    r"""
+    Process all runs in a directory in a process pool.
+
+    :param data_directory: directory searched (with subfolders) for .hdf5 files
+    :param config_path: path of JSON batch config file
+    :param max_workers: number of worker processes, or None for one per CPU
+    :param force: True to reprocess runs whose Mach datasets are up to date
+    :return: dictionary of run name to (status, seconds, error text)
+    """
+
+    config = load_batch_config(config_path)
+    os.makedirs(config["output_directory"], exist_ok=True)
+    runs = find_batch_runs(data_directory, config.get("langmuir_directory", data_directory),
+                           config["output_directory"])
+    print("Found " + str(len(runs)) + " runs in " + repr(data_directory))
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for run_name, hdf5_path, langmuir_path, output_path in runs:
+            if langmuir_path is None:
+                results[run_name] = ("failed", 0., "No Langmuir dataset found for run")
+            elif not force and is_up_to_date(run_output_paths(output_path, config), hdf5_path, langmuir_path,
+                                             config_path):
+                results[run_name] = ("skipped", 0., None)
+            else:
+                futures[executor.submit(process_run, hdf5_path, langmuir_path, output_path, config)] = run_name
+        for future in as_completed(futures):
+            try:
+                run_time, error = future.result()
+            except Exception:
+                # Such as BrokenProcessPool, if a worker process was killed; the runs it had are recorded as failed
+                run_time, error = 0., traceback.format_exc()
+            results[futures[future]] = ("failed" if error else "done", run_time, error)
+            print(f" * {futures[future]}: {results[futures[future]][0]} in {run_time:.1f} s")
+
+    if "figure_directory" in config:
+        render_batch_figures(runs, results, config, max_workers, force)
+
+    for run_name, (status, run_time, error) in sorted(results.items()):
+        print(f"{run_name}: {status} ({run_time:.1f} s)")
+        if error:
+            print("    " + error.strip().replace("\n", "\n    "))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Process every LAPD run in a directory into Mach datasets.")
+    parser.add_argument("data_directory", help="directory searched for .hdf5 files")
+    parser.add_argument("config", help="JSON batch config file")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPUs)")
+    parser.add_argument("--force", action="store_true", help="reprocess runs with up-to-date Mach datasets")
+    arguments = parser.parse_args()
+    batch_results = run_batch(arguments.data_directory, arguments.config, arguments.workers, arguments.force)
+    raise SystemExit(1 if any(status == "failed" for status, _, _ in batch_results.values()) else 0)
@@ -0,0 +1,272 @@
+r"""
+Benchmarks of the Mach probe analysis on synthetic LAPD HDF5 files.
+
+Usage: python benchmark.py [--sizes small medium ...] [--output RESULTS.json] [--compare OLD_RESULTS.json]
+Results record wall time, peak traced memory and isat throughput of each stage at each size, and can be compared
+with results saved from another commit. Stages that use the metadata index beside the run (see session.py) are timed
+cold, with the index removed before each call so that results compare with those from before the index, and warm,
+as "STAGE warm".
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+import astropy.units as u
+from bapsflib import lapd
+
+from experimental import get_exp_params
+from getMachIsat import channel_arrays, get_mach_isat, get_shot_index, to_mach_isat_da, wrap_mach_isat_array
+from radial import linear_profile, radial_profile
+from synthetic import write_synthetic_lapd
+from velocity import get_velocity_profiles
+
+# Synthetic run sizes; each is a set of keyword arguments of write_synthetic_lapd
+benchmark_sizes = {"small": {"x_positions": np.arange(-10., 11., 2.), "shots_per_position": 5,
+                             "num_frames": 4096},
+                   "medium": {"x_positions": np.arange(-20., 21., 1.), "shots_per_position": 10,
+                              "num_frames": 8192},
+                   "large": {"x_positions": np.arange(-30., 31., 1.), "shots_per_position": 15,
+                             "num_frames": 16384, "samples_to_average": 128},
+                   "areal": {"x_positions": np.arange(-10., 11., 2.), "y_positions": np.arange(-10., 11., 2.),
+                             "shots_per_position": 5, "num_frames": 4096},
+                   "interleaved": {"x_positions": np.arange(-20., 21., 1.), "shots_per_position": 10,
+                                   "num_frames": 8192, "interleaved": True}}
+benchmark_mach_bcs = [{1: (3, 0), 2: (3, 1), 3: (3, 2), 4: (3, 6), 5: (3, 3), 6: (3, 7)},
+                      {1: (4, 0), 2: (4, 1), 3: (4, 2), 4: (4, 6), 5: (4, 3), 6: (4, 7)}]
+benchmark_receptacles = [3, 4]
+benchmark_resistances = [{face: 15.0 for face in probe_bcs} for probe_bcs in benchmark_mach_bcs]
+
+
+def synthetic_mach_isat_da(num_x=21, num_y=1, shots_per_position=10, num_frames=4096, ports=(27, 29),
+                           faces=(1, 2, 3, 4, 5, 6), seed=0):
+    # Positive isat signals with a sheared parallel flow across x; no HDF5 file involved
+    rng = np.random.default_rng(seed)
+    x_pos = np.linspace(-20, 20, num_x)
+    y_pos = np.linspace(-20, 20, num_y) if num_y > 1 else np.array([0.])
+    parallel_mach = 0.4 * np.tanh(x_pos / 8)[np.newaxis, :, np.newaxis, np.newaxis, np.newaxis]
+    face_signs = {1: -1, 2: -1, 3: -1, 4: 1, 5: 1, 6: 1}
+    isat_array = np.empty((len(ports), len(faces), num_x, num_y, shots_per_position, num_frames))
+    for face_ind, face in enumerate(faces):
+        isat_array[:, face_ind] = np.exp(face_signs[face] * parallel_mach) * (
+            1 + 0.1 * rng.standard_normal((len(ports), num_x, num_y, shots_per_position, num_frames)))
+    return wrap_mach_isat_array(isat_array, np.array(ports), list(faces), x_pos, y_pos, 5.12 * u.us)
+
+
+def synthetic_electron_temperature_da(mach_isat_da):
+    x_pos = mach_isat_da.x.values
+    electron_temperature = 2 + 3 * np.exp(-(x_pos / 15) ** 2) * np.ones((mach_isat_da.sizes['port'], 1))
+    return xr.DataArray(electron_temperature, dims=['port', 'x'],
+                        coords=(('port', mach_isat_da.port.values), ('x', x_pos, {"units": str(u.cm)})),
+                        attrs={"units": str(u.eV)})
+
+
+def reference_velocity_profiles(mach_isat_da, electron_temperature_da):
+    # Unfused xarray implementation of get_velocity_profiles, kept to measure speedup of the fused kernel against
+    magnetization_factor = 0.5
+    alpha_fore = np.pi / 4 * u.rad
+    alpha_aft = np.pi / 4 * u.rad
+    ion_mass = 6.6464764e-27 * u.kg
+    mach_to_velocity = np.sqrt(electron_temperature_da / ion_mass).sortby("port")
+    mach_to_velocity_units = np.sqrt(1 * u.eV / u.kg).to(u.cm / u.s).value
+
+    parallel_mach = magnetization_factor * np.log(mach_isat_da.sel(face=5) / mach_isat_da.sel(face=2)).sortby("port")
+    langmuir_with_mach_ports = mach_to_velocity.assign_coords(port=parallel_mach.port)
+    mach_to_velocity = mach_to_velocity.reindex_like(langmuir_with_mach_ports, method="nearest", tolerance=5)
+    parallel_velocity = parallel_mach * mach_to_velocity * mach_to_velocity_units
+    mach_velocities = xr.Dataset({"Parallel Mach number": parallel_mach,
+                                  "Parallel velocity": parallel_velocity})
+
+    if np.isin(np.array([1, 3, 4, 6]), mach_isat_da.face).all():
+        mach_correction_fore = magnetization_factor * np.log(mach_isat_da.sel(face=6) / mach_isat_da.sel(face=3))
+        mach_correction_aft = magnetization_factor * np.log(mach_isat_da.sel(face=4) / mach_isat_da.sel(face=1))
+        perpendicular_mach_fore = (parallel_mach - mach_correction_fore) * np.cos(alpha_fore)
+        perpendicular_mach_aft = (parallel_mach - mach_correction_aft) * np.cos(alpha_aft)
+        perpendicular_mach = xr.concat([perpendicular_mach_fore, perpendicular_mach_aft], 'location').mean('location')
+        perpendicular_velocity = perpendicular_mach * mach_to_velocity * mach_to_velocity_units
+        mach_velocities = mach_velocities.assign({"Perpendicular Mach number": perpendicular_mach,
+                                                  "Perpendicular fore Mach number": perpendicular_mach_fore,
+                                                  "Perpendicular aft Mach number": perpendicular_mach_aft,
+                                                  "Perpendicular velocity": perpendicular_velocity})
+    return mach_velocities
+
+
+def time_function(function, *args, repeats=3, setup=None, **kwargs):
+    # Best wall time of several calls, and the result of the last call; setup, if given, runs untimed before each call
+    times = []
+    result = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchmark_velocity_profiles(shots_per_position_values=(5, 10, 20), repeats=3):
+    print("Benchmarking get_velocity_profiles against unfused xarray reference...")
+    for shots_per_position in shots_per_position_values:
+        mach_isat_da = synthetic_mach_isat_da(shots_per_position=shots_per_position)
+        electron_temperature_da = synthetic_electron_temperature_da(mach_isat_da)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reference_time, reference = time_function(reference_velocity_profiles, mach_isat_da,
+                                                      electron_temperature_da, repeats=repeats)
+            fused_time, fused = time_function(get_velocity_profiles, mach_isat_da, electron_temperature_da,
+                                              repeats=repeats)
+        max_difference = max(float(np.nanmax(np.abs(fused[key].values - np.asarray(reference[key].values))))
+                             for key in reference)
+        print(f" * isat {mach_isat_da.nbytes / 1e6:.0f} MB: reference {reference_time:.3f} s, "
+              f"fused {fused_time:.3f} s, speedup {reference_time / fused_time:.1f}x, "
+              f"max difference {max_difference:.2g}")
+
+
+def measure_stage(function, *args, repeats=3, setup=None, **kwargs):
+    # Best wall time of several untraced calls, then peak memory allocated during one traced call
+    best_time, result = time_function(function, *args, repeats=repeats, setup=setup, **kwargs)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best_time, peak_bytes, result
+
+
+def benchmark_size(size_name, directory, repeats=3):
+    r"""
+    Write a synthetic run of the given size and time each analysis stage on it.
+
+    :param size_name: key of benchmark_sizes
+    :param directory: directory for the synthetic HDF5 file
+    :param repeats: number of timed calls of each stage; the fastest is recorded
+    :return: dictionary of stage name to dictionary of results
+    """
+
+    hdf5_path = write_synthetic_lapd(os.path.join(directory, size_name + ".hdf5"), mach_bcs=benchmark_mach_bcs,
+                                     mach_receptacles=benchmark_receptacles, **benchmark_sizes[size_name])
+
+    with lapd.File(hdf5_path) as lapd_file:
+        isat_datas = [{face: channel_arrays(lapd_file.read_data(*probe_bcs[face], silent=True))
+                       for face in probe_bcs}
+                      for probe_bcs in benchmark_mach_bcs]
+        motor_datas = [lapd_file.read_controls([('6K Compumotor', receptacle)])
+                       for receptacle in benchmark_receptacles]
+    ports = np.array([motor_data.info['controls']['6K Compumotor']['probe']['port'] for motor_data in motor_datas])
+    shot_index = get_shot_index(motor_datas[0])
+    mach_isat_da = to_mach_isat_da(isat_datas, shot_index, ports, benchmark_resistances)
+    electron_temperature_da = synthetic_electron_temperature_da(mach_isat_da)
+    mach_ds = get_velocity_profiles(mach_isat_da, electron_temperature_da)
+    isat_megabytes = mach_isat_da.nbytes / 1e6
+
+    index_path = os.path.splitext(hdf5_path)[0] + "_index.json"
+    isat_path = os.path.splitext(hdf5_path)[0] + "_isat.npy"
+
+    def remove_index():
+        # Cold stages read metadata from the HDF5 file, as before the index existed
+        if os.path.isfile(index_path):
+            os.remove(index_path)
+
+    # Stages are (function, args, kwargs, setup); warm stages run after a cold stage has written the index. Streamed
+    # stages read 4 MB blocks of shots into isat held in memory, or in a memory-mapped file that tracemalloc does not
+    # count. Reading blocks in 4 reader processes is compared with reading them in this process.
+    stages = {"get_exp_params": (get_exp_params, (hdf5_path,), {}, remove_index),
+              "get_exp_params warm": (get_exp_params, (hdf5_path,), {}, None),
+              "get_mach_isat": (get_mach_isat, (hdf5_path, benchmark_mach_bcs, benchmark_receptacles,
+                                                benchmark_resistances), {}, remove_index),
+              "get_mach_isat warm": (get_mach_isat, (hdf5_path, benchmark_mach_bcs, benchmark_receptacles,
+                                                     benchmark_resistances), {}, None),
+              "get_mach_isat streamed": (get_mach_isat, (hdf5_path, benchmark_mach_bcs, benchmark_receptacles,
+                                                         benchmark_resistances), {"memory_budget": 2 ** 22}, None),
+              "get_mach_isat streamed 4 workers": (get_mach_isat, (hdf5_path, benchmark_mach_bcs,
+                                                                   benchmark_receptacles, benchmark_resistances),
+                                                   {"memory_budget": 2 ** 22, "max_workers": 4}, None),
+              "get_mach_isat streamed to disk": (get_mach_isat, (hdf5_path, benchmark_mach_bcs, benchmark_receptacles,
+                                                                 benchmark_resistances),
+                                                 {"memory_budget": 2 ** 22, "isat_path": isat_path}, None),
+              "get_shot_index": (get_shot_index, (motor_datas[0],), {}, None),
+              "to_mach_isat_da": (to_mach_isat_da, (isat_datas, shot_index, ports, benchmark_resistances), {}, None),
+              "get_velocity_profiles": (get_velocity_profiles, (mach_isat_da, electron_temperature_da), {}, None),
+              "linear_profile": (linear_profile, (mach_ds, 6 * u.ms, 15 * u.ms), {}, None),
+              "radial_profile": (radial_profile, (mach_ds, 6 * u.ms, 15 * u.ms), {}, None)}
+    if mach_isat_da.sizes['y'] > 1:
+        del stages["linear_profile"]  # Linear profiles are not defined for areal data
+
+    size_results = {}
+    for stage_name, (function, args, kwargs, setup) in stages.items():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stage_time, peak_bytes, _ = measure_stage(function, *args, repeats=repeats, setup=setup, **kwargs)
+        size_results[stage_name] = {"seconds": stage_time,
+                                    "peak MB": peak_bytes / 1e6,
+                                    "isat MB": isat_megabytes,
+                                    "MB/s": isat_megabytes / stage_time}
+        print(f" * {size_name:11s} {stage_name:32s} {stage_time:8.3f} s {peak_bytes / 1e6:9.1f} MB peak "
+              f"{isat_megabytes / stage_time:9.1f} MB/s")
+    remove_index()
+    os.remove(isat_path)
+    os.remove(hdf5_path)
+    return size_results
+
+
+def run_benchmarks(size_names=("small", "medium"), output_path=None, repeats=3):
+    results = {"commit": git_commit(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "xarray": xr.__version__,
+               "machine": platform.platform(),
+               "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "sizes": {}}
+    with tempfile.TemporaryDirectory(prefix="mach-benchmark-") as directory:
+        for size_name in size_names:
+            results["sizes"][size_name] = benchmark_size(size_name, directory, repeats)
+    if output_path is not None:
+        with open(output_path, "w") as output_file:
+            json.dump(results, output_file, indent=1)
+    return results
+
+
+def compare_benchmarks(old_results, new_results):
+    # Ratio of new to old wall time for every stage both result sets share; below 1 is faster
+    print(f"Comparing {new_results['commit']} to {old_results['commit']} (time and peak memory ratios, new / old)")
+    for size_name, size_results in new_results["sizes"].items():
+        for stage_name, stage_results in size_results.items():
+            old_stage_results = old_results["sizes"].get(size_name, {}).get(stage_name)
+            if old_stage_results is None:
+                continue
+            print(f" * {size_name:11s} {stage_name:32s} "
+                  f"time {stage_results['seconds'] / old_stage_results['seconds']:6.2f}x "
+                  f"peak {stage_results['peak MB'] / max(old_stage_results['peak MB'], 1e-9):6.2f}x")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the Mach probe analysis on synthetic LAPD files.")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(benchmark_sizes),
+                        help="synthetic run sizes to benchmark")
+    parser.add_argument("--repeats", type=int, default=3, help="timed calls per stage")
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument("--compare", help="JSON results file from another commit to compare with")
+    parser.add_argument("--kernel", action="store_true",
+                        help="also compare get_velocity_profiles with the unfused xarray reference")
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmarks(arguments.sizes, arguments.output, arguments.repeats)
+    if arguments.compare is not None:
+        with open(arguments.compare) as compare_file:
+            compare_benchmarks(json.load(compare_file), benchmark_results)
+    if arguments.kernel:
+        benchmark_velocity_profiles()
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from files import write_netcdf
+from getMachIsat import get_mach_isat, to_real_mach_isat_units
+from profiling import stage as profile_stage
+from session import file_identity
+from shot_statistics import get_mach_statistics, statistics_velocities
+from spectra import get_isat_spectra
+from velocity import get_velocity_profiles, get_velocities, mach_variable_order
+
+
+# get_mach_isat options that change how data is read but not the result, and so are left out of cache keys
+result_neutral_read_options = ("memory_budget", "max_workers", "chunk_positions", "chunk_frames", "isat_path")
+
+
+class StageCache:
+    r"""
+    Directory of NetCDF files holding intermediate results of the Mach probe analysis, one file per stage and key.
+    Keys are hashes of everything a stage depends on, so a changed parameter only recomputes the stages downstream
+    of it. Least recently used files are deleted when the directory grows past its size cap. Files are saved with
+    files.write_netcdf, with the keyword arguments in output_options, such as compression_level or dtype.
+    """
+
+    def __init__(self, directory, max_bytes=None, output_options=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.output_options = {} if output_options is None else output_options
+        self.hits = {}
+        self.misses = {}
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "cache_index.json")
+        try:
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+        # Forget entries whose files were removed outside the cache
+        self.index = {filename: entry for filename, entry in self.index.items()
+                      if os.path.isfile(os.path.join(directory, filename))}
+
+    def key(self, stage, *dependencies):
+        # Hash of stage name and dependencies; numpy values and astropy Quantities are hashed by their string form
+        dependency_str = json.dumps([stage, *dependencies], sort_keys=True, default=str)
+        return hashlib.sha256(dependency_str.encode()).hexdigest()[:24]
+
+    def get_or_compute(self, stage, key, compute):
+        r"""
+        Open the cached result of a stage, or compute and cache it if it is missing.
+
+        :param stage: name of stage, used in file name and hit/miss counts
+        :param key: key made by StageCache.key from the stage's dependencies
+        :param compute: function of no arguments returning a DataArray or Dataset
+        :return: result of stage
+        """
+
+        filename = stage + "_" + key + ".nc"
+        path = os.path.join(self.directory, filename)
+        if filename in self.index:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            self.index[filename]["last used"] = time.time()
+            self.write_index()
+            return self.open_stage(stage, filename)
+
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+        result = compute()
+        chunk_sizes = lazy_chunk_sizes(result)
+        # Lazy results are stored in chunks no larger than their dask chunks, which they are reopened with
+        output_options = {"chunk_sizes": chunk_sizes, **self.output_options} if chunk_sizes else self.output_options
+        with profile_stage("write cached " + stage, path=path) as record:
+            if isinstance(result, xr.DataArray):
+                name = result.name if result.name is not None else stage
+                write_netcdf(result.rename(name).to_dataset(), path, mode="w", **output_options)
+                self.index[filename] = {"type": "DataArray", "name": name}
+            else:
+                write_netcdf(result, path, mode="w", **output_options)
+                self.index[filename] = {"type": "Dataset"}
+            record["bytes written"] = os.path.getsize(path)
+        if chunk_sizes:
+            # Lazy results are reopened lazily with the same chunks; later stages then read this file, not the
+            # HDF5 file again through the graph that was just computed
+            self.index[filename]["chunks"] = chunk_sizes
+        self.index[filename].update({"stage": stage, "bytes": os.path.getsize(path), "last used": time.time()})
+        self.evict(keep=filename)
+        self.write_index()
+        return self.open_stage(stage, filename)
+
+    def open_stage(self, stage, filename):
+        # Stored result of a stage, loaded into memory, or read lazily by dask if it was computed lazily
+        entry = self.index[filename]
+        path = os.path.join(self.directory, filename)
+        with profile_stage("open cached " + stage, path=path, bytes=entry["bytes"]):
+            if "chunks" in entry:
+                result = xr.open_dataset(path, chunks=entry["chunks"])
+            else:
+                with xr.open_dataset(path) as cached_ds:
+                    result = cached_ds.load()
+        if entry["type"] == "DataArray":
+            result = result[entry["name"]]
+        return result
+
+    def evict(self, keep=None):
+        # Delete least recently used files until the cache fits in max_bytes; the newest file is never deleted
+        if self.max_bytes is None:
+            return
+        total_bytes = sum(entry["bytes"] for entry in self.index.values())
+        for filename in sorted(self.index, key=lambda name: self.index[name]["last used"]):
+            if total_bytes <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            total_bytes -= self.index[filename]["bytes"]
+            os.remove(os.path.join(self.directory, filename))
+            del self.index[filename]
+
+    def write_index(self):
+        # Written to a temporary file first, so an interrupted write leaves the last index intact
+        with open(self.index_path + ".tmp", "w") as index_file:
+            json.dump(self.index, index_file, indent=1)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def report(self):
+        total_bytes = sum(entry["bytes"] for entry in self.index.values())
+        print(f"Mach cache {self.directory}: {len(self.index)} files, {total_bytes / 1e6:.1f} MB")
+        for stage in sorted(set(self.hits) | set(self.misses)):
+            print(f" * {stage}: {self.hits.get(stage, 0)} hits, {self.misses.get(stage, 0)} misses")
+
+
+def lazy_chunk_sizes(result):
+    # Size of the first dask chunk along each chunked dimension of a DataArray or Dataset; empty if it is in memory
+    variables = [result.variable] if isinstance(result, xr.DataArray) else result.variables.values()
+    return {dim: sizes[0] for variable in variables if variable.chunks is not None
+            for dim, sizes in zip(variable.dims, variable.chunks)}
+
+
+def content_hash(data_array):
+    data_hash = hashlib.sha256(np.ascontiguousarray(data_array.values).tobytes())
+    for coord in sorted(data_array.coords):
+        data_hash.update(coord.encode())
+        data_hash.update(np.ascontiguousarray(data_array.coords[coord].values).tobytes())
+    return data_hash.hexdigest()
+
+
+def get_cached_mach_dataset(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, electron_temperature_da,
+                            **mach_isat_kwargs):
+    r"""
+    Find Mach numbers and velocities from an HDF5 file, reusing cached stages: raw isat (volts), scaled isat,
+    Mach numbers, and velocities.
+
+    :param cache: StageCache
+    :param hdf5_path: path of HDF5 file, or LapdSession
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe
+    :param electron_temperature_da: electron temperature profile
+    :param mach_isat_kwargs: other keyword arguments of get_mach_isat
+    :return: Dataset of Mach numbers and velocities
+    """
+
+    isat_key = cached_isat_key(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, mach_isat_kwargs)
+    mach_key = cache.key("mach", isat_key)
+    velocity_key = cache.key("velocity", mach_key, content_hash(electron_temperature_da))
+
+    mach_ds = cache.get_or_compute("mach", mach_key, lambda: get_velocity_profiles(get_cached_isat(
+        cache, hdf5_path, mach_bcs, mach_receptacles, resistances, **mach_isat_kwargs)))
+    velocity_ds = cache.get_or_compute("velocity", velocity_key,
+                                       lambda: get_velocities(mach_ds, electron_temperature_da))
+    mach_velocities = xr.merge([mach_ds, velocity_ds])
+    return mach_velocities[[key for key in mach_variable_order if key in mach_velocities]]
+
+
+def get_cached_isat_spectra(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, spectra_options=None,
+                            **mach_isat_kwargs):
+    r"""
+    Find isat spectra from an HDF5 file with get_isat_spectra, reusing cached isat and spectra stages.
+
+    :param cache: StageCache
+    :param hdf5_path: path of HDF5 file, or LapdSession
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe
+    :param spectra_options: dictionary of keyword arguments of get_isat_spectra, or None
+    :param mach_isat_kwargs: other keyword arguments of get_mach_isat
+    :return: Dataset of isat spectra
+    """
+
+    spectra_options = {} if spectra_options is None else spectra_options
+    isat_key = cached_isat_key(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, mach_isat_kwargs)
+    spectra_key = cache.key("spectra", isat_key, {option: value for option, value in spectra_options.items()
+                                                  if option != "block_size"})
+    return cache.get_or_compute("spectra", spectra_key, lambda: get_isat_spectra(get_cached_isat(
+        cache, hdf5_path, mach_bcs, mach_receptacles, resistances, **mach_isat_kwargs), **spectra_options))
+
+
+def get_cached_isat(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, **mach_isat_kwargs):
+    # Scaled isat from the cache, found from cached raw isat (volts) if only resistances changed
+    raw_isat_key = cached_isat_key(cache, hdf5_path, mach_bcs, mach_receptacles, None, mach_isat_kwargs)
+    isat_key = cached_isat_key(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, mach_isat_kwargs)
+    raw_isat = cache.get_or_compute("raw isat", raw_isat_key, lambda: get_mach_isat(
+        hdf5_path, mach_bcs, mach_receptacles, None, **mach_isat_kwargs))
+    return cache.get_or_compute("isat", isat_key, lambda: to_real_mach_isat_units(raw_isat, resistances))
+
+
+def cached_isat_key(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, mach_isat_kwargs):
+    # Key of isat stage, or of raw isat stage if resistances is None
+    read_options = {option: value for option, value in mach_isat_kwargs.items()
+                    if option not in result_neutral_read_options}
+    raw_isat_key = cache.key("raw isat", file_identity(hdf5_path), mach_bcs, mach_receptacles, read_options)
+    return raw_isat_key if resistances is None else cache.key("isat", raw_isat_key, resistances)
+
+
+def get_cached_mach_statistics(cache, hdf5_path, mach_bcs, mach_receptacles, resistances, electron_temperature_da,
+                               **statistics_kwargs):
+    r"""
+    Find shot statistics of Mach numbers and velocities from an HDF5 file with get_mach_statistics, reusing cached
+    shot statistics and velocities.
+
+    :param cache: StageCache
+    :param hdf5_path: path of HDF5 file, or LapdSession
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe
+    :param electron_temperature_da: electron temperature profile
+    :param statistics_kwargs: other keyword arguments of get_mach_statistics, except keep_shots
+    :return: Dataset of mean, variance and count of isat, Mach numbers and velocities
+    """
+
+    read_options = {option: value for option, value in statistics_kwargs.items()
+                    if option not in result_neutral_read_options}
+    statistics_key = cache.key("shot statistics", file_identity(hdf5_path), mach_bcs, mach_receptacles, resistances,
+                               read_options)
+    velocity_key = cache.key("velocity statistics", statistics_key, content_hash(electron_temperature_da))
+
+    statistics_ds = cache.get_or_compute("shot statistics", statistics_key, lambda: get_mach_statistics(
+        hdf5_path, mach_bcs, mach_receptacles, resistances, **statistics_kwargs))
+    velocity_ds = cache.get_or_compute("velocity statistics", velocity_key,
+                                       lambda: statistics_velocities(statistics_ds, electron_temperature_da))
+    return statistics_ds.assign(velocity_ds.data_vars)
@@ -1,10 +1,15 @@
-import numpy as np
 import astropy.units as u
 
-from bapsflib import lapd
+from session import as_session
 
 
 def get_exp_params(hdf5_path):
+    r"""
+    Find LAPD experimental parameters of a run.
+
+    :param hdf5_path: path of HDF5 file, or LapdSession to share its open file and metadata index
+    :return: dictionary of parameter name to value
+    """
 
     # The user can define these experimental control parameter functions
     exp_params_functions = [get_nominal_discharge,
@@ -14,14 +19,18 @@ def get_exp_params(hdf5_path):
                             get_magnetic_field]
     # Units are given in MATLAB code
     exp_params_names_values = {}
-    with lapd.File(hdf5_path) as hdf5_file:
+    session, close_session = as_session(hdf5_path)
+    try:
         for exp_param_function in exp_params_functions:
-            exp_params_names_values.update(exp_param_function(hdf5_file))
+            exp_params_names_values.update(exp_param_function(session))
+    finally:
+        if close_session:
+            session.close()
     return exp_params_names_values
 
 
-def get_nominal_discharge(file):
-    description = str(file.info['run description'])
+def get_nominal_discharge(session):
+    description = str(session.info['run description'])
 
     dis_ind = description.index("Idis")
     start_ind = description[dis_ind:].index(next(filter(str.isnumeric, description[dis_ind:]))) + dis_ind
@@ -30,8 +39,8 @@ def get_nominal_discharge(file):
     return {"Nominal discharge": float(description[start_ind:end_ind]) * u.A}
 
 
-def get_nominal_gas_puff(file):
-    description = str(file.info['run description']).lower()
+def get_nominal_gas_puff(session):
+    description = str(session.info['run description']).lower()
 
     puff_ind = description.index("puffing")
     start_ind = description[puff_ind:].index(next(filter(str.isnumeric, description[puff_ind:]))) + puff_ind
@@ -41,21 +50,18 @@ def get_nominal_gas_puff(file):
     return {"Nominal gas puff": float(description[start_ind:end_ind]) * u.V}
 
 
-def get_discharge(file):
+def get_discharge(session):
     # return item_at_path(file, '/MSI/Discharge/Discharge summary/')
-    return {"Discharge current": np.mean(file.read_msi("Discharge", silent=True)['meta']['peak current']) * u.A}
+    return {"Discharge current": session.msi_summary("Discharge", "peak current")["mean"] * u.A}
     # Future work: plotting the discharge current could give a really helpful
     #     visualization of the plasma heating over time
 
 
-def get_gas_pressure(file):
+def get_gas_pressure(session):
     # return item_at_path(file, '/MSI/Gas pressure/Gas pressure summary/')
-    return {"Fill pressure": np.mean(file.read_msi("Gas pressure", silent=True)['meta']['fill pressure']) * u.Torr}
+    return {"Fill pressure": session.msi_summary("Gas pressure", "fill pressure")["mean"] * u.Torr}
 
 
-def get_magnetic_field(file):
+def get_magnetic_field(session):
     # return item_at_path(file, '/MSI/Magnetic field/Magnetic field summary/')
-    return {"Peak magnetic field": np.mean(file.read_msi("Magnetic field", silent=True)['meta']['peak magnetic field']
-                                           ) * u.gauss}
-
-
+    return {"Peak magnetic field": session.msi_summary("Magnetic field", "peak magnetic field")["mean"] * u.gauss}
@@ -0,0 +1,164 @@
+r"""
+Render contour and linear profile figures of Mach datasets to image files, without a display.
+
+Each run is reduced once to a small summary dataset of shot means and steady-state linear profiles, and its figures
+are drawn from that summary in a process pool with the Agg backend. The inputs of each figure are hashed, and
+figures whose image file exists with the same inputs are not drawn again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+from files import make_path
+from profiling import stage
+from radial import linear_profile
+from shot_statistics import shot_mean
+from velocity import mach_variable_order
+
+logger = logging.getLogger(__name__)
+
+
+def summary_dataset(mach_ds, steady_state_start, steady_state_end):
+    r"""
+    Shot means of each Mach variable, and their linear profiles averaged over the steady-state period.
+
+    :param mach_ds: Dataset from get_velocity_profiles or get_mach_statistics
+    :param steady_state_start: start time of steady-state period, as an astropy Quantity
+    :param steady_state_end: end time of steady-state period, as an astropy Quantity
+    :return: Dataset with each Mach variable (port, x, y, time) and, for line data, VARIABLE profile (port, x, y)
+    """
+
+    with stage("summary dataset"):
+        summary_ds = mach_ds[[variable for variable in mach_variable_order if variable in mach_ds]].map(
+            shot_mean, keep_attrs=True).load()
+        if summary_ds.sizes['x'] > 1 and summary_ds.sizes['y'] > 1:
+            return summary_ds  # Linear profiles are not defined for areal data
+        profiles = {}
+        for variable in list(summary_ds.data_vars):
+            profile = linear_profile(summary_ds[variable], steady_state_start, steady_state_end)
+            # linear_profile squeezes out a single port, which is kept as a coordinate
+            profiles[variable + " profile"] = profile if 'port' in profile.dims else profile.expand_dims('port')
+        return summary_ds.assign(profiles)
+
+
+def figure_jobs(summary_ds, figure_directory, run_name, dpi=180):
+    r"""
+    List the contour and linear profile figures of every port and variable of a summary dataset.
+
+    :param summary_ds: Dataset from summary_dataset
+    :param figure_directory: directory to save figures in
+    :param run_name: name of run, which starts each figure file name
+    :param dpi: resolution of figures
+    :return: list of figure jobs, each a dictionary of figure "path", "kind", "title", "dpi", "data" and "inputs"
+    """
+
+    jobs = []
+    for variable in mach_variable_order:
+        if variable not in summary_ds:
+            continue
+        for port in summary_ds.port.values:
+            title = f"{variable} (Port {port})"
+            for kind, figure_da in (("contour", summary_ds[variable]),
+                                    ("profile", summary_ds.get(variable + " profile"))):
+                if figure_da is None:
+                    continue
+                figure_da = figure_da.sel(port=port).rename(variable)
+                jobs.append({"path": make_path(figure_directory, "_".join(
+                    [run_name, variable.replace(" ", "_"), "port" + str(port), kind]), "png"),
+                             "kind": kind, "title": title, "dpi": dpi, "data": figure_da,
+                             "inputs": figure_inputs_hash(figure_da, kind, title, dpi)})
+    return jobs
+
+
+def figure_inputs_hash(figure_da, kind, title, dpi):
+    # Hash of everything drawn in a figure: values, coordinates and attributes of its data, and how it is drawn
+    inputs_hash = hashlib.sha256(json.dumps([kind, title, dpi, figure_da.attrs], sort_keys=True,
+                                            default=str).encode())
+    inputs_hash.update(figure_da.values.tobytes())
+    for coord in sorted(figure_da.coords):
+        inputs_hash.update(coord.encode())
+        inputs_hash.update(figure_da.coords[coord].values.tobytes())
+    return inputs_hash.hexdigest()
+
+
+def render_figures(jobs, max_workers=None, force=False):
+    r"""
+    Draw figures in a process pool with the Agg backend, skipping those whose inputs have not changed since they were
+    last drawn. The inputs of each figure are recorded in figure_index.json in its directory.
+
+    :param jobs: list of figure jobs from figure_jobs
+    :param max_workers: number of worker processes, or None for one per CPU
+    :param force: True to draw figures whose inputs have not changed
+    :return: (number of figures drawn, number of figures skipped)
+    """
+
+    indexes = {}
+    for directory in {os.path.dirname(job["path"]) for job in jobs}:
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, "figure_index.json")) as index_file:
+                indexes[directory] = json.load(index_file)
+        except FileNotFoundError:
+            indexes[directory] = {}
+    stale_jobs = [job for job in jobs if force or not os.path.isfile(job["path"])
+                  or indexes[os.path.dirname(job["path"])].get(os.path.basename(job["path"])) != job["inputs"]]
+
+    with stage("render figures", figures=len(stale_jobs)):
+        if stale_jobs:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=use_headless_backend) as executor:
+                # Submitting jobs in order and collecting them in order raises the first failed figure's error
+                futures = [executor.submit(render_figure, job["data"], job["kind"], job["title"], job["path"],
+                                           job["dpi"]) for job in stale_jobs]
+                for job, future in zip(stale_jobs, futures):
+                    future.result()
+                    indexes[os.path.dirname(job["path"])][os.path.basename(job["path"])] = job["inputs"]
+    for directory, index in indexes.items():
+        with open(os.path.join(directory, "figure_index.json"), "w") as index_file:
+            json.dump(index, index_file, indent=1)
+    logger.info("%d figures drawn, %d unchanged", len(stale_jobs), len(jobs) - len(stale_jobs))
+    return len(stale_jobs), len(jobs) - len(stale_jobs)
+
+
+def use_headless_backend():
+    # Runs in each worker process before any figure is drawn
+    matplotlib.use("Agg", force=True)
+
+
+def render_figure(figure_da, kind, title, path, dpi):
+    # Runs in a worker process
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots()
+    figure_da = figure_da.squeeze()
+    if kind == "contour":
+        figure_da.plot.contourf(ax=axes, robust=True)
+    else:
+        figure_da.plot(ax=axes, x=next(dim for dim in ('x', 'y') if dim in figure_da.dims))
+    axes.set_title(title)
+    figure.savefig(path, dpi=dpi)
+    plt.close(figure)
+
+
+def render_run_figures(mach_ds, figure_directory, steady_state_start, steady_state_end, run_name, max_workers=None,
+                       dpi=180, force=False):
+    r"""
+    Save the contour and linear profile figures of every port and variable of a Mach dataset to image files.
+
+    :param mach_ds: Dataset from get_velocity_profiles or get_mach_statistics
+    :param figure_directory: directory to save figures in
+    :param steady_state_start: start time of steady-state period, as an astropy Quantity
+    :param steady_state_end: end time of steady-state period, as an astropy Quantity
+    :param run_name: name of run, which starts each figure file name
+    :param max_workers: number of worker processes, or None for one per CPU
+    :param dpi: resolution of figures
+    :param force: True to draw figures whose inputs have not changed
+    :return: (number of figures drawn, number of figures skipped)
+    """
+
+    summary_ds = summary_dataset(mach_ds, steady_state_start, steady_state_end)
+    return render_figures(figure_jobs(summary_ds, figure_directory, run_name, dpi), max_workers, force)
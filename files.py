@@ -1,8 +1,11 @@
 import os
 import warnings
 
+import numpy as np
 import xarray as xr
 
+from profiling import stage
+
 
 def choose_list(choices, kind, location, add_new):
     print("The following " + kind + "s were found in the " + location + ":")
@@ -33,24 +36,145 @@ def choose_multiple_list(choices, name, null_action=None):
     return [ord(letter) - 97 for letter in selection_str if 0 <= ord(letter) - 97 < len(choices)]
 
 
+# File signatures of NetCDF classic (CDF) and NetCDF-4 (HDF5) files
+netcdf_signatures = (b"CDF\x01", b"CDF\x02", b"CDF\x05", b"\x89HDF\r\n\x1a\n")
+
+
 # Ensure that the file path contains a Dataset
 def check_netcdf(filename):
+    # Only the file signature is read, so large datasets are not opened
     try:
-        xr.open_dataset(filename)
+        with open(filename, "rb") as netcdf_file:
+            signature = netcdf_file.read(8)
     except FileNotFoundError:
         return False
+    if not signature.startswith(netcdf_signatures):
+        raise ValueError("File " + repr(filename) + " is not a NetCDF file")
     return True
 
 
-def open_netcdf(filename):
+def open_netcdf(filename, chunks=None):
     # print("Opening NetCDF dataset file...")
-    return xr.open_dataset(filename)
+    # With chunks (for example {"port": 1}), variables are read lazily by dask one chunk at a time
+    with stage("open_netcdf", path=filename):
+        return xr.open_dataset(filename, chunks=chunks)
+
+
+def write_netcdf(dataset, path, compression_level=None, dtype=None, chunk_sizes=None, mode=None):
+    r"""
+    Save a Dataset to a NetCDF file, by default adding its variables to the file if it exists.
+
+    :param dataset: Dataset to save
+    :param path: path of NetCDF file
+    :param compression_level: zlib compression level from 1 to 9, or None to save uncompressed
+    :param dtype: data type to store floating-point variables as: np.float32, an integer type such as np.int16 to
+        store values scaled to the range of that type (lossy; infinite values are saved as missing), or None to keep
+        their data type
+    :param chunk_sizes: dictionary of dimension name to chunk size, overriding those of default_chunk_sizes;
+        chunks are only used if compression_level, dtype or chunk_sizes is given
+    :param mode: "w" to overwrite any existing file, "a" to add to an existing file, or None to add to the file if it
+        exists and create it otherwise
+    """
 
-
-def write_netcdf(dataset, path):
     # print("Saving diagnostic dataset...")
-    save_mode = 'a' if check_netcdf(path) else 'w'
-    dataset.to_netcdf(path=path, mode=save_mode)
+    with stage("write_netcdf", path=path, bytes=int(dataset.nbytes)) as record:
+        save_mode = mode if mode is not None else 'a' if check_netcdf(path) else 'w'
+        encoding = None
+        if compression_level is not None or dtype is not None or chunk_sizes is not None:
+            dataset = mask_unscalable_values(dataset, dtype)
+            encoding = output_encoding(dataset, compression_level, dtype, chunk_sizes, engine="netcdf4")
+        dataset.to_netcdf(path=path, mode=save_mode, encoding=encoding)
+        record["bytes written"] = os.path.getsize(path)
+
+
+def write_zarr(dataset, path, append_dim=None, dtype=None, chunk_sizes=None):
+    r"""
+    Save a Dataset to a Zarr store, which can be appended to and read partially. Requires the zarr package.
+
+    :param dataset: Dataset to save
+    :param path: path of Zarr store (a directory)
+    :param append_dim: dimension along which to append to an existing store, for example "shot" to add shots of a
+        run as they are processed, or None to overwrite any existing store
+    :param dtype: data type to store floating-point variables as, as in write_netcdf; ignored when appending
+    :param chunk_sizes: dictionary of dimension name to chunk size, overriding those of default_chunk_sizes;
+        ignored when appending
+    """
+
+    with stage("write_zarr", path=path, bytes=int(dataset.nbytes)):
+        if append_dim is not None and os.path.isdir(path):
+            # An existing store keeps the encoding and chunks it was created with
+            dataset.to_zarr(path, append_dim=append_dim)
+        else:
+            dataset = mask_unscalable_values(dataset, dtype)
+            dataset.to_zarr(path, mode='w', encoding=output_encoding(dataset, None, dtype, chunk_sizes, engine="zarr"))
+
+
+def open_zarr(path, chunks=None):
+    # Variables are read lazily by dask, so only the chunks that are used are loaded; by default dask chunks are the
+    # chunks of the store
+    with stage("open_zarr", path=path):
+        return xr.open_zarr(path, chunks={} if chunks is None else chunks)
+
+
+def default_chunk_sizes(dataset, target_bytes=2 ** 22):
+    # One port, face and y position per chunk, with whole x lines and all shots, so reading one port or one x line
+    # touches few chunks; time is split so that chunks hold about target_bytes
+    chunk_sizes = {dim: 1 for dim in ("port", "face", "y") if dim in dataset.dims}
+    chunk_sizes.update({dim: dataset.sizes[dim] for dim in ("x", "shot") if dim in dataset.dims})
+    if "time" in dataset.dims:
+        values_per_chunk = int(np.prod(list(chunk_sizes.values()))) * 8
+        chunk_sizes["time"] = int(np.clip(target_bytes // values_per_chunk, 1, dataset.sizes["time"]))
+    return chunk_sizes
+
+
+def output_encoding(dataset, compression_level=None, dtype=None, chunk_sizes=None, engine="netcdf4"):
+    r"""
+    Make the encoding of each data variable of a Dataset for to_netcdf or to_zarr.
+
+    :param dataset: Dataset to be saved
+    :param compression_level: zlib compression level from 1 to 9 (NetCDF only; Zarr stores are compressed by default)
+    :param dtype: data type to store floating-point variables as: np.float32, an integer type such as np.int16 to
+        store values scaled to the range of that type, or None to keep their data type
+    :param chunk_sizes: dictionary of dimension name to chunk size, overriding those of default_chunk_sizes
+    :param engine: "netcdf4" or "zarr"
+    :return: dictionary of variable name to encoding dictionary
+    """
+
+    chunk_sizes = {**default_chunk_sizes(dataset), **(chunk_sizes or {})}
+    encoding = {}
+    for name, variable in dataset.data_vars.items():
+        chunks = tuple(min(chunk_sizes.get(dim, variable.sizes[dim]), variable.sizes[dim]) for dim in variable.dims)
+        variable_encoding = {"chunksizes" if engine == "netcdf4" else "chunks": chunks}
+        if compression_level is not None and engine == "netcdf4":
+            variable_encoding.update({"zlib": True, "complevel": compression_level, "shuffle": True})
+        if dtype is not None and np.issubdtype(variable.dtype, np.floating):
+            if np.issubdtype(dtype, np.integer):
+                variable_encoding.update(scaled_integer_encoding(variable, dtype))
+            else:
+                variable_encoding["dtype"] = np.dtype(dtype)
+        encoding[name] = variable_encoding
+    return encoding
+
+
+def mask_unscalable_values(dataset, dtype):
+    # Infinite values (from zero isat on a face) have no scaled-integer value, so they are saved as missing values
+    if dtype is None or not np.issubdtype(dtype, np.integer):
+        return dataset
+    return dataset.map(lambda variable: variable.where(np.isfinite(variable))
+                       if np.issubdtype(variable.dtype, np.floating) else variable, keep_attrs=True)
+
+
+def scaled_integer_encoding(variable, dtype):
+    # Map the range of finite values onto the integer range, keeping the lowest integer to mark missing values
+    integer_info = np.iinfo(dtype)
+    min_value = float(variable.min(skipna=True))
+    max_value = float(variable.max(skipna=True))
+    if not np.isfinite(min_value) or not np.isfinite(max_value):
+        min_value = max_value = 0.
+    scale_factor = (max_value - min_value) / (int(integer_info.max) - int(integer_info.min) - 1) or 1.
+    add_offset = (max_value + min_value) / 2
+    return {"dtype": np.dtype(dtype), "scale_factor": scale_factor, "add_offset": add_offset,
+            "_FillValue": integer_info.min}
 
 
 # Search the given directory and all subfolders for files of desired extension
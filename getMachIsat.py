@@ -1,9 +1,21 @@
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
 import numpy as np
+import pandas as pd
 import xarray as xr
 import astropy.units as u
 from bapsflib import lapd
 from bapsflib.lapd.tools import portnum_to_z as port_to_z
 
+from profiling import stage, profiled, array_details
+from session import as_session, file_identity
+
 # Note: This code is based on getIVsweep.py in the lapd-plasma-analysis repository.
 # MAKE GET_ISWEEP_VSWEEP A NAMESPACE PACKAGE WITH GENERIC DATA TO ACCESS AND IMPORT HERE?
 
@@ -17,15 +29,37 @@ from bapsflib.lapd.tools import portnum_to_z as port_to_z
 #                          {2: 14.9, 5: 15.0}]
 
 
-def get_mach_isat(filename, mach_bcs, mach_receptacles, resistances):
+@profiled("get_mach_isat")
+def get_mach_isat(filename, mach_bcs, mach_receptacles, resistances, memory_budget=None, max_workers=1, dtype=float,
+                  chunk_positions=None, chunk_frames=None, time_window=None, decimation=1, decimation_method="boxcar",
+                  isat_path=None):
 
     # TODO add function definition
     r"""
 
-    :param filename:
+    :param filename: path of HDF5 file, or LapdSession to share its open file and metadata index
     :param mach_bcs:
     :param mach_receptacles:
-    :param resistances:
+    :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+    :param memory_budget: maximum number of bytes of raw digitizer data to hold in memory at once, or None to read
+        all shots of every channel at once. Setting a budget reads the data in blocks of shots; the returned isat array
+        is still held in memory unless isat_path is given.
+    :param max_workers: number of processes used to read blocks of shots concurrently when memory_budget is set (see
+        isat_reader); without a budget, all shots are read in this process
+    :param dtype: data type of returned isat array; use np.float32 to halve its memory
+    :param chunk_positions: number of x positions per chunk to return a lazy, dask-backed DataArray that is read
+        and computed chunk by chunk (in parallel) only when needed, or None to read all data now
+    :param chunk_frames: number of time steps per chunk of a lazy DataArray; each chunk reads only its own frames
+        (and the DC offset frames), so later stages that select times read only those. None for one chunk over all
+        times.
+    :param time_window: frames of each shot to read, as a slice of frame indices or a (start, end) pair of astropy
+        time Quantities such as steady_state_times, or None to read all frames. The DC offset is still found from
+        the last 1000 frames of each shot.
+    :param decimation: number of frames averaged into each returned time step
+    :param decimation_method: "boxcar" to average blocks of frames, or "anti-aliased" to low-pass filter with a
+        windowed-sinc filter before keeping every decimation-th frame
+    :param isat_path: path of a .npy file to write isat to block by block when memory_budget is set, so the returned
+        array is memory-mapped from disk and peak memory does not grow with run length; None to hold it in memory
     :return:
     """
 
@@ -40,98 +74,599 @@ def get_mach_isat(filename, mach_bcs, mach_receptacles, resistances):
     - We'll have to have a Face dimension. That will disappear in velocity.py
     """
 
-    lapd_file = lapd.File(filename)
-    run_name = lapd_file.info['run name']
+    session, close_session = as_session(filename)
+    run_name = session.info['run name']
+
+    try:
+        frame_selection = get_frame_selection(session.channel_layout(*mach_bcs[0][list(mach_bcs[0].keys())[0]]),
+                                              time_window, decimation, decimation_method)
+        if chunk_positions is not None:
+            isat_da = lazy_mach_isat(session, mach_bcs, mach_receptacles, resistances, chunk_positions, chunk_frames,
+                                     dtype, frame_selection)
+        elif memory_budget is not None:
+            isat_da = stream_mach_isat(session, mach_bcs, mach_receptacles, resistances, memory_budget, max_workers,
+                                       dtype, frame_selection, isat_path)
+        else:
+            isat_da = read_mach_isat(session, mach_bcs, mach_receptacles, resistances, dtype, frame_selection)
+    finally:
+        if close_session:
+            session.close()
+    return isat_da.rename(run_name)
+
+
+def read_mach_isat(session, mach_bcs, mach_receptacles, resistances, dtype=float, frame_selection=None):
+    # Reads all shots of every channel at once in this process, then assembles them into one isat array. Reader
+    # processes would each send a whole channel back through a pipe, briefly holding the data twice.
+    lapd_file = session.lapd_file
+    with stage("read isat") as record:
+        isat_datas, offset_datas = read_isat_frames(lapd_file, mach_bcs, None, frame_selection)
+        # print(isat_datas[0][2]['signal'].shape)
+        mach_motions = [session.motion(receptacle) for receptacle in mach_receptacles]
+        record["bytes read"] = isat_datas_bytes(isat_datas) + isat_datas_bytes(offset_datas)
+    ports = np.array([motion['port'] for motion in mach_motions])
+    # NOTE: Assume mach motor datas from 6K Compumotor are identical, and only consider first one
+    shot_index = get_run_shot_index(session, mach_receptacles[0])
+
+    with stage("assemble isat") as record:
+        isat_da = to_mach_isat_da(isat_datas, shot_index, ports, resistances, dtype, frame_selection, offset_datas)
+        record.update(array_details(isat_da))
+    return isat_da
+
+
+def stream_mach_isat(session, mach_bcs, mach_receptacles, resistances, memory_budget, max_workers=1, dtype=float,
+                     frame_selection=None, isat_path=None):
+    """
+    Read Mach probe isat signals block by block of shots into a preallocated array, removing the DC offset and
+    scaling by face resistance one block at a time, so that only one block of raw digitizer data is held in memory.
+    The isat array itself grows with run length; with isat_path, it is a memory-mapped file that each block is
+    flushed to, so it is held on disk instead of in memory.
+
+    :param session: LapdSession of HDF5 file
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+    :param memory_budget: maximum number of bytes of raw digitizer data to hold in memory at once
+    :param max_workers: number of processes used to read digitizer channels concurrently (see isat_reader)
+    :param dtype: data type of returned isat array
+    :param frame_selection: frames to read and decimation from get_frame_selection, or None for all frames
+    :param isat_path: path of .npy file to write isat array to, or None to hold it in memory
+    :return: DataArray of isat in real units
+    """
+
+    lapd_file = session.lapd_file
+    mach_motions = [session.motion(receptacle) for receptacle in mach_receptacles]
+    ports = np.array([motion['port'] for motion in mach_motions])
+    # NOTE: Assume mach motor datas from 6K Compumotor are identical, and only consider first one
+    shot_index = get_run_shot_index(session, mach_receptacles[0])
+    num_shots = len(shot_index['cube rows'])
+    cube_rows = None if shot_index['contiguous'] else shot_index['cube rows']
+
+    channel_layout = session.channel_layout(*mach_bcs[0][list(mach_bcs[0].keys())[0]])
+    if frame_selection is None:
+        frame_selection = get_frame_selection(channel_layout)
+    num_frames = frame_selection['num frames']
+    faces = sorted({face for probe_bcs in mach_bcs for face in probe_bcs})
+
+    shots_per_block = get_shots_per_block(mach_bcs, channel_layout, frame_selection, memory_budget, max_workers)
+
+    isat_array = empty_mach_isat_array((len(ports), len(faces), shot_index['num cube rows'], num_frames), mach_bcs,
+                                       faces, dtype, cube_rows, isat_path)
+    with isat_reader(session.hdf5_path, max_workers) as reader:
+        for start, stop, isat_datas, offset_datas in read_isat_blocks(lapd_file, mach_bcs, reader, num_shots,
+                                                                      shots_per_block, frame_selection):
+            with stage("assemble isat block", shots=stop - start):
+                for probe in range(len(isat_datas)):
+                    for face in isat_datas[probe]:
+                        if cube_rows is None:
+                            isat_rows, block_cube_rows = isat_array[probe, faces.index(face), start:stop], None
+                        else:
+                            isat_rows, block_cube_rows = isat_array[probe, faces.index(face)], cube_rows[start:stop]
+                        write_isat_rows(isat_rows, isat_datas[probe][face]['signal'],
+                                        face_resistance(resistances, probe, face), block_cube_rows,
+                                        offset_signal(offset_datas, probe, face), frame_selection)
+                if isat_path is not None:
+                    # Written pages can then be dropped from memory, rather than held until the whole array is done
+                    isat_array.flush()
+
+    if isat_path is not None:
+        isat_array = np.load(isat_path, mmap_mode="r")
+    x_pos, y_pos = shot_index['x'], shot_index['y']
+    isat_array = isat_array.reshape((len(ports), len(faces), len(x_pos), len(y_pos), shot_index['shots per position'],
+                                     num_frames))
+    return wrap_mach_isat_array(isat_array, ports, faces, x_pos, y_pos, channel_layout['dt'],
+                                frame_selection['frames'])
+
+
+def lazy_mach_isat(session, mach_bcs, mach_receptacles, resistances, chunk_positions, chunk_frames=None, dtype=float,
+                   frame_selection=None):
+    """
+    Build a dask-backed isat DataArray. Each chunk covers a range of x positions and of time steps of every probe
+    face, and reads only those shots and frames when computed. h5py runs every HDF5 call of a process under one
+    lock, so with dask's default threaded scheduler chunks are read one at a time, and only their offsetting and
+    scaling overlap; compute with the processes scheduler (dask.config.set(scheduler="processes")) or a distributed
+    cluster to read chunks in parallel. Each process keeps its own handle on the HDF5 file (see open_chunk_file).
+
+    :param session: LapdSession of HDF5 file, used only for motion lists and digitizer layout
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+    :param chunk_positions: number of x positions per chunk
+    :param chunk_frames: number of time steps per chunk, or None for all time steps in one chunk
+    :param dtype: data type of isat array
+    :param frame_selection: frames to read and decimation from get_frame_selection, or None for all frames
+    :return: lazy DataArray of isat in real units
+    """
+    import dask.array as da
+    from dask import delayed
+
+    mach_motions = [session.motion(receptacle) for receptacle in mach_receptacles]
+    ports = np.array([motion['port'] for motion in mach_motions])
+    # NOTE: Assume mach motor datas from 6K Compumotor are identical, and only consider first one
+    shot_index = get_run_shot_index(session, mach_receptacles[0])
+    channel_layout = session.channel_layout(*mach_bcs[0][list(mach_bcs[0].keys())[0]])
+    if frame_selection is None:
+        frame_selection = get_frame_selection(channel_layout)
+    num_frames = frame_selection['num frames']
+    faces = sorted({face for probe_bcs in mach_bcs for face in probe_bcs})
+    x_pos, y_pos, shots_per_position = shot_index['x'], shot_index['y'], shot_index['shots per position']
+
+    # Each range of time steps is read with its own frame selection over the frames it is decimated from, which gives
+    # the same time steps as the whole selection
+    time_chunk_selections = [(num_frames, frame_selection)]
+    if chunk_frames is not None:
+        window_start = frame_selection['read frames'].start + frame_selection['filter margin']
+        decimation = frame_selection['decimation']
+        time_chunk_selections = [
+            (min(time_start + chunk_frames, num_frames) - time_start,
+             get_frame_selection(channel_layout, slice(window_start + time_start * decimation,
+                                                       window_start + min(time_start + chunk_frames, num_frames)
+                                                       * decimation),
+                                 decimation, frame_selection['decimation method']))
+            for time_start in range(0, num_frames, chunk_frames)]
+
+    # Cube rows are ordered by x position first, so each x range is a contiguous range of cube rows. If shots are in
+    # cube order, it is also a contiguous range of digitizer rows; otherwise its shots are gathered by row number.
+    shots_per_x = len(y_pos) * shots_per_position
+    x_chunk_arrays = []
+    for x_start in range(0, len(x_pos), chunk_positions):
+        x_stop = min(x_start + chunk_positions, len(x_pos))
+        if shot_index['contiguous']:
+            digitizer_rows, chunk_cube_rows = slice(x_start * shots_per_x, x_stop * shots_per_x), None
+        else:
+            digitizer_rows = np.flatnonzero((shot_index['cube rows'] >= x_start * shots_per_x)
+                                            & (shot_index['cube rows'] < x_stop * shots_per_x))
+            chunk_cube_rows = shot_index['cube rows'][digitizer_rows] - x_start * shots_per_x
+        time_chunk_arrays = []
+        for chunk_num_frames, chunk_selection in time_chunk_selections:
+            chunk_shape = (len(ports), len(faces), x_stop - x_start, len(y_pos), shots_per_position, chunk_num_frames)
+            isat_chunk = delayed(read_isat_chunk)(session.hdf5_path, mach_bcs, resistances, digitizer_rows,
+                                                  chunk_shape, dtype, chunk_cube_rows, chunk_selection)
+            time_chunk_arrays.append(da.from_delayed(isat_chunk, shape=chunk_shape, dtype=dtype))
+        x_chunk_arrays.append(da.concatenate(time_chunk_arrays, axis=-1))
+    isat_array = da.concatenate(x_chunk_arrays, axis=2)
+
+    return wrap_mach_isat_array(isat_array, ports, faces, x_pos, y_pos, channel_layout['dt'],
+                                frame_selection['frames'])
+
+
+def read_isat_chunk(filename, mach_bcs, resistances, index, shape, dtype=float, cube_rows=None,
+                    frame_selection=None):
+    # Reads from the file handle of the process running it, so that chunks can be read by separate processes.
+    # Digitizer rows given by index are scattered to cube_rows of the chunk, or reshaped into it if cube_rows is None.
+    faces = sorted({face for probe_bcs in mach_bcs for face in probe_bcs})
+    flat_shape = (*shape[:2], int(np.prod(shape[2:-1])), shape[-1])
+    isat_chunk = empty_mach_isat_array(flat_shape, mach_bcs, faces, dtype, cube_rows)
+    lapd_file = open_chunk_file(filename)
+    with stage("read isat chunk", **array_details(isat_chunk)) as record:
+        record["bytes read"] = 0
+        for probe in range(len(mach_bcs)):
+            for face in mach_bcs[probe]:
+                isat_signal = lapd_file.read_data(*mach_bcs[probe][face], index=index, silent=True,
+                                                  time_slice=read_frames(frame_selection))['signal']
+                offset_frames_signal = None
+                if frame_selection is not None and frame_selection['offset frames'] is not None:
+                    offset_frames_signal = lapd_file.read_data(*mach_bcs[probe][face], index=index, silent=True,
+                                                               time_slice=frame_selection['offset frames'])['signal']
+                    record["bytes read"] += offset_frames_signal.nbytes
+                record["bytes read"] += isat_signal.nbytes
+                write_isat_rows(isat_chunk[probe, faces.index(face)], isat_signal,
+                                face_resistance(resistances, probe, face), cube_rows, offset_frames_signal,
+                                frame_selection)
+    return isat_chunk.reshape(shape)
+
+
+# HDF5 files opened by read_isat_chunk, kept open for the other chunks read by the same process, most recently used
+# last. Keys hold the process ID, so a forked process opens its own handle, and the file size and modification time,
+# so a changed file is opened again.
+chunk_files = OrderedDict()
+max_chunk_files = 4
+chunk_files_lock = threading.Lock()
+
+
+def open_chunk_file(filename):
+    chunk_file_key = (os.getpid(), *file_identity(filename))
+    with chunk_files_lock:
+        if chunk_file_key not in chunk_files:
+            chunk_files[chunk_file_key] = lapd.File(filename)
+            while len(chunk_files) > max_chunk_files:
+                (pid, *_), old_file = chunk_files.popitem(last=False)
+                if pid == os.getpid():
+                    old_file.close()
+        chunk_files.move_to_end(chunk_file_key)
+        return chunk_files[chunk_file_key]
+
+
+def get_shots_per_block(mach_bcs, channel_layout, frame_selection, memory_budget, max_workers=1):
+    # Each block holds the raw signals of every channel for its shots. With reader processes, the next block is read
+    # while the current one is used, so two blocks are held at once.
+    num_channels = sum(len(probe_bcs) for probe_bcs in mach_bcs)
+    bytes_per_shot = num_channels * frame_selection['num read frames'] * np.dtype(channel_layout['dtype']).itemsize
+    blocks_held = 1 if max_workers == 1 else 2
+    return max(int(memory_budget // (blocks_held * bytes_per_shot)), 1)
+
+
+def read_isat_blocks(lapd_file, mach_bcs, reader, num_shots, shots_per_block, frame_selection=None, first_shot=0):
+    # Yield (start, stop, isat_datas, offset_datas) for consecutive blocks of digitizer rows from first_shot on. With
+    # a reader from isat_reader, the next block is submitted before the current one is yielded, so its processes read
+    # it while the caller assembles the current block.
+    next_block = None
+    for start in range(first_shot, num_shots, shots_per_block):
+        stop = min(start + shots_per_block, num_shots)
+        with stage("read isat block", shots=stop - start) as record:
+            if reader is None:
+                isat_datas, offset_datas = read_isat_frames(lapd_file, mach_bcs, None, frame_selection,
+                                                            index=slice(start, stop))
+            else:
+                if next_block is None:
+                    next_block = submit_isat_frames(reader, mach_bcs, frame_selection, slice(start, stop))
+                isat_datas, offset_datas = collect_isat_frames(next_block)
+                next_block = None
+                if stop < num_shots:
+                    next_block = submit_isat_frames(reader, mach_bcs, frame_selection,
+                                                    slice(stop, min(stop + shots_per_block, num_shots)))
+            record["bytes read"] = isat_datas_bytes(isat_datas) + isat_datas_bytes(offset_datas)
+        yield start, stop, isat_datas, offset_datas
+
+
+def isat_reader(hdf5_path, max_workers=1, keep_file_open=True):
+    r"""
+    Pool of processes that read blocks of shots of digitizer channels concurrently for read_isat_blocks, each from its
+    own handle on the HDF5 file. h5py runs every HDF5 call of a process under one lock, so threads of one process
+    cannot overlap reads, but processes can. Each block is sent back to this process through a pipe, so the pool is
+    only worth its cost for blocks that are read while the previous block is assembled.
+
+    :param hdf5_path: path of HDF5 file
+    :param max_workers: number of reader processes, or None for one per CPU; with 1, channels are read in this process
+    :param keep_file_open: True for each process to keep the file open while the pool exists, or False to open it for
+        each read, so that a file still being written is not locked between reads and its new shots are seen. The
+        processes are then started with "spawn", so they do not inherit the lock of a file open in this process.
+    :return: context manager of the ProcessPoolExecutor to pass to read_isat_blocks, or of None if max_workers is 1
+    """
+
+    if max_workers == 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=open_reader_file,
+                               initargs=(os.fspath(hdf5_path), keep_file_open),
+                               mp_context=None if keep_file_open else multiprocessing.get_context("spawn"))
+
+
+# HDF5 file of a reader process of isat_reader, or None if it is opened for each read
+reader_path = None
+reader_file = None
+
+
+def open_reader_file(hdf5_path, keep_file_open=True):
+    # Runs once in each reader process; a file kept open is closed when the process exits
+    global reader_path, reader_file
+    reader_path = hdf5_path
+    if keep_file_open:
+        reader_file = lapd.File(hdf5_path)
+
 
+def read_channel(board, channel, index, time_slice):
+    # Runs in a reader process
+    if reader_file is not None:
+        return channel_arrays(reader_file.read_data(board, channel, index=index, silent=True, time_slice=time_slice))
+    with lapd.File(reader_path) as lapd_file:
+        return channel_arrays(lapd_file.read_data(board, channel, index=index, silent=True, time_slice=time_slice))
+
+
+def channel_arrays(isat_data):
+    # Plain arrays of bapsflib digitizer data, which are all that is used of it and are quick to send between processes
+    return {"signal": isat_data['signal'], "shotnum": isat_data['shotnum'], "dt": isat_data.dt}
+
+
+def read_isat_datas(lapd_file, mach_bcs, reader=None, index=slice(None), time_slice=slice(None)):
     # mach_bcs should be a list of dictionaries. Each dictionary entry pairs a face number with a board, channel tuple.
     # One dictionary corresponds to one probe, with its associated faces and board, channel tuples.
-    isat_datas = [{face_num: lapd_file.read_data(*probe_bcs[face_num], silent=True) for face_num in probe_bcs}
-                  for probe_bcs in mach_bcs]
-    # print(isat_datas[0][2]['signal'].shape)
+    # With a reader from isat_reader, all channels are submitted before any result is collected so that reads run
+    # concurrently in its processes; otherwise they are read one at a time from lapd_file.
+    if reader is None:
+        return [{face_num: channel_arrays(lapd_file.read_data(*probe_bcs[face_num], index=index, silent=True,
+                                                              time_slice=time_slice))
+                 for face_num in probe_bcs}
+                for probe_bcs in mach_bcs]
+    return collect_isat_datas(submit_isat_datas(reader, mach_bcs, index, time_slice))
 
-    mach_motor_datas = [lapd_file.read_controls([('6K Compumotor', receptacle)]) for receptacle in mach_receptacles]
-    lapd_file.close()
-    ports = np.array([motor_data.info['controls']['6K Compumotor']['probe']['port'] for motor_data in mach_motor_datas])
-    # NOTE: Assume mach motor datas from 6K Compumotor are identical, and only consider first one
-    positions, num_positions, shots_per_position = get_shot_positions(mach_motor_datas[0])
 
-    isat_da = to_mach_isat_da(isat_datas, positions, shots_per_position, ports).rename(run_name)
-    isat_da = to_real_mach_isat_units(isat_da, resistances)
+def submit_isat_datas(reader, mach_bcs, index=slice(None), time_slice=slice(None)):
+    return [{face_num: reader.submit(read_channel, *probe_bcs[face_num], index, time_slice) for face_num in probe_bcs}
+            for probe_bcs in mach_bcs]
 
-    return isat_da
+
+def collect_isat_datas(isat_futures):
+    return [{face_num: probe_futures[face_num].result() for face_num in probe_futures}
+            for probe_futures in isat_futures]
+
+
+def read_isat_frames(lapd_file, mach_bcs, reader=None, frame_selection=None, index=slice(None)):
+    # Isat datas of the selected frames, and of the DC offset frames if they are outside the selection (else None)
+    isat_datas = read_isat_datas(lapd_file, mach_bcs, reader, index, read_frames(frame_selection))
+    offset_datas = None
+    if frame_selection is not None and frame_selection['offset frames'] is not None:
+        offset_datas = read_isat_datas(lapd_file, mach_bcs, reader, index, frame_selection['offset frames'])
+    return isat_datas, offset_datas
+
+
+def submit_isat_frames(reader, mach_bcs, frame_selection=None, index=slice(None)):
+    # Futures of read_isat_frames in the processes of a reader, to be collected with collect_isat_frames
+    isat_futures = submit_isat_datas(reader, mach_bcs, index, read_frames(frame_selection))
+    offset_futures = None
+    if frame_selection is not None and frame_selection['offset frames'] is not None:
+        offset_futures = submit_isat_datas(reader, mach_bcs, index, frame_selection['offset frames'])
+    return isat_futures, offset_futures
+
+
+def collect_isat_frames(frame_futures):
+    isat_futures, offset_futures = frame_futures
+    return collect_isat_datas(isat_futures), None if offset_futures is None else collect_isat_datas(offset_futures)
+
+
+def isat_datas_bytes(isat_datas):
+    if isat_datas is None:
+        return 0
+    return sum(isat_data['signal'].nbytes for probe_datas in isat_datas for isat_data in probe_datas.values())
+
+
+def get_frame_selection(channel_layout, time_window=None, decimation=1, decimation_method="boxcar"):
+    r"""
+    Choose the frames of each shot to read, and how to decimate them.
+
+    :param channel_layout: digitizer channel layout from LapdSession.channel_layout
+    :param time_window: slice of frame indices, (start, end) pair of astropy time Quantities, or None for all frames
+    :param decimation: number of frames averaged into each time step
+    :param decimation_method: "boxcar" or "anti-aliased"
+    :return: dictionary of "read frames" (slice), "num read frames", "offset frames" (slice of last 1000 frames of
+        each shot to read separately for the DC offset, or None if they are in the read frames), "decimation",
+        "decimation method", "filter margin" (number of frames read before the time window for the anti-aliasing
+        filter), "num frames" (number of time steps after decimation), and "frames" (frame index of the centre of each
+        time step)
+    """
+
+    num_frames = channel_layout['num frames']
+    if time_window is None:
+        window = slice(0, num_frames)
+    elif isinstance(time_window, slice):
+        window = slice(*time_window.indices(num_frames)[:2])
+    else:
+        start_frame = int(np.ceil((time_window[0] / channel_layout['dt']).to(u.dimensionless_unscaled).value))
+        end_frame = int(np.floor((time_window[1] / channel_layout['dt']).to(u.dimensionless_unscaled).value))
+        window = slice(max(start_frame, 0), min(end_frame + 1, num_frames))
+    num_read_frames = window.stop - window.start
+
+    if decimation_method not in ("boxcar", "anti-aliased"):
+        raise ValueError("Unknown decimation method " + repr(decimation_method) + "; use 'boxcar' or 'anti-aliased'")
+    if decimation < 1 or num_read_frames // decimation < 1:
+        raise ValueError("Time window of " + str(num_read_frames) + " frames cannot be decimated by " + str(decimation))
+
+    # The anti-aliasing filter spans filter_half_width frames either side of each time step, so the frames of the shot
+    # just outside the window are also read
+    half_width = filter_half_width(decimation) if decimation_method == "anti-aliased" and decimation > 1 else 0
+    read_window = slice(max(window.start - half_width, 0), min(window.stop + half_width, num_frames))
+    offset_start = max(num_frames - 1000, 0)
+    offset_in_window = window.stop == num_frames and window.start <= offset_start
+    frame_starts = window.start + np.arange(num_read_frames // decimation) * decimation
+    return {"read frames": read_window,
+            "num read frames": read_window.stop - read_window.start
+            + (0 if offset_in_window else num_frames - offset_start),
+            "offset frames": None if offset_in_window else slice(offset_start, num_frames),
+            "decimation": decimation,
+            "decimation method": decimation_method,
+            "filter margin": window.start - read_window.start,
+            "num frames": num_read_frames // decimation,
+            "frames": frame_starts + (decimation - 1) / 2 if decimation_method == "boxcar" else frame_starts}
+
+
+def read_frames(frame_selection):
+    return slice(None) if frame_selection is None else frame_selection['read frames']
 
 
-def get_shot_positions(isat_motor_data):
+def offset_signal(offset_datas, probe, face):
+    return offset_datas[probe][face]['signal'] if offset_datas is not None else None
+
+
+def get_shot_index(isat_motor_data):
+    r"""
+    Index from each shot (digitizer row) to its row of the flattened (x, y, shot) cube, found in one pass by hashing
+    rounded shot coordinates. Shots may be in any order, such as interleaved positions, and positions may have
+    different numbers of shots, such as after failed shots; the cube then has as many shots as the position with
+    the most, and is NaN where a position has fewer.
+
+    :param isat_motor_data: motor data with 'xyz' array of shot positions, as from LapdSession.motion
+    :return: dictionary of "x" and "y" positions, "shots per position", "cube rows" (cube row of each shot),
+        "num cube rows", and "contiguous" (True if shots are already in cube order, so signals can be reshaped into
+        the cube instead of scattered)
+    """
 
-    num_shots = len(isat_motor_data['shotnum'])
     shot_positions = np.round(isat_motor_data['xyz'], 1)
+    # z-position is ignored; it is hard to vary by accident, as it is set by the port
+    x_codes, x_pos = pd.factorize(shot_positions[:, 0], sort=True)
+    y_codes, y_pos = pd.factorize(shot_positions[:, 1], sort=True)
+    position_codes = x_codes * len(y_pos) + y_codes
+    shot_codes = pd.Series(position_codes).groupby(position_codes).cumcount().to_numpy()
+
+    shots_per_position = int(shot_codes.max()) + 1
+    cube_rows = position_codes * shots_per_position + shot_codes
+    num_cube_rows = len(x_pos) * len(y_pos) * shots_per_position
+    contiguous = len(cube_rows) == num_cube_rows and bool((cube_rows == np.arange(num_cube_rows)).all())
+    if len(cube_rows) < num_cube_rows:
+        warnings.warn("Mach probe positions have unequal numbers of shots (" + str(len(cube_rows)) + " shots at "
+                      + str(len(x_pos) * len(y_pos)) + " positions); missing shots are NaN")
 
-    z_positions = shot_positions[:, 2]
-    # if np.amin(z_positions) != np.amax(z_positions):
-    #     raise ValueError("Varying z-position when only x and/or y variation expected")
-    # save z-position for later? Shouldn't need to, because hard to accidentally vary port
-    positions = np.unique(shot_positions[:, :2], axis=0)  # list of all unique (x, y) positions
-    num_positions = len(positions)
-    if num_shots % num_positions != 0:
-        raise ValueError("Number of Mach measurements " + str(num_shots) +
-                         " does not evenly divide into " + str(num_positions) + " unique positions")
-    shots_per_position = int(num_shots // num_positions)
+    return {"x": np.asarray(x_pos), "y": np.asarray(y_pos), "shots per position": shots_per_position,
+            "cube rows": cube_rows, "num cube rows": num_cube_rows, "contiguous": contiguous}
 
-    xy_at_positions = shot_positions[:, :2].reshape((num_positions, shots_per_position, 2))  # (x, y) at shots by pos.
-    if not (np.amax(xy_at_positions, axis=1) == np.amin(xy_at_positions, axis=1)).all():
-        raise ValueError("Non-uniform position values when grouping Mach probe data by position")
 
-    return positions, num_positions, shots_per_position
+def get_run_shot_index(session, receptacle):
+    # The shot index is kept in the session's metadata index, so it is built once per run
+    shot_index = session.cached("shot index", str(receptacle), lambda: {
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in get_shot_index(session.motion(receptacle)).items()})
+    return {key: np.array(value) if isinstance(value, list) else value for key, value in shot_index.items()}
 
 
 def to_real_mach_isat_units(isat_da, resistances):
-    for probe in range(len(resistances)):
-        for face in resistances[probe]:
-            resistance = resistances[probe][face]
-            isat_da[probe].loc[{"face": face}] *= resistance
-    return isat_da
+    # Multiplied by a (port, face) array of resistances rather than scaled in place, so isat read lazily by dask is
+    # scaled too, and isat_da is not changed. Faces without a resistance are left in volts.
+    resistance_da = xr.DataArray(np.array([[resistances[probe].get(face, 1.) for face in isat_da.face.values]
+                                           for probe in range(len(resistances))], dtype=isat_da.dtype),
+                                 dims=['port', 'face'],
+                                 coords={'port': isat_da.port.values, 'face': isat_da.face.values})
+    return isat_da * resistance_da
 
 
-def to_mach_isat_da(isat_datas, positions, shots_per_position, ports):
+def to_mach_isat_da(isat_datas, shot_index, ports, resistances=None, dtype=float, frame_selection=None,
+                    offset_datas=None):
     """
 
     :param isat_datas:
-    :param shots_per_position:
-    :param positions:
+    :param shot_index: index of shots in (x, y, shot) cube from get_shot_index
     :param ports:
+    :param resistances: list of {face: resistance} dictionaries, one per probe, to convert to real units while
+        assembling; if None, isat is left in volts and to_real_mach_isat_units can be applied afterwards
+    :param dtype: data type of isat array; use np.float32 to halve its memory
+    :param frame_selection: frames read and decimation from get_frame_selection, or None if all frames were read
+    :param offset_datas: isat datas of the DC offset frames, if frame_selection has them outside the read frames
     :return:
     """
     # [{face_num: isat_data for face_num in probe_bcs} for probe_bcs in mach_bcs]
 
     faces = sorted({face for probe in isat_datas for face in probe})
-    x_pos = np.unique(positions[:, 0])
-    y_pos = np.unique(positions[:, 1])
+    x_pos, y_pos = shot_index['x'], shot_index['y']
     # ports already given
     test_isat = isat_datas[0][list(isat_datas[0].keys())[0]]
-    num_frames = test_isat['signal'].shape[-1]
-    dt = test_isat.dt
-    port_z = np.array([port_to_z(port).to(u.cm).value for port in ports])
+    num_frames = test_isat['signal'].shape[-1] if frame_selection is None else frame_selection['num frames']
+    dt = test_isat['dt']
 
-    # isat_signals = [np.concatenate([isat_data['signal'][np.newaxis, ...] for isat_data in isat_datas], axis=0)]
-    isat_signals_shape = (len(x_pos), len(y_pos), shots_per_position, num_frames)
-    isat_signals = [{face: probe_isat_data['signal'].reshape(isat_signals_shape)
-                     for face, probe_isat_data in probe_data.items()}
-                    for probe_data in isat_datas]
-
-    empty_isat_array = np.full((len(ports), len(faces), *isat_signals_shape), np.nan)
-    isat_da = xr.DataArray(data=empty_isat_array,
-                           dims=['port', 'face', 'x', 'y', 'shot', 'time'],
-                           coords=(('port', ports),
-                                   ('face', faces),
-                                   ('x', x_pos, {"units": str(u.cm)}),
-                                   ('y', y_pos, {"units": str(u.cm)}),
-                                   ('shot', np.arange(shots_per_position) + 1),
-                                   ('time', np.arange(num_frames) * dt.to(u.ms).value, {"units": str(u.ms)}))
-                           ).assign_coords({'z': ('port', port_z)})
-    for probe in range(len(isat_signals)):
-        for face in isat_signals[probe]:
-            isat_da[probe].loc[{"face": face}] = isat_signals[probe][face]
-
-    isat_dc_offset = isat_da[..., -1000:].mean(dim='time')
-    isat_da -= isat_dc_offset
-    return isat_da
+    # Each channel is copied straight into its slice of a single isat array, then offset and scaled in place;
+    # shots out of cube order are scattered to their rows instead
+    cube_rows = None if shot_index['contiguous'] else shot_index['cube rows']
+    isat_array = empty_mach_isat_array((len(ports), len(faces), shot_index['num cube rows'], num_frames), isat_datas,
+                                       faces, dtype, cube_rows)
+    for probe in range(len(isat_datas)):
+        for face in isat_datas[probe]:
+            write_isat_rows(isat_array[probe, faces.index(face)], isat_datas[probe][face]['signal'],
+                            face_resistance(resistances, probe, face), cube_rows,
+                            offset_signal(offset_datas, probe, face), frame_selection)
+
+    isat_array = isat_array.reshape((len(ports), len(faces), len(x_pos), len(y_pos), shot_index['shots per position'],
+                                     num_frames))
+    return wrap_mach_isat_array(isat_array, ports, faces, x_pos, y_pos, dt,
+                                None if frame_selection is None else frame_selection['frames'])
+
+
+def empty_mach_isat_array(shape, probe_faces, faces, dtype=float, cube_rows=None, path=None):
+    # Only (port, face) slices with no channel, and rows (axis 2) of the cube that no shot is scattered to, are filled
+    # with NaN; all others are overwritten by write_isat_rows. With a path, the array is a memory-mapped .npy file.
+    if path is None:
+        isat_array = np.empty(shape, dtype=dtype)
+    else:
+        isat_array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    for probe in range(len(probe_faces)):
+        for face in faces:
+            if face not in probe_faces[probe]:
+                isat_array[probe, faces.index(face)] = np.nan
+    if cube_rows is not None and len(cube_rows) < shape[2]:
+        missing_rows = np.ones(shape[2], dtype=bool)
+        missing_rows[cube_rows] = False
+        isat_array[:, :, missing_rows] = np.nan
+    return isat_array
+
+
+def face_resistance(resistances, probe, face):
+    return resistances[probe][face] if resistances is not None else None
+
+
+def write_isat_signal(isat_slice, isat_signal, resistance=None, offset_signal=None, frame_selection=None):
+    # Remove DC offset (mean of last 1000 frames of each shot) and convert to real units without a temporary array.
+    # If isat_signal is a time window without the last 1000 frames, offset_signal holds them. Signals are decimated
+    # before the offset is removed, which gives the same result as decimation preserves the mean.
+    decimation = 1 if frame_selection is None else frame_selection['decimation']
+    if decimation == 1:
+        isat_slice[...] = isat_signal
+    else:
+        isat_slice[...] = decimate_signal(isat_signal, decimation, frame_selection['decimation method'],
+                                          frame_selection['filter margin'], frame_selection['num frames'])
+    if offset_signal is None:
+        offset_signal = isat_slice[..., -1000:] if decimation == 1 else isat_signal[..., -1000:]
+    isat_slice -= offset_signal.mean(axis=-1, keepdims=True, dtype=float).astype(isat_slice.dtype)
+    if resistance is not None:
+        isat_slice *= resistance
+
+
+def write_isat_rows(isat_rows, isat_signal, resistance=None, cube_rows=None, offset_signal=None,
+                    frame_selection=None, rows_per_block=256):
+    # Shots in cube order (cube_rows is None) are written straight into place. Others are offset and scaled a block
+    # at a time in a small buffer, then scattered to their rows of the cube, so the signal array is not sorted or
+    # copied as a whole.
+    if cube_rows is None:
+        write_isat_signal(isat_rows, isat_signal, resistance, offset_signal, frame_selection)
+        return
+    block = np.empty((min(rows_per_block, len(cube_rows)), isat_rows.shape[-1]), dtype=isat_rows.dtype)
+    for start in range(0, len(cube_rows), rows_per_block):
+        stop = min(start + rows_per_block, len(cube_rows))
+        write_isat_signal(block[:stop - start], isat_signal[start:stop], resistance,
+                          None if offset_signal is None else offset_signal[start:stop], frame_selection)
+        isat_rows[cube_rows[start:stop]] = block[:stop - start]
+
+
+def filter_half_width(decimation):
+    # Number of frames either side of its centre spanned by the anti-aliasing filter
+    return 4 * decimation
+
+
+def decimate_signal(isat_signal, decimation, decimation_method="boxcar", first_frame=0, num_frames=None):
+    # Boxcar averages each block of frames; anti-aliased applies a Hamming-windowed sinc low-pass filter with cutoff at
+    # the new Nyquist frequency, evaluated only at every decimation-th frame. Both have unit gain at zero frequency.
+    # Time steps start at first_frame; the filter uses the frames of isat_signal either side of the time window, and
+    # repeats the first or last frame only past the ends of the shot.
+    if num_frames is None:
+        num_frames = (isat_signal.shape[-1] - first_frame) // decimation
+    if decimation_method == "boxcar":
+        return isat_signal[..., first_frame:first_frame + num_frames * decimation].reshape(
+            (*isat_signal.shape[:-1], num_frames, decimation)).mean(axis=-1, dtype=float)
+    half_width = filter_half_width(decimation)
+    taps = np.sinc(np.arange(-half_width, half_width + 1) / decimation) * np.hamming(2 * half_width + 1)
+    taps /= taps.sum()
+    centres = first_frame + np.arange(num_frames) * decimation
+    decimated_signal = np.zeros((*isat_signal.shape[:-1], num_frames))
+    for tap_ind, tap in enumerate(taps):
+        # Only the frames used by each tap are gathered, so the signal is not copied or padded as a whole
+        decimated_signal += tap * isat_signal[..., np.clip(centres + tap_ind - half_width, 0,
+                                                           isat_signal.shape[-1] - 1)]
+    return decimated_signal
+
+
+def wrap_mach_isat_array(isat_array, ports, faces, x_pos, y_pos, dt, frames=None):
+    # isat_array has dimensions (port, face, x, y, shot, time); frames are the frame indices of its times
+    frames = np.arange(isat_array.shape[-1]) if frames is None else frames
+    port_z = np.array([port_to_z(port).to(u.cm).value for port in ports])
+    return xr.DataArray(data=isat_array,
+                        dims=['port', 'face', 'x', 'y', 'shot', 'time'],
+                        coords=(('port', ports),
+                                ('face', faces),
+                                ('x', x_pos, {"units": str(u.cm)}),
+                                ('y', y_pos, {"units": str(u.cm)}),
+                                ('shot', np.arange(isat_array.shape[-2]) + 1),
+                                ('time', frames * dt.to(u.ms).value, {"units": str(u.ms)}))
+                        ).assign_coords({'z': ('port', port_z)})
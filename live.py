@@ -0,0 +1,334 @@
+r"""
+Follow an LAPD run while it is being written, updating Mach statistics as new shots are added.
+
+Usage: python live.py HDF5_FILE CONFIG_FILE [--poll SECONDS] [--polls N] [--langmuir LANGMUIR_FILE]
+
+CONFIG_FILE is a batch config file (see batch.py). Shot statistics of the run (see shot_statistics.py) are saved to
+output_directory as NAME_live.nc after each update, with velocities if a Langmuir dataset is given. Progress is saved
+to a checkpoint beside the run, NAME_live.npz, so that a restarted follower resumes where it stopped. Options of the
+config's "mach_isat_options" object that LiveMachRun takes (live_read_options) are used; others are ignored.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import warnings
+
+import numpy as np
+import astropy.units as u
+import xarray as xr
+from bapsflib import lapd
+
+from files import make_path, write_netcdf
+from getMachIsat import get_frame_selection, get_shots_per_block, isat_reader, read_isat_blocks
+from profiling import stage
+from shot_statistics import ShotStatistics, add_isat_block, statistics_dataset, statistics_velocities
+
+logger = logging.getLogger(__name__)
+
+
+# Options of the batch config's "mach_isat_options" object that LiveMachRun also takes; others, such as dtype and
+# chunk_positions, only apply to get_mach_isat
+live_read_options = ("memory_budget", "max_workers", "time_window", "decimation", "decimation_method")
+
+
+class LiveMachRun:
+    r"""
+    Shot statistics of isat and Mach numbers of a run that is still being written. Each update reads only the
+    digitizer and motion rows added since the last update, and adds them to the per-position statistics, so the
+    work of an update does not grow with the length of the run. Positions are added as the probe reaches them.
+    After each update, the statistics and the number of shots processed are saved to a checkpoint, which is loaded
+    when a LiveMachRun with the same options is made again. With max_workers other than 1, its reader processes are
+    started once and kept until close is called (or a with block using it ends); they open the HDF5 file only while
+    reading, so its writer is not locked out between updates. They are started with "spawn", which imports the main
+    module again, so a script using them must run under if __name__ == '__main__'.
+    """
+
+    def __init__(self, hdf5_path, mach_bcs, mach_receptacles, resistances, checkpoint_path=None,
+                 memory_budget=2 ** 28, max_workers=1, time_window=None, decimation=1, decimation_method="boxcar",
+                 block_size=2 ** 16):
+        r"""
+        :param hdf5_path: path of HDF5 file
+        :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+        :param mach_receptacles: 6K Compumotor receptacle of each probe
+        :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+        :param checkpoint_path: path of checkpoint file, or None for NAME_live.npz beside NAME.hdf5
+        :param memory_budget: maximum number of bytes of raw digitizer data to hold in memory at once
+        :param max_workers: number of processes used to read digitizer channels concurrently (see isat_reader)
+        :param time_window: (start, end) times to read, as in get_mach_isat, or None to read all times
+        :param decimation: number of frames averaged into each time step
+        :param decimation_method: "boxcar" or "anti-aliased", as in get_mach_isat
+        :param block_size: approximate number of elements of one face processed at a time by the Mach kernel
+        """
+
+        self.hdf5_path = os.path.abspath(hdf5_path)
+        self.checkpoint_path = checkpoint_path if checkpoint_path is not None \
+            else os.path.splitext(self.hdf5_path)[0] + "_live.npz"
+        self.mach_bcs, self.mach_receptacles, self.resistances = mach_bcs, mach_receptacles, resistances
+        self.memory_budget, self.max_workers, self.block_size = memory_budget, max_workers, block_size
+        self.read_options = (time_window, decimation, decimation_method)
+        # Options that change the statistics; a checkpoint made with other options is not used
+        self.options = json.dumps({"hdf5 path": self.hdf5_path,
+                                   "mach bcs": [{str(face): list(bc) for face, bc in probe_bcs.items()}
+                                                for probe_bcs in mach_bcs],
+                                   "receptacles": list(mach_receptacles),
+                                   "resistances": None if resistances is None else
+                                   [{str(face): resistance for face, resistance in probe_resistances.items()}
+                                    for probe_resistances in resistances],
+                                   "time window": time_window, "decimation": decimation,
+                                   "decimation method": decimation_method}, default=str, sort_keys=True)
+        self.faces = sorted({face for probe_bcs in mach_bcs for face in probe_bcs})
+
+        self.num_shots = 0  # Digitizer rows processed
+        self.positions = {}  # Position index of each (x, y), in order of first shot there
+        self.ports = None
+        self.channel_layout = None
+        self.frame_selection = None
+        self.dt = None
+        self.isat_statistics = None
+        self.mach_statistics = {}
+        self.reader = None if max_workers == 1 else isat_reader(self.hdf5_path, max_workers, keep_file_open=False)
+        self.load_checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # Stop the reader processes
+        if self.reader is not None:
+            self.reader.shutdown()
+            self.reader = None
+
+    def ready_shots(self, lapd_file):
+        # Number of shots written to every digitizer channel and motion list
+        digitizer = lapd_file.file_map.main_digitizer
+        config_name = digitizer.active_configs[0]
+        dataset_rows = [lapd_file[digitizer.info['group path'] + "/" + digitizer.construct_dataset_name(
+            board, channel, config_name=config_name)].shape[0]
+                        for probe_bcs in self.mach_bcs for board, channel in probe_bcs.values()]
+        motion_configs = lapd_file.file_map.controls['6K Compumotor'].configs
+        dataset_rows += [lapd_file[motion_configs[receptacle]['dset paths'][0]].shape[0]
+                         for receptacle in self.mach_receptacles]
+        return min(dataset_rows)
+
+    def update(self):
+        r"""
+        Add shots written since the last update to the statistics, and save a checkpoint.
+
+        :return: number of shots added
+        """
+
+        with stage("open HDF5 file", path=self.hdf5_path):
+            lapd_file = lapd.File(self.hdf5_path)
+        with lapd_file:
+            num_shots = self.ready_shots(lapd_file)
+            if num_shots < self.num_shots:
+                raise ValueError("HDF5 file " + repr(self.hdf5_path) + " has " + str(num_shots) + " shots, but "
+                                 + str(self.num_shots) + " were processed; delete checkpoint "
+                                 + repr(self.checkpoint_path) + " to start again")
+            if num_shots == self.num_shots:
+                return 0
+            if self.channel_layout is None:
+                # Read once from the open file; a LapdSession index would be out of date after every poll
+                first_bc = next(iter(self.mach_bcs[0].values()))
+                test_data = lapd_file.read_data(*first_bc, index=slice(0, 1), silent=True)
+                self.channel_layout = {"num frames": int(test_data['signal'].shape[-1]), "dt": test_data.dt.to(u.s),
+                                       "dtype": str(test_data['signal'].dtype)}
+                self.frame_selection = get_frame_selection(self.channel_layout, *self.read_options)
+                self.dt = self.channel_layout['dt']
+            frame_selection = self.frame_selection
+            if self.ports is None:
+                motion_configs = lapd_file.file_map.controls['6K Compumotor'].configs
+                self.ports = np.array([int(motion_configs[receptacle]['probe']['port'])
+                                       for receptacle in self.mach_receptacles])
+                self.isat_statistics = ShotStatistics((len(self.ports), len(self.faces), 0,
+                                                       frame_selection['num frames']), axis=2)
+
+            shots_per_block = get_shots_per_block(self.mach_bcs, self.channel_layout, frame_selection,
+                                                  self.memory_budget, self.max_workers)
+            first_shot = self.num_shots
+            for start, stop, isat_datas, offset_datas in read_isat_blocks(
+                    lapd_file, self.mach_bcs, self.reader, num_shots, shots_per_block, frame_selection, first_shot):
+                with stage("live statistics block", shots=stop - start):
+                    # Motion of only the new shots, by shot number. Shots without a motion entry are left out, so
+                    # every isat row is paired with the motion of its own shot.
+                    shot_numbers = next(iter(isat_datas[0].values()))['shotnum']
+                    motor_data = lapd_file.read_controls([('6K Compumotor', self.mach_receptacles[0])],
+                                                         shotnum=shot_numbers, silent=True)
+                    has_motion = np.isin(shot_numbers, motor_data['shotnum'])
+                    if not has_motion.all():
+                        warnings.warn(str(np.count_nonzero(~has_motion)) + " shots of " + repr(self.hdf5_path)
+                                      + " have no motion entry and are left out")
+                        isat_datas = select_shots(isat_datas, has_motion)
+                        offset_datas = select_shots(offset_datas, has_motion)
+                    motion_rows = np.searchsorted(motor_data['shotnum'], shot_numbers[has_motion])
+                    positions = self.position_indexes(motor_data['xyz'][motion_rows])
+                    for statistics in [self.isat_statistics] + list(self.mach_statistics.values()):
+                        statistics.grow(len(self.positions))
+                    add_isat_block(self.isat_statistics, self.mach_statistics, isat_datas, offset_datas,
+                                   positions, self.mach_bcs, self.resistances, len(self.ports), self.faces,
+                                   frame_selection, block_size=self.block_size)
+                    self.num_shots = stop
+        self.save_checkpoint()
+        return self.num_shots - first_shot
+
+    def position_indexes(self, xyz):
+        # Position index of each shot, adding positions not seen before; positions are rounded as in get_shot_index
+        position_xy = np.round(np.asarray(xyz)[:, :2], 1)
+        for x, y in position_xy:
+            self.positions.setdefault((float(x), float(y)), len(self.positions))
+        return np.array([self.positions[(float(x), float(y))] for x, y in position_xy])
+
+    def statistics(self, electron_temperature_da=None):
+        r"""
+        Shot statistics of the shots processed so far, on the grid of x and y positions reached so far.
+
+        :param electron_temperature_da: electron temperature profile to also find velocities, or None
+        :return: Dataset of shot statistics, as from get_mach_statistics
+        """
+
+        if not self.positions:
+            raise ValueError("No shots of " + repr(self.hdf5_path) + " have been processed")
+        position_xy = np.array(list(self.positions))
+        x_pos, x_codes = np.unique(position_xy[:, 0], return_inverse=True)
+        y_pos, y_codes = np.unique(position_xy[:, 1], return_inverse=True)
+        grid_positions = x_codes * len(y_pos) + y_codes
+
+        def on_grid(statistics):
+            shape = list(statistics.count.shape[1:])
+            shape.insert(statistics.axis, len(x_pos) * len(y_pos))
+            grid_statistics = ShotStatistics(shape, statistics.axis)
+            for name in ("count", "mean", "m2"):
+                getattr(grid_statistics, name)[grid_positions] = getattr(statistics, name)
+            return grid_statistics
+
+        statistics_ds = statistics_dataset(on_grid(self.isat_statistics),
+                                           {key: on_grid(self.mach_statistics[key]) for key in self.mach_statistics},
+                                           self.ports, self.faces, x_pos, y_pos, self.dt,
+                                           self.frame_selection['frames'],
+                                           {"run name": os.path.basename(self.hdf5_path), "shots": self.num_shots})
+        if electron_temperature_da is not None:
+            statistics_ds = statistics_ds.assign(
+                statistics_velocities(statistics_ds, electron_temperature_da).data_vars)
+        return statistics_ds
+
+    def save_checkpoint(self):
+        # Written to a temporary file first, so an interrupted save leaves the last checkpoint intact
+        arrays = {"options": np.array(self.options), "num shots": np.array(self.num_shots),
+                  "position xy": np.array(list(self.positions), dtype=float).reshape(-1, 2),
+                  "ports": self.ports, "dt": np.array(self.dt.to(u.s).value),
+                  "frames": self.frame_selection['frames'], "mach keys": np.array(list(self.mach_statistics))}
+        for key, statistics in [("Mach isat", self.isat_statistics)] + list(self.mach_statistics.items()):
+            for name in ("count", "mean", "m2"):
+                arrays[key + ": " + name] = getattr(statistics, name)
+        with open(self.checkpoint_path + ".tmp", "wb") as checkpoint_file:
+            np.savez(checkpoint_file, **arrays)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def load_checkpoint(self):
+        if not os.path.isfile(self.checkpoint_path):
+            return
+        with np.load(self.checkpoint_path) as checkpoint:
+            if str(checkpoint["options"]) != self.options:
+                warnings.warn("Checkpoint " + repr(self.checkpoint_path) + " was made with other options; "
+                              "the run is processed from the first shot")
+                return
+            self.num_shots = int(checkpoint["num shots"])
+            self.positions = {(float(x), float(y)): index for index, (x, y) in enumerate(checkpoint["position xy"])}
+            self.ports = checkpoint["ports"]
+            self.dt = float(checkpoint["dt"]) * u.s
+            frame_selection = {"frames": checkpoint["frames"]}
+            self.frame_selection = frame_selection
+            statistics = {}
+            for key, axis in [("Mach isat", 2)] + [(str(key), 1) for key in checkpoint["mach keys"]]:
+                count = checkpoint[key + ": count"]
+                statistics[key] = ShotStatistics(np.moveaxis(count, 0, axis).shape, axis)
+                for name in ("count", "mean", "m2"):
+                    setattr(statistics[key], name, checkpoint[key + ": " + name])
+        self.isat_statistics = statistics.pop("Mach isat")
+        self.mach_statistics = statistics
+        logger.info("Resuming %r after %d shots", os.path.basename(self.hdf5_path), self.num_shots)
+
+
+def select_shots(isat_datas, shots):
+    # Isat datas of only the shots selected by a boolean array, or None if isat_datas is None
+    if isat_datas is None:
+        return None
+    return [{face: {**isat_data, "signal": isat_data['signal'][shots], "shotnum": isat_data['shotnum'][shots]}
+             for face, isat_data in probe_datas.items()}
+            for probe_datas in isat_datas]
+
+
+def follow_mach_run(hdf5_path, mach_bcs, mach_receptacles, resistances, electron_temperature_da=None,
+                    poll_seconds=10., max_polls=None, output_path=None, on_update=None, **live_options):
+    r"""
+    Update shot statistics of a run as shots are added to its HDF5 file, until interrupted or max_polls polls.
+
+    :param hdf5_path: path of HDF5 file
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe
+    :param electron_temperature_da: electron temperature profile to also find velocities, or None
+    :param poll_seconds: seconds between checks for new shots
+    :param max_polls: number of checks for new shots, or None to follow until interrupted
+    :param output_path: path of NetCDF file to save statistics to after each update, or None
+    :param on_update: function called with the Dataset of statistics after each update, such as to plot it, or None
+    :param live_options: other keyword arguments of LiveMachRun
+    :return: LiveMachRun, with its reader processes stopped
+    """
+
+    live_run = LiveMachRun(hdf5_path, mach_bcs, mach_receptacles, resistances, **live_options)
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            new_shots = live_run.update()
+            polls += 1
+            if new_shots:
+                statistics_ds = live_run.statistics(electron_temperature_da)
+                logger.info("%d shots (%d new) at %d positions", live_run.num_shots, new_shots,
+                            len(live_run.positions))
+                if output_path is not None:
+                    write_netcdf(statistics_ds, output_path, mode="w")
+                if on_update is not None:
+                    on_update(statistics_ds)
+            if max_polls is None or polls < max_polls:
+                time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        logger.info("Stopped following %r after %d shots", os.path.basename(hdf5_path), live_run.num_shots)
+    finally:
+        live_run.close()
+    return live_run
+
+
+if __name__ == '__main__':
+    from batch import load_batch_config
+    from radial import linear_profile
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Update Mach statistics of an LAPD run as it is written.")
+    parser.add_argument("hdf5_file", help="HDF5 file of run")
+    parser.add_argument("config", help="JSON batch config file")
+    parser.add_argument("--poll", type=float, default=10., help="seconds between checks for new shots")
+    parser.add_argument("--polls", type=int, default=None, help="number of checks (default: until interrupted)")
+    parser.add_argument("--langmuir", default=None, help="Langmuir dataset with T_e, to also find velocities")
+    arguments = parser.parse_args()
+
+    live_config = load_batch_config(arguments.config)
+    live_electron_temperature = None
+    if arguments.langmuir is not None:
+        with xr.open_dataset(arguments.langmuir) as langmuir_dataset:
+            live_electron_temperature = linear_profile(langmuir_dataset['T_e'].load(),
+                                                       *[time_ms * u.ms for time_ms in
+                                                         live_config["steady_state_times_ms"]])
+    os.makedirs(live_config["output_directory"], exist_ok=True)
+    run_name = os.path.splitext(os.path.basename(arguments.hdf5_file))[0]
+    follow_mach_run(arguments.hdf5_file, live_config["mach_face_bcs"], live_config["mach_receptacles"],
+                    live_config["mach_face_resistances"], live_electron_temperature, arguments.poll, arguments.polls,
+                    make_path(live_config["output_directory"], run_name + "_live", "nc"),
+                    **{option: value for option, value in live_config.get("mach_isat_options", {}).items()
+                       if option in live_read_options})
@@ -1,9 +1,17 @@
+import logging
+
 import matplotlib.pyplot as plt
 from experimental import *
 from getMachIsat import *
 from velocity import *
 from radial import *
+from cache import *
+from files import write_netcdf
+from figures import summary_dataset, figure_jobs, render_figures
+from profiling import start_profile, stop_profile
+from session import LapdSession
 
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 # BAPSFLIB parameters
 mach_face_bcs = [{2: (3, 1), 5: (3, 3)},
@@ -20,17 +28,50 @@ steady_state_times = 6 * u.ms, 15 * u.ms  # 2 * u.ms, 5 * u.ms
 # TODO make custom
 hdf5_path = "/Users/leomurphy/lapd-data/March_2022/01_line_valves85V_7400A.hdf5"
 langmuir_nc_path = "/Users/leomurphy/lapd-data/March_2022/lang_nc 2024-01-19/01_line_valves85V_7400A_lang.nc"
-mach_save_filename = "/Users/leomurphy/lapd-data/March_2022/mach_nc/mach_da_01.nc"
-mach_open_filename = mach_save_filename
+mach_cache_directory = "/Users/leomurphy/lapd-data/March_2022/mach_nc/cache/"
 
 # User settings
 """Set the use_existing_lang variable to True to open an existing Langmuir diagnostic dataset,
        or False to create a new one."""
 use_existing_lang = True  # False not yet supported
-"""Set the use_existing_mach variable to True to open an existing Mach dataset, or False to create a new one."""
-use_existing_mach = False
-"""Set the save_mach variable to True to save a Mach dataset if a new one is created."""
-save_mach = True
+"""Mach datasets are cached in mach_cache_directory by stage (raw isat, scaled isat, Mach numbers, velocities), and
+       only stages whose inputs changed are recomputed. Set the mach_cache_max_bytes variable to cap the cache size;
+       least recently used files are deleted first."""
+mach_cache_max_bytes = 20e9
+"""Set the mach_output_options variable to keyword arguments of files.write_netcdf used to save cached stages and
+       spectra, for example {"compression_level": 4, "dtype": "float32"} to save compressed single-precision files."""
+mach_output_options = {}
+"""Set the mach_chunk_positions variable to a number of x positions to read the Mach dataset lazily in chunks of
+       that many positions, or None to read it all at once. The HDF5 file is read once, chunk by chunk, when the raw
+       isat stage is cached, so chunking bounds memory but every frame in mach_time_window is still read; later stages
+       and plots read the cached stages lazily in the same chunks. Chunks are read one at a time under dask's default
+       threaded scheduler; set dask.config.set(scheduler="processes") to read them in parallel."""
+mach_chunk_positions = None
+"""Set the mach_time_window variable to a (start, end) pair of times, such as steady_state_times, to read only those
+       times of each shot, or None to read all times. Set mach_decimation to a number of frames to average into each
+       time step of the Mach dataset (1 to keep the digitizer rate)."""
+mach_time_window = None
+mach_decimation = 1
+"""Set the mach_profile_path variable to a JSON file path to record the time, data read and array sizes of each
+       analysis stage there, or None to not profile. Set mach_profile_memory to True to also record peak memory
+       allocated in each stage, which slows the analysis."""
+mach_profile_path = None
+mach_profile_memory = False
+"""Set the mach_shot_statistics variable to True to keep only the mean, variance and count over shots at each position
+       of isat, Mach numbers and velocities, accumulated while shots are read, instead of every shot."""
+mach_shot_statistics = False
+"""Set the mach_time_resolved_temperature variable to True to find velocities from the Langmuir electron temperature
+       interpolated in position and time onto the Mach probe grid, or False to use its steady-state linear profile."""
+mach_time_resolved_temperature = False
+"""Set the mach_spectra_path variable to a NetCDF file path to save Welch spectra of isat fluctuations of each face and
+       cross-spectra and coherence of pairs of faces there, or None to not find spectra. mach_spectra_options are
+       keyword arguments of spectra.get_isat_spectra, for example {"segment_length": 512, "average_shots": True}."""
+mach_spectra_path = None
+mach_spectra_options = {}
+"""Set the mach_figure_directory variable to a directory to save contour and linear profile figures of every port and
+       variable there as image files, drawn in parallel without a display, or None to show them. Figures whose data
+       have not changed since they were last saved are not drawn again."""
+mach_figure_directory = None
 # End user settings
 
 
@@ -39,47 +80,67 @@ if __name__ == '__main__':
 
     uTorr = u.def_unit("uTorr", 1e-6 * u.Torr)
     lapd_plot_units = (uTorr, u.gauss, u.kA)
-    lapd_parameters = get_exp_params(hdf5_path)
+    if mach_profile_path is not None:
+        start_profile(os.path.basename(hdf5_path), trace_memory=mach_profile_memory)
+    # The HDF5 file is opened at most once; its metadata is read from an index beside it after the first analysis
+    lapd_session = LapdSession(hdf5_path)
+    lapd_parameters = get_exp_params(lapd_session)
 
     diagnostic_dataset = xr.open_dataset(langmuir_nc_path)
-    # Make position-linear electron temperature dataset from LAPD diagnostic dataset
-    linear_electron_temperature = linear_profile(diagnostic_dataset['T_e'], *steady_state_times)
-
-    # (Clean up)
-    # Check if mach dataset file exists
-    generate_mach = not use_existing_mach
-    if use_existing_mach:
-        try:
-            mach_test = xr.open_dataset(mach_open_filename)
-        except FileNotFoundError:
-            print("** Mach data .nc file not found. Calculating Mach dataset...")
-            generate_mach = True
+    if mach_time_resolved_temperature:
+        electron_temperature = diagnostic_dataset['T_e']
+    else:
+        # Make position-linear electron temperature dataset from LAPD diagnostic dataset
+        electron_temperature = linear_profile(diagnostic_dataset['T_e'], *steady_state_times)
 
-    # Generate a new mach and/or isat dataset file if needed
-    if not generate_mach:
-        print("Opening Mach data file...")
-        mach_ds = xr.open_dataset(mach_open_filename)
+    # Open cached Mach dataset stages, calculating any that are missing or out of date
+    mach_cache = StageCache(mach_cache_directory, max_bytes=mach_cache_max_bytes, output_options=mach_output_options)
+    if mach_shot_statistics:
+        mach_ds = get_cached_mach_statistics(mach_cache, lapd_session, mach_face_bcs, mach_receptacles,
+                                             mach_face_resistances, electron_temperature,
+                                             time_window=mach_time_window, decimation=mach_decimation
+                                             ).assign_attrs(lapd_parameters)
     else:
-        mach_isat = get_mach_isat(hdf5_path, mach_face_bcs, mach_receptacles, mach_face_resistances)
-        mach_ds = get_velocity_profiles(mach_isat, linear_electron_temperature).assign_attrs(lapd_parameters)
-        if save_mach:
-            mach_ds.to_netcdf(mach_save_filename)
+        mach_ds = get_cached_mach_dataset(mach_cache, lapd_session, mach_face_bcs, mach_receptacles,
+                                          mach_face_resistances, electron_temperature,
+                                          chunk_positions=mach_chunk_positions, time_window=mach_time_window,
+                                          decimation=mach_decimation).assign_attrs(lapd_parameters)
+    if mach_spectra_path is not None:
+        isat_spectra = get_cached_isat_spectra(mach_cache, lapd_session, mach_face_bcs, mach_receptacles,
+                                               mach_face_resistances, mach_spectra_options,
+                                               chunk_positions=mach_chunk_positions, time_window=mach_time_window,
+                                               decimation=mach_decimation)
+        write_netcdf(isat_spectra.assign_attrs(
+            {parameter: str(value) for parameter, value in lapd_parameters.items()}), mach_spectra_path, mode="w",
+                     **mach_output_options)
+    lapd_session.close()
+    mach_cache.report()
+    if mach_profile_path is not None:
+        stop_profile(mach_profile_path)
 
     # mach_isat[0].mean(dim='shot', keep_attrs=True).squeeze().plot.contourf()
     # plt.show()
 
     print("Experimental parameters at LAPD:", {parameter: str(value) for parameter, value in lapd_parameters.items()})
-    plt.rcParams['figure.dpi'] = 180
-    for probe in range(len(mach_ds.port)):
-        for variable in mach_ds.isel(port=probe):
-            mach_ds.isel(port=probe)[variable].mean(dim='shot', keep_attrs=True).squeeze().plot.contourf(robust=True)
-            title = f"{variable} (Port {mach_ds.port[probe].item()})"
-            plt.title(title)
-            plt.show()
-            linear_profile(mach_ds.isel(port=probe)[variable].mean(dim='shot', keep_attrs=True),
-                           *steady_state_times).squeeze().plot(x='x')
-            plt.title(title)
-            plt.show()
+    # Shots are averaged and steady-state profiles found once per variable for all ports
+    mach_summary = summary_dataset(mach_ds, *steady_state_times)
+    if mach_figure_directory is not None:
+        render_figures(figure_jobs(mach_summary, mach_figure_directory,
+                                   os.path.splitext(os.path.basename(hdf5_path))[0]))
+    else:
+        plt.rcParams['figure.dpi'] = 180
+        for probe in range(len(mach_ds.port)):
+            for variable in mach_variable_order:
+                if variable not in mach_summary:
+                    continue
+                mach_summary[variable].isel(port=probe).squeeze().plot.contourf(robust=True)
+                title = f"{variable} (Port {mach_ds.port[probe].item()})"
+                plt.title(title)
+                plt.show()
+                if variable + " profile" in mach_summary:
+                    mach_summary[variable + " profile"].isel(port=probe).rename(variable).squeeze().plot(x='x')
+                    plt.title(title)
+                    plt.show()
 
     # plt.title(str([parameter + " = " + str(value) for parameter, value in lapd_parameters.items()]), size='medium')
     # Can use numpy to round experimental parameters and add to all plots now that in correct units?
@@ -0,0 +1,128 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Profile of the current run, or None while profiling is off (the default)
+current_profile = None
+profile_lock = threading.Lock()
+stage_stacks = threading.local()
+
+
+def start_profile(run_name, trace_memory=False):
+    r"""
+    Start recording every pipeline stage until stop_profile is called.
+
+    :param run_name: name stored in the profile
+    :param trace_memory: True to also record peak memory allocated in each stage with tracemalloc, which slows
+        allocation-heavy stages; peaks include allocations by other threads running at the same time
+    """
+
+    global current_profile
+    start_tracing = trace_memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    current_profile = {"run": run_name,
+                       "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "trace memory": trace_memory,
+                       "start time": time.perf_counter(),
+                       "stop tracing": start_tracing,
+                       "stages": []}
+
+
+def stop_profile(path=None):
+    r"""
+    Stop recording stages, and return the profile with a per-stage summary.
+
+    :param path: path of JSON file to write the profile to, or None to not write it
+    :return: dictionary of run name, total seconds, stage records in order of completion, and summary by stage name
+    """
+
+    global current_profile
+    profile, current_profile = current_profile, None
+    if profile is None:
+        raise ValueError("No profile was started")
+    if profile.pop("stop tracing"):
+        tracemalloc.stop()
+    profile["total seconds"] = time.perf_counter() - profile.pop("start time")
+
+    summary = {}
+    for record in profile["stages"]:
+        stage_summary = summary.setdefault(record["stage"], {"calls": 0, "seconds": 0.})
+        stage_summary["calls"] += 1
+        stage_summary["seconds"] += record["seconds"]
+        for key in ("bytes read", "peak bytes"):
+            if key in record:
+                combine = sum if key == "bytes read" else max
+                stage_summary[key] = combine((stage_summary.get(key, 0), record[key]))
+    profile["summary"] = summary
+
+    if path is not None:
+        with open(path, "w") as profile_file:
+            json.dump(profile, profile_file, indent=1, default=str)
+    return profile
+
+
+@contextmanager
+def stage(name, **details):
+    r"""
+    Time a pipeline stage if profiling is on. Yields a dictionary to which the stage can add details, such as
+    "bytes read" or array sizes from array_details; it is discarded when profiling is off.
+
+    :param name: name of stage
+    :param details: details known before the stage starts
+    """
+
+    if current_profile is None:
+        yield details
+        return
+
+    profile = current_profile
+    stack = stage_stacks.__dict__.setdefault("stack", [])
+    record = {"stage": name, "parent": stack[-1]["stage"] if stack else None, **details}
+    if profile["trace memory"]:
+        # tracemalloc keeps a single peak, so a parent's peak so far is carried past the reset for each child stage
+        if stack:
+            stack[-1]["carried peak"] = max(stack[-1].get("carried peak", 0), tracemalloc.get_traced_memory()[1])
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    stack.append(record)
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start_time
+        record["start"] = start_time - profile["start time"]
+        stack.pop()
+        if profile["trace memory"]:
+            peak_memory = max(record.pop("carried peak", 0), tracemalloc.get_traced_memory()[1])
+            record["peak bytes"] = peak_memory - start_memory
+            if stack:
+                stack[-1]["carried peak"] = max(stack[-1].get("carried peak", 0), peak_memory)
+        with profile_lock:
+            profile["stages"].append(record)
+
+
+def profiled(name):
+    # Decorator recording each call of a function as a stage
+    def decorator(function):
+        @functools.wraps(function)
+        def profiled_function(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return profiled_function
+    return decorator
+
+
+def array_details(array, prefix=""):
+    # Shape, data type and size of an array (numpy, dask or xarray) or Dataset for a stage record
+    if hasattr(array, "data_vars"):
+        return {prefix + "sizes": dict(array.sizes),
+                prefix + "variables": len(array.data_vars),
+                prefix + "bytes": int(array.nbytes)}
+    return {prefix + "shape": list(array.shape),
+            prefix + "dtype": str(array.dtype),
+            prefix + "bytes": int(array.nbytes)}
@@ -1,22 +1,219 @@
+from collections import OrderedDict
+
 import numpy as np
+import xarray as xr
 import astropy.units as u
 
+from profiling import stage, array_details
+
+
+# Profile indexes by grid and binning, shared by all variables and runs with the same grid, most recently used last;
+# only the last few are kept, as a long-running follower adds a grid each time positions are added
+profile_indexes = OrderedDict()
+max_profile_indexes = 4
+
+
+def radial_profile(diagnostic, steady_state_start=None, steady_state_end=None, bin_edges=None, center=(0., 0.),
+                   block_size=2 ** 22):
+    r"""
+    Average a diagnostic, or every variable of a dataset, over positions in bins of radius r = sqrt(x² + y²).
+
+    :param diagnostic: DataArray or Dataset with x and y dimensions
+    :param steady_state_start: start time of steady state to average over, or None to keep the time dimension
+    :param steady_state_end: end time of steady state
+    :param bin_edges: edges of radius bins in units of x and y, or None for bins one grid step wide starting at 0
+    :param center: (x, y) of r = 0 in units of x and y
+    :param block_size: approximate number of elements reduced at a time
+    :return: DataArray or Dataset with an r dimension instead of x and y; bins without positions are NaN
+    """
+
+    x, y = diagnostic.coords['x'].values, diagnostic.coords['y'].values
+    profile_index = get_profile_index(x, y, bin_edges, center=center)
+    # Steady state times are selected before binning, and averaged over after it
+    profile = binned_profile(steady_state_times(diagnostic, steady_state_start, steady_state_end), profile_index,
+                             block_size)
+    return profile if steady_state_start is None else profile.mean(dim='time', keep_attrs=True)
+
 
-def radial_profile(diagnostic, steady_state_start, steady_state_end):
+def line_profile(diagnostic, line_start, line_end, width=None, steady_state_start=None, steady_state_end=None,
+                 bin_edges=None, block_size=2 ** 22):
+    r"""
+    Average a diagnostic, or every variable of a dataset, over positions in bins of distance along a line cut.
 
-    # Develop radial profile; can use in ex. neutrals.py where needed
-    linear_diagnostic_profile = linear_profile(diagnostic, steady_state_start, steady_state_end)
-    pass
+    :param diagnostic: DataArray or Dataset with x and y dimensions
+    :param line_start: (x, y) of start of line cut in units of x and y
+    :param line_end: (x, y) of end of line cut
+    :param width: width of line cut, or None for one grid step; positions further than width / 2 are left out
+    :param steady_state_start: start time of steady state to average over, or None to keep the time dimension
+    :param steady_state_end: end time of steady state
+    :param bin_edges: edges of distance bins, or None for bins one grid step wide from the start to the end of the line
+    :param block_size: approximate number of elements reduced at a time
+    :return: DataArray or Dataset with a distance dimension instead of x and y; bins without positions are NaN
+    """
+
+    x, y = diagnostic.coords['x'].values, diagnostic.coords['y'].values
+    profile_index = get_profile_index(x, y, bin_edges, line=(tuple(line_start), tuple(line_end)), width=width)
+    # Steady state times are selected before binning, and averaged over after it
+    profile = binned_profile(steady_state_times(diagnostic, steady_state_start, steady_state_end), profile_index,
+                             block_size)
+    return profile if steady_state_start is None else profile.mean(dim='time', keep_attrs=True)
+
+
+def get_profile_index(x, y, bin_edges=None, center=(0., 0.), line=None, width=None):
+    r"""
+    Bin of each (x, y) grid position, by radius from a center or by distance along a line cut. Indexes are computed
+    once per grid and binning and then reused.
+
+    :param x: x coordinates of grid
+    :param y: y coordinates of grid
+    :param bin_edges: edges of bins, or None for bins one grid step wide
+    :param center: (x, y) of r = 0, for radial bins
+    :param line: ((x, y) of start, (x, y) of end) of line cut, or None for radial bins
+    :param width: width of line cut, or None for one grid step
+    :return: dictionary of "dimension" name, bin "centers" and "edges", "positions" in each bin, and "order" and
+        "starts" of flattened grid positions sorted by bin
+    """
+
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    bin_edges = None if bin_edges is None else np.asarray(bin_edges, dtype=float)
+    key = (x.tobytes(), y.tobytes(), None if bin_edges is None else bin_edges.tobytes(), tuple(center), line, width)
+    if key in profile_indexes:
+        profile_indexes.move_to_end(key)
+        return profile_indexes[key]
+
+    step = grid_step(x, y)
+    grid_x, grid_y = (coordinate.ravel() for coordinate in np.meshgrid(x, y, indexing='ij'))  # Same order as (x, y)
+    if line is None:
+        dimension = "r"
+        distance = np.hypot(grid_x - center[0], grid_y - center[1])
+        in_profile = np.ones(distance.shape, dtype=bool)
+        length = distance.max()
+    else:
+        dimension = "distance"
+        (start_x, start_y), (end_x, end_y) = line
+        length = np.hypot(end_x - start_x, end_y - start_y)
+        if length == 0:
+            raise ValueError("Line cut starts and ends at the same point")
+        direction_x, direction_y = (end_x - start_x) / length, (end_y - start_y) / length
+        distance = (grid_x - start_x) * direction_x + (grid_y - start_y) * direction_y
+        offset = np.abs((grid_y - start_y) * direction_x - (grid_x - start_x) * direction_y)
+        width = step if width is None else width
+        in_profile = (offset <= width / 2 + 1e-9 * step) & (distance >= -step / 2) & (distance <= length + step / 2)
+    if bin_edges is None:
+        # Bins centered on multiples of the grid step, so grid positions along x or y fall in the middle of bins
+        bin_edges = (np.arange(np.floor(length / step + 0.5) + 2) - 0.5) * step
+
+    bins = np.searchsorted(bin_edges, distance, side='right') - 1
+    in_profile &= (bins >= 0) & (bins < len(bin_edges) - 1)
+    order = np.flatnonzero(in_profile)
+    order = order[np.argsort(bins[order], kind="stable")]
+    filled_bins, starts = np.unique(bins[order], return_index=True)
+    profile_index = {"dimension": dimension,
+                     "centers": (bin_edges[:-1] + bin_edges[1:]) / 2,
+                     "edges": bin_edges,
+                     "positions": np.bincount(bins[order], minlength=len(bin_edges) - 1),
+                     "filled bins": filled_bins,
+                     "order": order,
+                     "starts": starts}
+    profile_indexes[key] = profile_index
+    while len(profile_indexes) > max_profile_indexes:
+        profile_indexes.popitem(last=False)
+    return profile_index
+
+
+def grid_step(x, y):
+    # Smallest spacing of grid positions, in units of x and y
+    steps = np.concatenate([np.diff(np.unique(x)), np.diff(np.unique(y))])
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        raise ValueError("Diagnostic data has no spatial dimension. Spatial data needed for profiles.")
+    return steps.min()
+
+
+def binned_profile(diagnostic, profile_index, block_size=2 ** 22):
+    r"""
+    Average each variable over the grid positions in each bin of a profile index, ignoring NaN values. Variables
+    with the same dimensions are reduced together, one block at a time.
+
+    :param diagnostic: DataArray or Dataset with x and y dimensions
+    :param profile_index: profile index from get_profile_index
+    :param block_size: approximate number of elements reduced at a time
+    :return: DataArray or Dataset with the profile dimension in place of x and y; variables without both x and y
+        dimensions are unchanged
+    """
+
+    if not hasattr(diagnostic, "data_vars"):
+        return binned_profile(diagnostic.to_dataset(name="diagnostic"), profile_index, block_size
+                              )["diagnostic"].rename(diagnostic.name)
+
+    with stage("binned_profile", **array_details(diagnostic)):
+        dimension, order, starts = profile_index["dimension"], profile_index["order"], profile_index["starts"]
+        filled_bins, num_bins = profile_index["filled bins"], len(profile_index["centers"])
+        groups = {}
+        profiles = {}
+        for name, variable in diagnostic.data_vars.items():
+            if {'x', 'y'} <= set(variable.dims):
+                # y is moved next to x, which leaves Mach datasets (port, x, y, shot, time) as they are
+                dims = [dim for dim in variable.dims if dim != 'y']
+                dims.insert(dims.index('x') + 1, 'y')
+                groups.setdefault(tuple(dims), []).append(name)
+            else:
+                profiles[name] = variable.drop_vars([coord for coord in variable.coords if coord in ('x', 'y')])
+
+        for dims, names in groups.items():
+            template = diagnostic[names[0]].transpose(*dims)
+            pre_dims, post_dims = dims[:dims.index('x')], dims[dims.index('y') + 1:]
+            pre_shape, post_shape = template.shape[:len(pre_dims)], template.shape[len(pre_dims) + 2:]
+            num_pre, num_post = int(np.prod(pre_shape, dtype=int)), int(np.prod(post_shape, dtype=int))
+            # Each variable as (pre, position, post), so positions are gathered without moving other dimensions
+            variables = [diagnostic[name].transpose(*dims).values.reshape(num_pre, -1, num_post) for name in names]
+            elements_per_post = max(len(order) * len(names), 1)
+            post_per_block = max(min(num_post, block_size // elements_per_post), 1)
+            pre_per_block = max(block_size // (elements_per_post * post_per_block), 1) \
+                if post_per_block == num_post else 1
+
+            profile_arrays = np.full((len(names), num_pre, num_bins, num_post), np.nan)
+            for pre_start in range(0, num_pre, pre_per_block):
+                pre_block = slice(pre_start, min(pre_start + pre_per_block, num_pre))
+                for post_start in range(0, num_post, post_per_block):
+                    post_block = slice(post_start, min(post_start + post_per_block, num_post))
+                    # One segment sum over positions sorted by bin reduces all variables of the block together
+                    block = np.stack([variable[pre_block, order, post_block] for variable in variables])
+                    is_value = ~np.isnan(block)
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        profile_arrays[:, pre_block, filled_bins, post_block] = (
+                                np.add.reduceat(np.where(is_value, block, 0.), starts, axis=2)
+                                / np.add.reduceat(is_value, starts, axis=2))
+
+            coords = {name: coord for name, coord in template.coords.items() if not {'x', 'y'} & set(coord.dims)}
+            coords[dimension] = (dimension, profile_index["centers"], template.coords['x'].attrs)
+            coords["positions"] = (dimension, profile_index["positions"])
+            for name, profile_array in zip(names, profile_arrays):
+                profiles[name] = xr.DataArray(profile_array.reshape(pre_shape + (num_bins,) + post_shape),
+                                              dims=pre_dims + (dimension,) + post_dims, coords=coords,
+                                              attrs=diagnostic[name].attrs)
+        return xr.Dataset({name: profiles[name] for name in diagnostic.data_vars}, attrs=diagnostic.attrs)
+
+
+def steady_state_times(diagnostic, steady_state_start=None, steady_state_end=None):
+    # Diagnostic at times from steady_state_start to steady_state_end, or diagnostic itself if no times are given
+    if steady_state_start is None:
+        return diagnostic
+    time = diagnostic.coords['time'] * (1. * u.Unit(diagnostic.coords['time'].attrs['units'])).to(u.s).value
+    in_steady_state = np.logical_and(time >= steady_state_start.to(u.s).value, time <= steady_state_end.to(u.s).value)
+    return diagnostic.isel(time=in_steady_state.values)
 
 
 def linear_profile(diagnostic, steady_state_start, steady_state_end):
 
     if validate_dimensions(diagnostic.sizes):
-        time = diagnostic.coords['time'] * (1. * u.Unit(diagnostic.coords['time'].attrs['units'])).to(u.s).value
-        diagnostic = diagnostic.squeeze().where(
-            np.logical_and(time >= steady_state_start.to(u.s).value, time <= steady_state_end.to(u.s).value), drop=True
-        )
-        diagnostic = diagnostic.mean(dim='time', keep_attrs=True)
+        with stage("linear_profile", **array_details(diagnostic)):
+            time = diagnostic.coords['time'] * (1. * u.Unit(diagnostic.coords['time'].attrs['units'])).to(u.s).value
+            diagnostic = diagnostic.squeeze().where(
+                np.logical_and(time >= steady_state_start.to(u.s).value, time <= steady_state_end.to(u.s).value),
+                drop=True
+            )
+            diagnostic = diagnostic.mean(dim='time', keep_attrs=True)
         return diagnostic
 
 
@@ -25,7 +222,7 @@ def validate_dimensions(da_sizes):
     if da_sizes['x'] == da_sizes['y'] == 1:
         raise ValueError("Diagnostic data has no spatial dimension. One-dimensional data needed for linear profiles.")
     elif da_sizes['x'] > 1 and da_sizes['y'] > 1:
-        print("Linear profiles not defined for two-dimensional (areal) data.")
+        print("Linear profiles not defined for two-dimensional (areal) data; use radial_profile or line_profile.")
         return False
     else:
         return True
@@ -0,0 +1,160 @@
+import json
+import os
+import warnings
+
+import numpy as np
+import astropy.units as u
+from bapsflib import lapd
+
+from profiling import stage
+
+
+class LapdSession:
+    r"""
+    An LAPD HDF5 file opened at most once and shared by get_exp_params and get_mach_isat, which both also accept
+    a path. Run information, MSI summaries, digitizer channel layout and motion lists are saved to a small JSON
+    index beside the file, so repeat analyses of the run read them from the index instead of the HDF5 file, and do
+    not open the HDF5 file at all unless digitizer signals are needed. The index is ignored once the HDF5 file
+    changes. A session can be used wherever a file path is expected.
+    """
+
+    def __init__(self, hdf5_path, index_path=None):
+        r"""
+        :param hdf5_path: path of LAPD HDF5 file
+        :param index_path: path of JSON index file, or None for NAME_index.json beside NAME.hdf5
+        """
+
+        self.hdf5_path = os.path.abspath(hdf5_path)
+        self.index_path = index_path if index_path is not None else os.path.splitext(self.hdf5_path)[0] + "_index.json"
+        self.opened_file = None
+        self.index_changed = False
+        identity = file_identity(self.hdf5_path)
+        try:
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+        if self.index.get("file identity") != identity:
+            self.index = {"file identity": identity}
+
+    def __fspath__(self):
+        return self.hdf5_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def lapd_file(self):
+        # Opened on first use; bapsflib maps the whole file when opening it
+        if self.opened_file is None:
+            with stage("open HDF5 file", path=self.hdf5_path):
+                self.opened_file = lapd.File(self.hdf5_path)
+        return self.opened_file
+
+    def cached(self, section, key, compute):
+        r"""
+        Get an entry of the metadata index, computing and adding it if it is missing.
+
+        :param section: name of section of index, for example "motion"
+        :param key: string key of entry in section
+        :param compute: function of no arguments returning the entry; it must be JSON serializable
+        :return: entry
+        """
+
+        index_section = self.index.setdefault(section, {})
+        if key not in index_section:
+            index_section[key] = compute()
+            self.index_changed = True
+        return index_section[key]
+
+    @property
+    def info(self):
+        # Run information of bapsflib, such as 'run name' and 'run description', with values as strings
+        return self.cached("info", "run", lambda: {key: str(value) for key, value in self.lapd_file.info.items()})
+
+    def msi_summary(self, diagnostic, field):
+        r"""
+        Summary statistics of one MSI field over all shots, reading only that field of its summary dataset.
+
+        :param diagnostic: MSI diagnostic name, for example "Discharge"
+        :param field: bapsflib name of field, for example "peak current"
+        :return: dictionary of "mean", "std", "min" and "max"
+        """
+
+        def read_msi_summary():
+            field_map = self.lapd_file.file_map.msi[diagnostic].configs['meta'][field]
+            values = np.concatenate([np.ravel(self.lapd_file[dset_path][dset_field])
+                                     for dset_path, dset_field in zip(field_map['dset paths'],
+                                                                      field_map['dset field'])])
+            return {"mean": float(np.mean(values)), "std": float(np.std(values)),
+                    "min": float(np.min(values)), "max": float(np.max(values))}
+
+        return self.cached("msi", diagnostic + "/" + field, read_msi_summary)
+
+    def channel_layout(self, board, channel):
+        r"""
+        Number of time frames, time step and data type of a digitizer channel.
+
+        :param board: digitizer board
+        :param channel: digitizer channel
+        :return: dictionary of "num frames", "dt" (an astropy Quantity) and "dtype"
+        """
+
+        def read_channel_layout():
+            test_data = self.lapd_file.read_data(board, channel, index=slice(0, 1), silent=True)
+            return {"num frames": int(test_data['signal'].shape[-1]),
+                    "dt": test_data.dt.to(u.s).value,
+                    "dtype": str(test_data['signal'].dtype)}
+
+        channel_layout = self.cached("channels", str(board) + ":" + str(channel), read_channel_layout)
+        return {**channel_layout, "dt": channel_layout["dt"] * u.s}
+
+    def motion(self, receptacle):
+        r"""
+        Motion of the probe in a 6K Compumotor receptacle.
+
+        :param receptacle: 6K Compumotor receptacle
+        :return: dictionary of "shotnum" and "xyz" arrays, as in bapsflib motor data, and "port"
+        """
+
+        def read_motion():
+            motor_data = self.lapd_file.read_controls([('6K Compumotor', receptacle)], silent=True)
+            return {"port": int(motor_data.info['controls']['6K Compumotor']['probe']['port']),
+                    "shotnum": motor_data['shotnum'].tolist(),
+                    "xyz": motor_data['xyz'].tolist()}
+
+        motion = self.cached("motion", str(receptacle), read_motion)
+        return {"port": motion["port"], "shotnum": np.array(motion["shotnum"]), "xyz": np.array(motion["xyz"])}
+
+    def save_index(self):
+        # The index is only a shortcut, so a directory that cannot be written to only gives a warning
+        if not self.index_changed:
+            return
+        try:
+            with open(self.index_path, "w") as index_file:
+                json.dump(self.index, index_file)
+            self.index_changed = False
+        except OSError as error:
+            warnings.warn("Could not save metadata index " + repr(self.index_path) + ": " + str(error))
+
+    def close(self):
+        self.save_index()
+        if self.opened_file is not None:
+            self.opened_file.close()
+            self.opened_file = None
+
+
+def as_session(hdf5_path):
+    # Functions taking a file path also take an open session; returns the session and whether to close it afterwards
+    if isinstance(hdf5_path, LapdSession):
+        return hdf5_path, False
+    return LapdSession(hdf5_path), True
+
+
+def file_identity(path):
+    # A changed size or modification time of the HDF5 file invalidates its metadata index and cached stages
+    file_stat = os.stat(path)
+    return [os.path.abspath(path), file_stat.st_size, file_stat.st_mtime_ns]
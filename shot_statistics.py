@@ -0,0 +1,279 @@
+import logging
+
+import numpy as np
+import xarray as xr
+import astropy.units as u
+
+from getMachIsat import (get_frame_selection, get_run_shot_index, get_shots_per_block, isat_reader, read_isat_blocks,
+                         empty_mach_isat_array, write_isat_rows, face_resistance, offset_signal, wrap_mach_isat_array)
+from profiling import stage, profiled
+from session import as_session
+from velocity import (mach_velocity_kernel, mach_variable_order, get_sound_speed, interpolated_sound_speed,
+                      magnetization_factor, alpha_fore, alpha_aft)
+
+logger = logging.getLogger(__name__)
+
+
+class ShotStatistics:
+    r"""
+    Running count, mean and variance over shots at each position, updated one block of shots at a time with
+    Welford's algorithm (block statistics merged as in Chan et al.), so that shots need not be kept in memory.
+    NaN values are left out, so each element has its own count of shots.
+    """
+
+    def __init__(self, shape, axis):
+        r"""
+        :param shape: shape of statistics arrays, with one index per position along the position axis
+        :param axis: position axis of statistics arrays, which is the shot axis of blocks passed to add
+        """
+
+        self.axis = axis
+        shape = (shape[axis],) + tuple(shape[:axis]) + tuple(shape[axis + 1:])
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)  # Sum of squared deviations from the mean
+
+    def add(self, values, positions):
+        r"""
+        Add a block of shots.
+
+        :param values: array of shots, with shots along the position axis and other dimensions as statistics arrays
+        :param positions: position index of each shot in values
+        """
+
+        # Shots of each position are made consecutive, so block sums are one reduction per position
+        order = np.argsort(positions, kind="stable")
+        block_positions, starts, shots = np.unique(positions[order], return_index=True, return_counts=True)
+        values = np.moveaxis(values, self.axis, 0)[order]
+        is_value = ~np.isnan(values)
+        block_count = np.add.reduceat(is_value, starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block_mean = np.add.reduceat(np.where(is_value, values, 0), starts, axis=0) / block_count
+            deviations = np.where(is_value, values - np.repeat(block_mean, shots, axis=0), 0)
+            block_m2 = np.add.reduceat(deviations ** 2, starts, axis=0)
+
+            count = self.count[block_positions]
+            total_count = count + block_count
+            delta = np.where(block_count > 0, block_mean - self.mean[block_positions], 0)
+            self.mean[block_positions] += np.where(total_count > 0, delta * block_count / total_count, 0)
+            self.m2[block_positions] += block_m2 + np.where(
+                total_count > 0, delta ** 2 * count * block_count / total_count, 0)
+        self.count[block_positions] = total_count
+
+    def grow(self, num_positions):
+        # Add positions without shots, up to num_positions positions
+        for name in ("count", "mean", "m2"):
+            array = getattr(self, name)
+            extra = np.zeros((num_positions - len(array),) + array.shape[1:], dtype=array.dtype)
+            setattr(self, name, np.concatenate([array, extra]))
+
+    def get_count(self):
+        return np.moveaxis(self.count, 0, self.axis)
+
+    def get_mean(self):
+        # NaN where a position has no shots
+        return np.moveaxis(np.where(self.count > 0, self.mean, np.nan), 0, self.axis)
+
+    def get_variance(self, ddof=1):
+        # Sample variance over shots by default; NaN where a position has ddof shots or fewer
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+        return np.moveaxis(variance, 0, self.axis)
+
+
+@profiled("get_mach_statistics")
+def get_mach_statistics(filename, mach_bcs, mach_receptacles, resistances, electron_temperature_da=None,
+                        memory_budget=2 ** 28, max_workers=1, keep_shots=False, dtype=float, time_window=None,
+                        decimation=1, decimation_method="boxcar", block_size=2 ** 16):
+    r"""
+    Read Mach probe isat signals block by block of shots, and accumulate the mean, variance and count over shots at
+    each position of isat and of Mach numbers found from each shot, instead of keeping every shot in memory.
+
+    :param filename: path of HDF5 file, or LapdSession
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+    :param electron_temperature_da: electron temperature profile to also find velocities, or None
+    :param memory_budget: maximum number of bytes of raw digitizer data to hold in memory at once
+    :param max_workers: number of processes used to read digitizer channels concurrently (see isat_reader)
+    :param keep_shots: True to also return the isat of every shot, as from get_mach_isat
+    :param dtype: data type of isat of each block of shots
+    :param time_window: (start, end) times to read, as in get_mach_isat, or None to read all times
+    :param decimation: number of frames averaged into each time step
+    :param decimation_method: "boxcar" or "anti-aliased", as in get_mach_isat
+    :param block_size: approximate number of elements of one face processed at a time by the Mach kernel
+    :return: Dataset of "Mach isat" and Mach numbers (and velocities), each with "VARIABLE variance" and
+        "VARIABLE count" variables, without a shot dimension; and DataArray of isat if keep_shots is True
+    """
+
+    session, close_session = as_session(filename)
+    try:
+        run_name = session.info['run name']
+        channel_layout = session.channel_layout(*mach_bcs[0][list(mach_bcs[0].keys())[0]])
+        frame_selection = get_frame_selection(channel_layout, time_window, decimation, decimation_method)
+        lapd_file = session.lapd_file
+        ports = np.array([session.motion(receptacle)['port'] for receptacle in mach_receptacles])
+        # NOTE: Assume mach motor datas from 6K Compumotor are identical, and only consider first one
+        shot_index = get_run_shot_index(session, mach_receptacles[0])
+        num_shots = len(shot_index['cube rows'])
+        positions = shot_index['cube rows'] // shot_index['shots per position']
+        num_positions = len(shot_index['x']) * len(shot_index['y'])
+        num_frames = frame_selection['num frames']
+        faces = sorted({face for probe_bcs in mach_bcs for face in probe_bcs})
+
+        logger.info("Accumulating shot statistics")
+        isat_statistics = ShotStatistics((len(ports), len(faces), num_positions, num_frames), axis=2)
+        mach_statistics = {}
+        isat_array = None
+        if keep_shots:
+            isat_array = empty_mach_isat_array((len(ports), len(faces), shot_index['num cube rows'], num_frames),
+                                               mach_bcs, faces, dtype, shot_index['cube rows'])
+        shots_per_block = get_shots_per_block(mach_bcs, channel_layout, frame_selection, memory_budget, max_workers)
+        with isat_reader(session.hdf5_path, max_workers) as reader:
+            for start, stop, isat_datas, offset_datas in read_isat_blocks(lapd_file, mach_bcs, reader, num_shots,
+                                                                          shots_per_block, frame_selection):
+                with stage("shot statistics block", shots=stop - start):
+                    isat_block = add_isat_block(isat_statistics, mach_statistics, isat_datas, offset_datas,
+                                                positions[start:stop], mach_bcs, resistances, len(ports), faces,
+                                                frame_selection, dtype, block_size)
+                    if isat_array is not None:
+                        isat_array[:, :, shot_index['cube rows'][start:stop]] = isat_block
+    finally:
+        if close_session:
+            session.close()
+
+    statistics_ds = statistics_dataset(isat_statistics, mach_statistics, ports, faces, shot_index['x'],
+                                       shot_index['y'], channel_layout['dt'], frame_selection['frames'],
+                                       {"run name": run_name, "shots": num_shots})
+    if electron_temperature_da is not None:
+        velocity_ds = statistics_velocities(statistics_ds, electron_temperature_da)
+        statistics_ds = statistics_ds.assign(velocity_ds.data_vars)
+    logger.info("Found shot statistics")
+
+    if not keep_shots:
+        return statistics_ds
+    x_pos, y_pos = shot_index['x'], shot_index['y']
+    isat_array = isat_array.reshape((len(ports), len(faces), len(x_pos), len(y_pos),
+                                     shot_index['shots per position'], num_frames))
+    isat_da = wrap_mach_isat_array(isat_array, ports, faces, x_pos, y_pos, channel_layout['dt'],
+                                   frame_selection['frames'])
+    return statistics_ds, isat_da.rename(run_name)
+
+
+def add_isat_block(isat_statistics, mach_statistics, isat_datas, offset_datas, positions, mach_bcs, resistances,
+                   num_ports, faces, frame_selection, dtype=float, block_size=2 ** 16):
+    r"""
+    Add a block of shots read with read_isat_blocks to isat statistics, and the Mach numbers of its shots to Mach
+    number statistics.
+
+    :param isat_statistics: ShotStatistics of isat with dimensions (port, face, position, time)
+    :param mach_statistics: dictionary of ShotStatistics with dimensions (port, position, time) by variable name,
+        to which missing variables are added
+    :param isat_datas: isat datas of block from read_isat_blocks
+    :param offset_datas: offset datas of block from read_isat_blocks
+    :param positions: position index of each shot of block
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param resistances: list of {face: resistance} dictionaries, one per probe, or None to leave isat in volts
+    :param num_ports: number of probes
+    :param faces: sorted list of faces of all probes
+    :param frame_selection: frames to read and decimation from get_frame_selection
+    :param dtype: data type of isat of block
+    :param block_size: approximate number of elements of one face processed at a time by the Mach kernel
+    :return: isat of block with dimensions (port, face, shot, time)
+    """
+
+    num_frames = frame_selection['num frames']
+    isat_block = empty_mach_isat_array((num_ports, len(faces), len(positions), num_frames), mach_bcs, faces, dtype)
+    for probe in range(len(isat_datas)):
+        for face in isat_datas[probe]:
+            write_isat_rows(isat_block[probe, faces.index(face)], isat_datas[probe][face]['signal'],
+                            face_resistance(resistances, probe, face), None, offset_signal(offset_datas, probe, face),
+                            frame_selection)
+    isat_statistics.add(isat_block, positions)
+    perpendicular = np.isin(np.array([1, 3, 4, 6]), faces).all()
+    mach_arrays = mach_velocity_kernel(isat_block, faces, None, magnetization_factor, np.cos(alpha_fore).value,
+                                       np.cos(alpha_aft).value, perpendicular, block_size)
+    for key in mach_arrays:
+        if key not in mach_statistics:
+            mach_statistics[key] = ShotStatistics((num_ports, len(isat_statistics.count), num_frames), axis=1)
+        mach_statistics[key].add(mach_arrays[key], positions)
+    return isat_block
+
+
+def statistics_dataset(isat_statistics, mach_statistics, ports, faces, x_pos, y_pos, dt, frames, attrs=None):
+    r"""
+    Dataset of shot statistics, with positions of statistics ordered as x outer, y inner.
+
+    :param isat_statistics: ShotStatistics of isat with dimensions (port, face, position, time)
+    :param mach_statistics: dictionary of ShotStatistics with dimensions (port, position, time) by variable name
+    :param ports: port of each probe
+    :param faces: sorted list of faces
+    :param x_pos: x positions
+    :param y_pos: y positions
+    :param dt: time step of digitizer (an astropy Quantity)
+    :param frames: frame index of each time
+    :param attrs: attributes of Dataset
+    :return: Dataset of "Mach isat" and Mach numbers, each with "VARIABLE variance" and "VARIABLE count" variables
+    """
+
+    with stage("wrap shot statistics"):
+        num_frames = len(frames)
+
+        def wrap_isat(array):
+            array = array.reshape((len(ports), len(faces), len(x_pos), len(y_pos), 1, num_frames))
+            return wrap_mach_isat_array(array, ports, faces, x_pos, y_pos, dt, frames).isel(shot=0, drop=True)
+
+        mach_grid = wrap_isat(isat_statistics.get_count()).isel(face=0, drop=True)
+
+        def wrap_mach(array):
+            return mach_grid.copy(data=array.reshape(mach_grid.shape))
+
+        statistics = {"Mach isat": (wrap_isat(isat_statistics.get_mean()),
+                                    wrap_isat(isat_statistics.get_variance()),
+                                    wrap_isat(isat_statistics.get_count()))}
+        for key in mach_variable_order:
+            if key in mach_statistics:
+                statistics[key] = (wrap_mach(mach_statistics[key].get_mean()),
+                                   wrap_mach(mach_statistics[key].get_variance()),
+                                   wrap_mach(mach_statistics[key].get_count()))
+        statistics_ds = xr.Dataset({name: variable
+                                    for key in ["Mach isat"] + mach_variable_order if key in statistics
+                                    for name, variable in zip((key, key + " variance", key + " count"),
+                                                              statistics[key])})
+        if not statistics_ds.indexes['port'].is_monotonic_increasing:
+            statistics_ds = statistics_ds.sortby("port")
+        return statistics_ds.assign_attrs({} if attrs is None else attrs)
+
+
+def statistics_velocities(statistics_ds, electron_temperature_da):
+    r"""
+    Find velocity statistics from Mach number statistics made by get_mach_statistics without an electron temperature.
+
+    :param statistics_ds: Dataset of shot statistics
+    :param electron_temperature_da: electron temperature profile
+    :return: Dataset of mean, variance and count of parallel and (if available) perpendicular velocities
+    """
+
+    # Velocity is Mach number times a sound speed that is the same for every shot
+    sound_speed = get_sound_speed(electron_temperature_da, statistics_ds.port)
+    if 'time' in sound_speed.dims:
+        sound_speed = statistics_ds["Parallel Mach number"].copy(
+            data=np.broadcast_to(interpolated_sound_speed(sound_speed, statistics_ds["Parallel Mach number"]),
+                                 statistics_ds["Parallel Mach number"].shape))
+    velocities = {}
+    for key in ("Parallel", "Perpendicular"):
+        if key + " Mach number" not in statistics_ds:
+            continue
+        velocities[key + " velocity"] = statistics_ds[key + " Mach number"] * sound_speed
+        velocities[key + " velocity"].attrs = {'units': str(u.cm / u.s)}
+        velocities[key + " velocity variance"] = statistics_ds[key + " Mach number variance"] * sound_speed ** 2
+        velocities[key + " velocity variance"].attrs = {'units': str(u.cm ** 2 / u.s ** 2)}
+        velocities[key + " velocity count"] = statistics_ds[key + " Mach number count"]
+    return xr.Dataset(velocities)
+
+
+def shot_mean(data_array):
+    # Mean over shots of a DataArray from get_velocity_profiles; DataArrays from get_mach_statistics are already means
+    if "shot" not in data_array.dims:
+        return data_array
+    return data_array.mean(dim='shot', keep_attrs=True)
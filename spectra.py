@@ -0,0 +1,115 @@
+import logging
+
+import numpy as np
+import xarray as xr
+import astropy.units as u
+from numpy.lib.stride_tricks import sliding_window_view
+
+from profiling import stage, profiled, array_details
+
+logger = logging.getLogger(__name__)
+
+
+# Face pairs of cross-spectra by default: the parallel faces, and the fore and aft faces on each side of the probe
+default_face_pairs = [(2, 5), (3, 1), (4, 6)]
+
+
+@profiled("get_isat_spectra")
+def get_isat_spectra(mach_isat_da, segment_length=256, overlap=0.5, face_pairs=None, average_shots=False,
+                     dtype=float, block_size=2 ** 22):
+    r"""
+    Welch power spectral densities of isat fluctuations of every face, and cross-spectral densities and coherence of
+    pairs of faces, at every port, position and shot. Time segments have the mean removed and a Hann window applied,
+    and their real FFTs are found for slabs of x positions at a time.
+
+    :param mach_isat_da: DataArray of isat with dimensions (port, face, x, y, shot, time), from get_mach_isat
+    :param segment_length: number of time steps in each segment
+    :param overlap: fraction of each segment overlapping the next
+    :param face_pairs: list of (face, face) pairs for cross-spectra, or None for default_face_pairs of faces present
+    :param average_shots: True to also average spectra over shots before finding coherence
+    :param dtype: float, or np.float32 to find FFTs in single precision with half the memory
+    :param block_size: approximate number of complex FFT elements held in memory at a time
+    :return: Dataset of "Isat PSD" (port, face, x, y, shot, frequency), and "Cross spectral density", "Cross phase"
+        and "Coherence" (port, pair, x, y, shot, frequency), with a frequency coordinate in Hz
+    """
+
+    mach_isat_da = mach_isat_da.transpose('port', 'face', 'x', 'y', 'shot', 'time')
+    faces = list(mach_isat_da.face.values)
+    if face_pairs is None:
+        face_pairs = [pair for pair in default_face_pairs if pair[0] in faces and pair[1] in faces]
+    missing_faces = {face for pair in face_pairs for face in pair if face not in faces}
+    if missing_faces:
+        raise ValueError("Faces " + str(sorted(missing_faces)) + " of face pairs are not in the isat DataArray")
+    num_times = mach_isat_da.sizes['time']
+    if segment_length > num_times:
+        raise ValueError("Segment length " + str(segment_length) + " is longer than the " + str(num_times)
+                         + " time steps of each shot")
+    step = max(int(round(segment_length * (1 - overlap))), 1)
+    num_segments = (num_times - segment_length) // step + 1
+
+    time = mach_isat_da.coords['time']
+    time_step = (np.diff(time.values).mean() * u.Unit(time.attrs.get('units', 'ms'))).to(u.s).value
+    sampling_frequency = 1 / time_step
+    frequencies = np.fft.rfftfreq(segment_length, time_step)
+    window = np.hanning(segment_length + 1)[:-1].astype(dtype)  # Periodic Hann window, as in Welch's method
+    # One-sided density: power at frequencies other than zero and (for even lengths) Nyquist is doubled
+    scale = np.full(len(frequencies), 2 / (sampling_frequency * np.sum(window.astype(float) ** 2)))
+    scale[0] /= 2
+    if segment_length % 2 == 0:
+        scale[-1] /= 2
+    scale = scale.astype(dtype)
+
+    num_ports, num_faces, num_x, num_y, num_shots = mach_isat_da.shape[:-1]
+    spectra_dtype = np.result_type(dtype, np.float32)
+    psd = np.empty((num_ports, num_faces, num_x, num_y, num_shots, len(frequencies)), dtype=spectra_dtype)
+    cross = np.empty((num_ports, len(face_pairs), num_x, num_y, num_shots, len(frequencies)),
+                     dtype=np.result_type(spectra_dtype, np.complex64))
+
+    # Blocks are slabs of x positions; each holds the FFTs of all segments of all faces in the slab
+    elements_per_x = num_ports * num_faces * num_y * num_shots * num_segments * len(frequencies)
+    x_per_block = max(int(block_size // max(elements_per_x, 1)), 1)
+    with stage("isat spectra", segments=num_segments, **array_details(mach_isat_da, "isat ")):
+        for x_start in range(0, num_x, x_per_block):
+            x_block = slice(x_start, min(x_start + x_per_block, num_x))
+            isat_block = np.asarray(mach_isat_da.isel(x=x_block).values, dtype=dtype)
+            segments = sliding_window_view(isat_block, segment_length, axis=-1)[..., ::step, :]
+            segments = (segments - segments.mean(axis=-1, keepdims=True)) * window
+            transforms = np.fft.rfft(segments, axis=-1)  # (port, face, x, y, shot, segment, frequency)
+            del segments
+            psd[:, :, x_block] = (transforms.real ** 2 + transforms.imag ** 2).mean(axis=-2) * scale
+            for pair, (face_1, face_2) in enumerate(face_pairs):
+                cross[:, pair, x_block] = (np.conj(transforms[:, faces.index(face_1)])
+                                           * transforms[:, faces.index(face_2)]).mean(axis=-2) * scale
+
+    if average_shots:
+        psd, cross = psd.mean(axis=-2), cross.mean(axis=-2)
+    psd_1 = psd[:, [faces.index(face_1) for face_1, _ in face_pairs]]
+    psd_2 = psd[:, [faces.index(face_2) for _, face_2 in face_pairs]]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        coherence = (cross.real ** 2 + cross.imag ** 2) / (psd_1 * psd_2)
+
+    shot_dims = [] if average_shots else ['shot']
+    spectra_grid = mach_isat_da.isel(time=0, drop=True)
+    if average_shots:
+        spectra_grid = spectra_grid.isel(shot=0, drop=True)
+    face_coords = dict(spectra_grid.coords)
+    face_coords['frequency'] = ('frequency', frequencies, {"units": str(u.Hz)})
+    pair_coords = {name: coord for name, coord in face_coords.items() if name != 'face'}
+    pair_coords.update({'pair': np.arange(len(face_pairs)),
+                        'face1': ('pair', [pair[0] for pair in face_pairs]),
+                        'face2': ('pair', [pair[1] for pair in face_pairs])})
+    face_dims = ['port', 'face', 'x', 'y'] + shot_dims + ['frequency']
+    pair_dims = ['port', 'pair', 'x', 'y'] + shot_dims + ['frequency']
+
+    isat_units = mach_isat_da.attrs.get('units')
+    psd_attrs = {"units": str(u.Unit(isat_units) ** 2 / u.Hz)} if isat_units else {}
+    spectra = xr.Dataset({"Isat PSD": xr.DataArray(psd, dims=face_dims, coords=face_coords, attrs=psd_attrs),
+                          "Cross spectral density": xr.DataArray(np.abs(cross), dims=pair_dims, coords=pair_coords,
+                                                                 attrs=psd_attrs),
+                          "Cross phase": xr.DataArray(np.angle(cross), dims=pair_dims, coords=pair_coords,
+                                                      attrs={"units": str(u.rad)}),
+                          "Coherence": xr.DataArray(coherence, dims=pair_dims, coords=pair_coords)},
+                         attrs={"segment length": segment_length, "segment overlap": overlap,
+                                "segments per shot": num_segments, "window": "hann"})
+    logger.info("Found isat spectra")
+    return spectra
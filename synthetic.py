@@ -0,0 +1,269 @@
+import h5py
+import numpy as np
+
+# Note: This file layout follows the BaPSF HDF5 structure read by bapsflib (SIS 3301 digitizer,
+#     6K Compumotor motion control, and MSI summaries), with only the groups and attributes bapsflib needs.
+
+# BAPSFLIB parameters matching main.py
+synthetic_mach_face_bcs = [{2: (3, 1), 5: (3, 3)},
+                           {2: (3, 4), 5: (3, 5)}]
+synthetic_mach_receptacles = [3, 4]
+synthetic_mach_ports = [27, 29]
+
+sis3301_scale = 3.051944077014923e-4  # [V / bit]
+sis3301_offset = -2.5  # [V]
+
+
+def write_synthetic_lapd(filename, x_positions=np.arange(-20., 21., 2.), y_positions=np.array([0.]),
+                         shots_per_position=5, num_frames=4096, samples_to_average=512,
+                         mach_bcs=None, mach_receptacles=None, mach_ports=None,
+                         run_name="00_synthetic_line", seed=0, shots_per_write=256, interleaved=False):
+    r"""
+    Write an HDF5 file in the LAPD layout containing synthetic Mach probe ion saturation current signals.
+
+    :param filename: path of HDF5 file to create
+    :param x_positions: x positions of the motion list, in cm
+    :param y_positions: y positions of the motion list, in cm
+    :param shots_per_position: number of shots taken at each position
+    :param num_frames: number of digitizer samples per shot
+    :param samples_to_average: digitizer hardware sample averaging; sets the time step
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param mach_ports: LAPD port of each probe
+    :param run_name: name of the data run
+    :param seed: random number generator seed
+    :param shots_per_write: number of shots generated and written at a time, to bound memory for large files
+    :param interleaved: True to take shots in passes over all positions (one shot per position per pass) instead of
+        taking all shots at one position before moving to the next
+    :return: path of HDF5 file
+    """
+
+    mach_bcs = synthetic_mach_face_bcs if mach_bcs is None else mach_bcs
+    mach_receptacles = synthetic_mach_receptacles if mach_receptacles is None else mach_receptacles
+    mach_ports = synthetic_mach_ports if mach_ports is None else mach_ports
+
+    xy_positions = np.array([(x, y) for x in x_positions for y in y_positions])
+    if interleaved:
+        shot_xy = np.tile(xy_positions, (shots_per_position, 1))
+    else:
+        shot_xy = np.repeat(xy_positions, shots_per_position, axis=0)
+
+    with h5py.File(filename, "w") as hdf5_file:
+        hdf5_file.attrs["LaPD HDF5 software version"] = np.bytes_("1.2")
+        raw_group = hdf5_file.create_group("Raw data + config")
+        raw_group.attrs.update({"Data run": np.bytes_(run_name),
+                                "Description": np.bytes_("Synthetic Mach probe line; Idis 5000 A, "
+                                                         "puffing 85 V, Mach probes at ports "
+                                                         + ", ".join(str(port) for port in mach_ports)),
+                                "Investigator": np.bytes_("Synthetic"),
+                                "Experiment name": np.bytes_("Synthetic"),
+                                "Experiment description": np.bytes_(""),
+                                "Experiment set name": np.bytes_("Synthetic"),
+                                "Experiment set description": np.bytes_(""),
+                                "Status": np.bytes_("Completed"),
+                                "Status date": np.bytes_("1/1/2024 12:00:00 PM")})
+        write_msi(hdf5_file.create_group("MSI"))
+        write_sis3301(raw_group.create_group("SIS 3301"), mach_bcs, num_frames, samples_to_average)
+        write_six_k(raw_group.create_group("6K Compumotor"), mach_receptacles, mach_ports, x_positions, y_positions)
+
+    for start in range(0, len(shot_xy), shots_per_write):
+        append_synthetic_shots(filename, shot_xy[start:start + shots_per_write], mach_bcs=mach_bcs,
+                               mach_receptacles=mach_receptacles, seed=(seed, start))
+    return filename
+
+
+def append_synthetic_shots(filename, shot_xy, mach_bcs=None, mach_receptacles=None, seed=None):
+    r"""
+    Append synthetic shots at the given (x, y) positions to an HDF5 file made by write_synthetic_lapd.
+
+    :param filename: path of HDF5 file
+    :param shot_xy: array of (x, y) positions, one row per new shot
+    :param mach_bcs: list of {face: (board, channel)} dictionaries, one per probe
+    :param mach_receptacles: 6K Compumotor receptacle of each probe
+    :param seed: random number generator seed
+    :return: number of shots in file after appending
+    """
+
+    mach_bcs = synthetic_mach_face_bcs if mach_bcs is None else mach_bcs
+    mach_receptacles = synthetic_mach_receptacles if mach_receptacles is None else mach_receptacles
+    rng = np.random.default_rng(seed)
+    shot_xy = np.asarray(shot_xy, dtype=float).reshape(-1, 2)
+
+    with h5py.File(filename, "r+") as hdf5_file:
+        sis_group = hdf5_file["Raw data + config/SIS 3301"]
+        six_k_group = hdf5_file["Raw data + config/6K Compumotor"]
+        num_frames = sis_group["Configuration: config01/Boards[0]"].attrs["Board samples"]
+        motion_datasets = [six_k_group[name] for name in six_k_group if name.startswith("XY[")]
+        old_num_shots = motion_datasets[0].shape[0]
+        new_num_shots = old_num_shots + len(shot_xy)
+        shot_numbers = np.arange(old_num_shots, new_num_shots) + 1
+
+        for probe, probe_bcs in enumerate(mach_bcs):
+            isat_signals = synthetic_isat_signals(shot_xy, sorted(probe_bcs), num_frames, rng, probe)
+            for face, (board, channel) in probe_bcs.items():
+                signal_dataset = sis_group[f"config01 [{board}:{channel}]"]
+                header_dataset = sis_group[f"config01 [{board}:{channel}] headers"]
+                bits = np.clip(np.round((isat_signals[face] - sis3301_offset) / sis3301_scale), 0, 2 ** 14 - 1
+                               ).astype(np.int16)
+                headers = np.empty(len(shot_xy), dtype=header_dataset.dtype)
+                headers["Shot"] = shot_numbers
+                headers["Scale"] = sis3301_scale
+                headers["Offset"] = sis3301_offset
+                headers["Min"] = bits.min(axis=1)
+                headers["Max"] = bits.max(axis=1)
+                headers["Clipped"] = 0
+                append_rows(signal_dataset, bits)
+                append_rows(header_dataset, headers)
+
+        for motion_dataset in motion_datasets:
+            motion_rows = np.zeros(len(shot_xy), dtype=motion_dataset.dtype)
+            motion_rows["Shot number"] = shot_numbers
+            motion_rows["x"] = shot_xy[:, 0]
+            motion_rows["y"] = shot_xy[:, 1]
+            motion_rows["Motion list"] = np.bytes_("ml-0001")
+            motion_rows["Probe name"] = np.bytes_(motion_dataset.name.split("/")[-1])
+            append_rows(motion_dataset, motion_rows)
+
+    return new_num_shots
+
+
+def append_rows(dataset, rows):
+    dataset.resize(dataset.shape[0] + len(rows), axis=0)
+    dataset[-len(rows):] = rows
+
+
+def synthetic_isat_signals(shot_xy, faces, num_frames, rng, probe=0):
+    # Parallel flow profile is a tanh shear layer across x, reversed for the second probe
+    parallel_mach = 0.4 * np.tanh(shot_xy[:, 0] / 8) * (-1) ** probe
+    perpendicular_mach = 0.1 * np.exp(-(shot_xy[:, 0] / 10) ** 2)
+    density = 0.2 + 0.6 * np.exp(-(shot_xy[:, 0] ** 2 + shot_xy[:, 1] ** 2) / 15 ** 2)  # [V across resistor]
+
+    frames = np.arange(num_frames)
+    envelope = np.clip(np.minimum(frames - 0.05 * num_frames, 0.7 * num_frames - frames) / (0.02 * num_frames), 0, 1)
+    face_log_ratios = {5: parallel_mach, 2: -parallel_mach,
+                       6: parallel_mach + perpendicular_mach, 3: -parallel_mach - perpendicular_mach,
+                       4: parallel_mach - perpendicular_mach, 1: -parallel_mach + perpendicular_mach}
+
+    dc_offset = rng.normal(0.05, 0.01, size=(len(shot_xy), 1))
+    isat_signals = {}
+    for face in faces:
+        amplitude = density * np.exp(face_log_ratios[face])  # 0.5 * ln(I_5 / I_2) is the parallel Mach number
+        fluctuation = 1 + 0.1 * rng.standard_normal((len(shot_xy), num_frames))
+        isat_signals[face] = (amplitude[:, np.newaxis] * envelope * fluctuation + dc_offset
+                              + 0.002 * rng.standard_normal((len(shot_xy), num_frames)))
+    return isat_signals
+
+
+def write_msi(msi_group):
+    summary_shots = np.array([0, 1])
+    discharge_group = msi_group.create_group("Discharge")
+    discharge_group.attrs.update({"Calibration tag": np.bytes_(""),
+                                  "Current conversion factor": np.float32(0.),
+                                  "Start time": np.float32(-0.0249856),
+                                  "Timestep": np.float32(4.88e-5),
+                                  "Voltage conversion factor": np.float32(0.)})
+    discharge_group.create_dataset("Cathode-anode voltage", data=np.zeros((2, 2048), dtype=np.float32))
+    discharge_group.create_dataset("Discharge current", data=np.zeros((2, 2048), dtype=np.float32))
+    discharge_summary = np.zeros(2, dtype=[("Shot number", np.int32), ("Timestamp", np.float64),
+                                           ("Data valid", np.int8), ("Pulse length", np.float32),
+                                           ("Peak current", np.float32), ("Bank voltage", np.float32)])
+    discharge_summary["Shot number"] = summary_shots
+    discharge_summary["Peak current"] = [5012.5, 4987.5]
+    discharge_group.create_dataset("Discharge summary", data=discharge_summary)
+
+    gas_group = msi_group.create_group("Gas pressure")
+    gas_group.attrs.update({"Ion gauge calibration tag": np.bytes_("03/01/2006"),
+                            "RGA AMUs": np.arange(1, 51, dtype=np.int32),
+                            "RGA calibration tag": np.bytes_("03/01/2006")})
+    gas_summary = np.zeros(2, dtype=[("Shot number", np.int32), ("Timestamp", np.float64),
+                                     ("Ion gauge data valid", np.int8), ("RGA data valid", np.int8),
+                                     ("Fill pressure", np.float32), ("Peak AMU", np.float32)])
+    gas_summary["Shot number"] = summary_shots
+    gas_summary["Fill pressure"] = 4.2e-5
+    gas_summary["Peak AMU"] = 4.
+    gas_group.create_dataset("Gas pressure summary", data=gas_summary)
+    gas_group.create_dataset("RGA partial pressures", data=np.zeros((2, 50), dtype=np.float32))
+
+    field_group = msi_group.create_group("Magnetic field")
+    field_group.attrs.update({"Calibration tag": np.bytes_("08/27/2013"),
+                              "Profile z locations": (-300. + np.arange(1024) * 2325.3 / 1023).astype(np.float32)})
+    field_group.create_dataset("Magnet power supply currents", data=np.zeros((2, 10), dtype=np.float32))
+    field_group.create_dataset("Magnetic field profile", data=np.zeros((2, 1024), dtype=np.float32))
+    field_summary = np.zeros(2, dtype=[("Shot number", np.int32), ("Timestamp", np.float64),
+                                       ("Data valid", np.int8), ("Peak magnetic field", np.float32)])
+    field_summary["Shot number"] = summary_shots
+    field_summary["Data valid"] = 1
+    field_summary["Peak magnetic field"] = 1000.
+    field_group.create_dataset("Magnetic field summary", data=field_summary)
+
+
+def write_sis3301(sis_group, mach_bcs, num_frames, samples_to_average):
+    sis_group.attrs.update({"Device name": np.bytes_("SIS 3301"),
+                            "Type": np.bytes_("Data acquisition")})
+    config_group = sis_group.create_group("Configuration: config01")
+    config_group.attrs.update({"Clock rate": np.bytes_("Internal 100 MHz"),
+                               "Configuration": np.bytes_("config01"),
+                               "Samples to average": np.bytes_(f"Average {samples_to_average} Samples"
+                                                               if samples_to_average > 1 else "No averaging"),
+                               "Shots to average": np.int16(1),
+                               "Software start": np.bytes_("TRUE"),
+                               "Stop delay": np.uint16(0),
+                               "Trigger mode": np.bytes_("Start/stop")})
+
+    board_channels = {}
+    for probe_bcs in mach_bcs:
+        for board, channel in probe_bcs.values():
+            board_channels.setdefault(board, set()).add(channel)
+
+    header_dtype = np.dtype([("Shot", np.uint32), ("Scale", np.float64), ("Offset", np.float64),
+                             ("Min", np.int16), ("Max", np.int16), ("Clipped", np.uint8)])
+    for board_index, board in enumerate(sorted(board_channels)):
+        board_group = config_group.create_group(f"Boards[{board_index}]")
+        board_group.attrs.update({"Board": np.uint32(board), "Board samples": np.uint32(num_frames)})
+        for channel_index, channel in enumerate(sorted(board_channels[board])):
+            channel_group = board_group.create_group(f"Channels[{channel_index}]")
+            channel_group.attrs.update({"Board": np.uint32(board), "Channel": np.uint32(channel),
+                                        "DC offset (mV)": np.float64(0.), "Data type": np.bytes_("Isat")})
+            sis_group.create_dataset(f"config01 [{board}:{channel}]", shape=(0, num_frames), dtype=np.int16,
+                                     maxshape=(None, num_frames), chunks=(1, num_frames))
+            sis_group.create_dataset(f"config01 [{board}:{channel}] headers", shape=(0,), dtype=header_dtype,
+                                     maxshape=(None,), chunks=(1024,))
+
+
+def write_six_k(six_k_group, mach_receptacles, mach_ports, x_positions, y_positions):
+    six_k_group.attrs.update({"Device name": np.bytes_("6K Compumotor"),
+                              "Type": np.bytes_("Motion")})
+    motion_dtype = np.dtype([("Shot number", np.int32), ("x", np.float64), ("y", np.float64), ("z", np.float64),
+                             ("theta", np.float64), ("phi", np.float64),
+                             ("Motion list", np.bytes_, 120), ("Probe name", np.bytes_, 120)])
+    for receptacle, port in zip(mach_receptacles, mach_ports):
+        probe_name = f"mach{receptacle:02}"
+        probe_group = six_k_group.create_group(f"Probe: XY[{receptacle}]: {probe_name}")
+        probe_group.attrs.update({"Calibration": np.bytes_("2004-06-04 0.375 inch calibration"),
+                                  "Level sy (cm)": np.float64(70.46),
+                                  "Port": np.uint8(port),
+                                  "Probe": np.bytes_(probe_name),
+                                  "Probe channels": np.bytes_(""),
+                                  "Probe type": np.bytes_("LaPD probe"),
+                                  "Receptacle": np.int8(receptacle),
+                                  "Unnamed": np.bytes_("lower East"),
+                                  "sx at end (cm)": np.float64(112.01),
+                                  "z": np.float64(0.)})
+        for axis in range(2):
+            probe_group.create_group(f"Axes[{axis}]").attrs.update({"6K #": np.uint8(1),
+                                                                    "Axis": np.uint8(2 * (receptacle - 1) + axis + 1),
+                                                                    "Id": np.uint8(receptacle)})
+        six_k_group.create_dataset(f"XY[{receptacle}]: {probe_name}", shape=(0,), dtype=motion_dtype,
+                                   maxshape=(None,), chunks=(1024,))
+
+    motion_list_group = six_k_group.create_group("Motion list: ml-0001")
+    motion_list_group.attrs.update({"Created date": np.bytes_("1/1/2024 12:00:00 PM"),
+                                    "Data motion count": np.uint32(len(x_positions) * len(y_positions)),
+                                    "Delta x": np.float64(np.ptp(x_positions) / max(len(x_positions) - 1, 1)),
+                                    "Delta y": np.float64(np.ptp(y_positions) / max(len(y_positions) - 1, 1)),
+                                    "Grid center x": np.float64(np.mean(x_positions)),
+                                    "Grid center y": np.float64(np.mean(y_positions)),
+                                    "Motion count": np.uint32(len(x_positions) * len(y_positions)),
+                                    "Motion list": np.bytes_("ml-0001"),
+                                    "Nx": np.uint32(len(x_positions)),
+                                    "Ny": np.uint32(len(y_positions))})
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+
+mach_bcs = synthetic.synthetic_mach_face_bcs
+mach_receptacles = synthetic.synthetic_mach_receptacles
+# Different resistances on each face, so isat left in volts on any face is caught
+resistances = [{2: 10., 5: 20.}, {2: 30., 5: 40.}]
+
+
+@pytest.fixture(scope="session")
+def synthetic_file(tmp_path_factory):
+    return synthetic.write_synthetic_lapd(str(tmp_path_factory.mktemp("lapd") / "synthetic.hdf5"),
+                                          x_positions=np.arange(-4., 5., 2.), shots_per_position=3, num_frames=2048)
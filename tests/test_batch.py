@@ -0,0 +1,70 @@
+import json
+import os
+
+import astropy.units as u
+import numpy as np
+import pytest
+import xarray as xr
+
+import batch
+from conftest import mach_bcs, mach_receptacles, resistances
+
+
+def write_batch_run(directory, hdf5_path, **config):
+    # Langmuir dataset and config file for a synthetic run; returns config path
+    run_name = os.path.splitext(os.path.basename(hdf5_path))[0]
+    os.link(hdf5_path, os.path.join(directory, run_name + ".hdf5"))
+    x = np.arange(-30., 31., 1.5)
+    times = np.linspace(0., 20., 41)
+    electron_temperature = 2. + 3. * np.exp(-(x[None, :, None, None] / 15.) ** 2) * np.ones((2, 1, 1, len(times)))
+    xr.DataArray(electron_temperature, dims=['port', 'x', 'y', 'time'],
+                 coords=(('port', [27, 29]), ('x', x, {'units': 'cm'}), ('y', [0.], {'units': 'cm'}),
+                         ('time', times, {'units': 'ms'})), attrs={'units': 'eV'}
+                 ).to_dataset(name='T_e').to_netcdf(os.path.join(directory, run_name + "_lang.nc"))
+    config_path = os.path.join(directory, "config.json")
+    with open(config_path, "w") as config_file:
+        json.dump({"mach_face_bcs": [{str(face): list(bc) for face, bc in probe_bcs.items()} for probe_bcs in mach_bcs],
+                   "mach_receptacles": mach_receptacles,
+                   "mach_face_resistances": [{str(face): resistance for face, resistance in probe_resistances.items()}
+                                             for probe_resistances in resistances],
+                   "steady_state_times_ms": [2, 8],
+                   "output_directory": os.path.join(directory, "out"),
+                   **config}, config_file)
+    return config_path
+
+
+def test_load_batch_config_time_window(tmp_path):
+    config_path = tmp_path / "config.json"
+    for time_window, expected in (([100, 1900], slice(100, 1900)), ([0, 10, "ms"], (0 * u.ms, 10 * u.ms)),
+                                  (None, None)):
+        config_path.write_text(json.dumps({"mach_face_bcs": [], "mach_receptacles": [], "mach_face_resistances": [],
+                                           "steady_state_times_ms": [2, 8], "output_directory": str(tmp_path),
+                                           "mach_isat_options": {"time_window": time_window}}))
+        assert batch.load_batch_config(str(config_path))["mach_isat_options"]["time_window"] == expected
+    config_path.write_text(json.dumps({"mach_face_bcs": [], "mach_receptacles": [], "mach_face_resistances": [],
+                                       "steady_state_times_ms": [2, 8], "output_directory": str(tmp_path),
+                                       "mach_isat_options": {"time_window": [0, 0.01]}}))
+    with pytest.raises(ValueError):
+        batch.load_batch_config(str(config_path))
+
+
+def test_run_batch_skips_only_runs_with_every_output(synthetic_file, tmp_path):
+    config_path = write_batch_run(str(tmp_path), synthetic_file, spectra_options={},
+                                  mach_isat_options={"time_window": [0, 2, "ms"]})
+    assert batch.run_batch(str(tmp_path), config_path, max_workers=1)["synthetic"][0] == "done"
+    assert batch.run_batch(str(tmp_path), config_path, max_workers=1)["synthetic"][0] == "skipped"
+    os.remove(tmp_path / "out" / "synthetic_spectra.nc")
+    assert batch.run_batch(str(tmp_path), config_path, max_workers=1)["synthetic"][0] == "done"
+    assert os.path.isfile(tmp_path / "out" / "synthetic_spectra.nc")
+
+
+def exit_worker(*args):
+    # Stands in for batch.process_run in a worker process that is killed
+    os._exit(1)
+
+
+def test_run_batch_records_broken_pool_as_failed(synthetic_file, tmp_path, monkeypatch):
+    config_path = write_batch_run(str(tmp_path), synthetic_file)
+    monkeypatch.setattr(batch, "process_run", exit_worker)
+    status, _, error = batch.run_batch(str(tmp_path), config_path, max_workers=1)["synthetic"]
+    assert status == "failed" and "BrokenProcessPool" in error
@@ -0,0 +1,27 @@
+import numpy as np
+
+from cache import StageCache, get_cached_isat
+from conftest import mach_bcs, mach_receptacles, resistances
+from getMachIsat import get_mach_isat
+
+
+def test_lazy_isat_stage_matches_eager(synthetic_file, tmp_path):
+    isat_da = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances)
+    eager_isat = get_cached_isat(StageCache(str(tmp_path / "eager")), synthetic_file, mach_bcs, mach_receptacles,
+                                 resistances)
+    lazy_isat = get_cached_isat(StageCache(str(tmp_path / "lazy")), synthetic_file, mach_bcs, mach_receptacles,
+                                resistances, chunk_positions=2)
+    assert lazy_isat.chunks is not None
+    np.testing.assert_allclose(eager_isat.values, isat_da.values)
+    np.testing.assert_allclose(lazy_isat.values, isat_da.values)
+
+
+def test_stage_files_use_output_options(synthetic_file, tmp_path):
+    isat_da = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances)
+    for chunk_positions in (None, 2):
+        cache = StageCache(str(tmp_path / str(chunk_positions)),
+                           output_options={"compression_level": 4, "dtype": "float32"})
+        cached_isat = get_cached_isat(cache, synthetic_file, mach_bcs, mach_receptacles, resistances,
+                                      chunk_positions=chunk_positions)
+        assert cached_isat.encoding["dtype"] == np.float32 and cached_isat.encoding["zlib"]
+        np.testing.assert_allclose(cached_isat.values, isat_da.values, rtol=1e-6, atol=1e-6)
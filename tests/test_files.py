@@ -0,0 +1,15 @@
+import numpy as np
+import xarray as xr
+
+from files import write_netcdf
+
+
+def test_write_netcdf_modes(tmp_path):
+    path = str(tmp_path / "dataset.nc")
+    write_netcdf(xr.Dataset({"a": ("x", np.arange(3.))}), path)
+    write_netcdf(xr.Dataset({"b": ("x", np.ones(3))}), path)
+    with xr.open_dataset(path) as dataset:
+        assert set(dataset.data_vars) == {"a", "b"}
+    write_netcdf(xr.Dataset({"c": ("x", np.zeros(3))}), path, mode="w")
+    with xr.open_dataset(path) as dataset:
+        assert set(dataset.data_vars) == {"c"}
@@ -0,0 +1,33 @@
+import numpy as np
+
+from conftest import mach_bcs, mach_receptacles, resistances
+from getMachIsat import get_mach_isat
+
+
+def test_streamed_isat_to_disk_matches_in_memory(synthetic_file, tmp_path):
+    isat_da = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances)
+    streamed_isat = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances, memory_budget=2 ** 16,
+                                  isat_path=str(tmp_path / "isat.npy"))
+    assert isinstance(streamed_isat.data, np.memmap)
+    np.testing.assert_array_equal(streamed_isat.values, isat_da.values)
+
+
+def test_reader_processes_match_reading_in_process(synthetic_file):
+    isat_da = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances, memory_budget=2 ** 16)
+    for max_workers in (2, 3):
+        worker_isat = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances, memory_budget=2 ** 16,
+                                    max_workers=max_workers)
+        np.testing.assert_array_equal(worker_isat.values, isat_da.values)
+    np.testing.assert_array_equal(get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances,
+                                                max_workers=2).values, isat_da.values)
+
+
+def test_lazy_time_chunks_match_eager(synthetic_file):
+    for read_options in ({}, {"time_window": slice(100, 1900), "decimation": 8},
+                         {"time_window": slice(100, 1900), "decimation": 8, "decimation_method": "anti-aliased"}):
+        isat_da = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances, **read_options)
+        lazy_isat = get_mach_isat(synthetic_file, mach_bcs, mach_receptacles, resistances, chunk_positions=2,
+                                  chunk_frames=50, **read_options)
+        assert lazy_isat.data.numblocks[-1] > 1
+        np.testing.assert_allclose(lazy_isat.values, isat_da.values, rtol=1e-12, atol=1e-12)
+        np.testing.assert_array_equal(lazy_isat.time.values, isat_da.time.values)
@@ -0,0 +1,67 @@
+import h5py
+import numpy as np
+import pytest
+
+import synthetic
+from conftest import mach_bcs, mach_receptacles, resistances
+from live import LiveMachRun
+from shot_statistics import get_mach_statistics
+
+
+def assert_statistics_match(live_run, hdf5_path):
+    # Live statistics of each position reached equal those of the whole file read at once
+    statistics_ds = live_run.statistics()
+    reference_ds = get_mach_statistics(hdf5_path, mach_bcs, mach_receptacles, resistances)
+    statistics_ds = statistics_ds.sel(x=reference_ds.x, y=reference_ds.y)
+    assert set(statistics_ds.data_vars) == set(reference_ds.data_vars)
+    for key in reference_ds.data_vars:
+        np.testing.assert_allclose(statistics_ds[key].values, reference_ds[key].values, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_live_run_follows_appended_shots(tmp_path, max_workers):
+    hdf5_path = synthetic.write_synthetic_lapd(str(tmp_path / "live.hdf5"), x_positions=np.array([-4., -2.]),
+                                               shots_per_position=3, num_frames=1024)
+    rng = np.random.default_rng(3)
+    with LiveMachRun(hdf5_path, mach_bcs, mach_receptacles, resistances, memory_budget=2 ** 15,
+                     max_workers=max_workers) as live_run:
+        assert live_run.update() == 6
+        assert_statistics_match(live_run, hdf5_path)
+        assert live_run.update() == 0
+        for append in range(3):
+            # Shots at positions seen before and at new positions, written while the reader processes exist
+            synthetic.append_synthetic_shots(hdf5_path, np.column_stack([rng.choice([-4., -2., 0., 2.], 4),
+                                                                         np.zeros(4)]), seed=append)
+            assert live_run.update() == 4
+            assert_statistics_match(live_run, hdf5_path)
+
+    # A new LiveMachRun resumes from the checkpoint
+    synthetic.append_synthetic_shots(hdf5_path, [[4., 0.]] * 2, seed=9)
+    with LiveMachRun(hdf5_path, mach_bcs, mach_receptacles, resistances) as resumed_run:
+        assert resumed_run.num_shots == 18
+        assert resumed_run.update() == 2
+        assert_statistics_match(resumed_run, hdf5_path)
+
+
+def test_live_run_leaves_out_shots_without_motion(tmp_path):
+    hdf5_path = synthetic.write_synthetic_lapd(str(tmp_path / "live.hdf5"), x_positions=np.array([-4., -2.]),
+                                               shots_per_position=3, num_frames=1024)
+    synthetic.append_synthetic_shots(hdf5_path, [[-4., 0.], [0., 0.], [-2., 0.]], seed=1)
+    # Statistics of the other positions are those of the file before the motion entry of the shot at x = 0 is given
+    # another shot number, so that shot has no motion
+    reference_ds = get_mach_statistics(hdf5_path, mach_bcs, mach_receptacles, resistances).sel(x=[-4., -2.])
+    with h5py.File(hdf5_path, "r+") as hdf5_file:
+        six_k_group = hdf5_file["Raw data + config/6K Compumotor"]
+        motion_dataset = six_k_group[next(name for name in six_k_group
+                                          if name.startswith(f"XY[{mach_receptacles[0]}]"))]
+        motion_row = motion_dataset[7]
+        motion_row["Shot number"] = 1000
+        motion_dataset[7] = motion_row
+    with LiveMachRun(hdf5_path, mach_bcs, mach_receptacles, resistances) as live_run:
+        with pytest.warns(UserWarning, match="no motion entry"):
+            live_run.update()
+        statistics_ds = live_run.statistics()
+    # Shots after the one left out keep their own positions
+    np.testing.assert_array_equal(statistics_ds.x.values, [-4., -2.])
+    for key in reference_ds.data_vars:
+        np.testing.assert_allclose(statistics_ds[key].values, reference_ds[key].values, rtol=1e-10, atol=1e-12)
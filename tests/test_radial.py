@@ -0,0 +1,21 @@
+import numpy as np
+
+import radial
+from radial import get_profile_index
+
+
+def test_profile_indexes_are_bounded():
+    radial.profile_indexes.clear()
+    y = np.array([0.])
+    for num_x in range(2, 4 + radial.max_profile_indexes):
+        get_profile_index(np.linspace(-4., 4., num_x), y)
+    assert len(radial.profile_indexes) == radial.max_profile_indexes
+
+    # Reusing the oldest grid keeps it, and the next new grid drops the least recently used one instead
+    oldest_key = next(iter(radial.profile_indexes))
+    oldest_index = radial.profile_indexes[oldest_key]
+    assert get_profile_index(np.frombuffer(oldest_key[0]), y) is oldest_index
+    second_key = list(radial.profile_indexes)[0]
+    get_profile_index(np.linspace(-4., 4., 20), y)
+    assert oldest_key in radial.profile_indexes
+    assert second_key not in radial.profile_indexes
@@ -0,0 +1,53 @@
+from statistics import NormalDist
+
+import numpy as np
+import xarray as xr
+
+from velocity import shot_confidence_intervals
+
+
+def shots_with_missing_values(num_rows=200, num_shots=9, missing_fraction=0.3):
+    # Random shots with NaN values; row 0 has two values, row 1 one value, and row 2 none
+    values = np.random.default_rng(0).standard_normal((num_rows, num_shots))
+    values[np.random.default_rng(1).random(values.shape) < missing_fraction] = np.nan
+    values[0] = [1., 3.] + [np.nan] * (num_shots - 2)
+    values[1] = [2.] + [np.nan] * (num_shots - 1)
+    values[2] = np.nan
+    return values
+
+
+def test_jackknife_missing_shots(confidence_level=0.95):
+    # Against leave-one-out means of each row's values
+    values = shots_with_missing_values()
+    confidence_intervals = shot_confidence_intervals(xr.Dataset({"value": (("x", "shot"), values)}), confidence_level,
+                                                     resampling="jackknife")
+    z = NormalDist().inv_cdf((1 + confidence_level) / 2)
+    reference = np.full((len(values), 2), np.nan)
+    for row, row_values in enumerate(values):
+        row_values = row_values[~np.isnan(row_values)]
+        if len(row_values) >= 2:
+            leave_one_out_means = (row_values.sum() - row_values) / (len(row_values) - 1)
+            half_width = z * np.sqrt((len(row_values) - 1) / len(row_values) * np.sum(
+                (leave_one_out_means - leave_one_out_means.mean()) ** 2))
+            reference[row] = row_values.mean() - half_width, row_values.mean() + half_width
+    np.testing.assert_allclose(confidence_intervals["value lower CI"].values, reference[:, 0], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(confidence_intervals["value upper CI"].values, reference[:, 1], rtol=0, atol=1e-12)
+
+
+def test_bootstrap_missing_shots(confidence_level=0.9, num_resamples=500, seed=3):
+    # Against np.quantile of the means of the same resamples, leaving out resamples that drew only NaN shots
+    values = shots_with_missing_values()
+    confidence_intervals = shot_confidence_intervals(xr.Dataset({"value": (("x", "shot"), values)}), confidence_level,
+                                                     num_resamples=num_resamples, seed=seed, block_size=2 ** 12)
+    shot_indexes = np.random.default_rng(seed).integers(0, values.shape[1], size=(num_resamples, values.shape[1]))
+    reference = np.full((len(values), 2), np.nan)
+    for row, row_values in enumerate(values):
+        resample_values = row_values[shot_indexes]
+        has_value = ~np.isnan(resample_values).all(axis=-1)
+        if has_value.any():
+            reference[row] = np.quantile(np.nanmean(resample_values[has_value], axis=-1),
+                                         [(1 - confidence_level) / 2, (1 + confidence_level) / 2])
+    assert np.isnan(values[1][shot_indexes]).all(axis=-1).any()  # Some resamples of row 1 drew only NaN shots
+    np.testing.assert_allclose(confidence_intervals["value lower CI"].values, reference[:, 0], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(confidence_intervals["value upper CI"].values, reference[:, 1], rtol=0, atol=1e-12)
+    assert confidence_intervals["value lower CI"].values[1] == 2.
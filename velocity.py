@@ -1,15 +1,48 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from statistics import NormalDist
+
 import numpy as np
 import xarray as xr
 import astropy.units as u
 
+from profiling import stage, profiled, array_details
+
+logger = logging.getLogger(__name__)
+
+mach_variable_order = ["Parallel Mach number", "Parallel velocity",
+                       "Perpendicular Mach number", "Perpendicular fore Mach number", "Perpendicular aft Mach number",
+                       "Perpendicular velocity"]
+
+"""CONSTANTS AND DESCRIPTIONS ARE TAKEN FROM MATLAB CODE WRITTEN BY CONOR PERKS"""
+# Mach probe calculation constants
+magnetization_factor = 0.5  # Mag. factor value from Hutchinson's derivation incorporating diamagnetic drift
+alpha_fore = np.pi / 4 * u.rad  # [rad] Angle the face in fore direction makes with B-field
+alpha_aft = np.pi / 4 * u.rad  # [rad] Angle the face in aft direction makes with B-field
 
-def get_velocity_profiles(mach_isat_da, electron_temperature_da):
+# Sound speeds interpolated from time-resolved electron temperatures onto Mach grids, by temperature and grid, most
+# recently used last; only the last few are kept, as a long-running follower adds a grid each time positions are added
+sound_speed_fields = OrderedDict()
+max_sound_speed_fields = 4
+
+
+@profiled("get_velocity_profiles")
+def get_velocity_profiles(mach_isat_da, electron_temperature_da=None, block_size=2 ** 16, confidence_level=None,
+                          resampling="bootstrap", num_resamples=1000, seed=0):
     r"""
 
     Parameters
     ----------
     :param mach_isat_da:
-    :param electron_temperature_da:
+    :param electron_temperature_da: electron temperature profile, or None to find Mach numbers only
+        (velocities can then be added with get_velocities)
+    :param block_size: approximate number of elements of one face processed at a time
+    :param confidence_level: confidence level of intervals of the mean over shots of each variable, such as 0.95,
+        or None to not find confidence intervals; see shot_confidence_intervals
+    :param resampling: "bootstrap" or "jackknife"
+    :param num_resamples: number of bootstrap resamples
+    :param seed: seed of random number generator for bootstrap resamples
     :return:
     """
 
@@ -38,12 +71,183 @@ def get_velocity_profiles(mach_isat_da, electron_temperature_da):
                                                                    ).assign_attrs({"units": keys_units[key]})
                                  for key in keys_units})"""
 
-    """CONSTANTS AND DESCRIPTIONS ARE TAKEN FROM MATLAB CODE WRITTEN BY CONOR PERKS"""
-    # Mach probe calculation constants
-    magnetization_factor = 0.5  # Mag. factor value from Hutchinson's derivation incorporating diamagnetic drift
-    alpha_fore = np.pi / 4 * u.rad  # [rad] Angle the face in fore direction makes with B-field
-    alpha_aft = np.pi / 4 * u.rad  # [rad] Angle the face in aft direction makes with B-field
+    logger.info("Calculating Mach numbers")
+    if not mach_isat_da.indexes['port'].is_monotonic_increasing:
+        mach_isat_da = mach_isat_da.sortby("port")
+    mach_isat_da = mach_isat_da.transpose('port', 'face', ...)
+    has_perpendicular_faces = np.isin(np.array([1, 3, 4, 6]), mach_isat_da.face).all()
+
+    """Parallel and perpendicular steady-state velocity profiles"""
+    mach_grid = mach_isat_da.isel(face=0, drop=True)
+    sound_speed = sound_speed_array = None
+    if electron_temperature_da is not None:
+        with stage("sound speed", **array_details(electron_temperature_da, "T_e ")):
+            sound_speed = get_sound_speed(electron_temperature_da, mach_isat_da.port)
+            if 'time' in sound_speed.dims:
+                # Time-resolved T_e gives each Mach number the sound speed at its own position and time
+                sound_speed_array = interpolated_sound_speed(sound_speed, mach_grid)
+            else:
+                sound_speed_array = broadcastable_sound_speed(sound_speed, mach_grid)
+
+    # Dask-backed isat (from get_mach_isat with chunk_positions) stays lazy; chunks are computed when needed
+    kernel = mach_velocity_kernel if mach_isat_da.chunks is None else lazy_mach_velocity_kernel
+    with stage("Mach kernel", lazy=mach_isat_da.chunks is not None, **array_details(mach_isat_da, "isat ")):
+        mach_arrays = kernel(mach_isat_da.data, mach_isat_da.face.values, sound_speed_array, magnetization_factor,
+                             np.cos(alpha_fore).value, np.cos(alpha_aft).value, has_perpendicular_faces, block_size)
+    mach_das = {key: xr.DataArray(mach_arrays[key], coords=mach_grid.coords, dims=mach_grid.dims)
+                for key in mach_arrays}
+    logger.info("Found " + ("parallel and perpendicular" if has_perpendicular_faces else "parallel") + " Mach numbers")
+
+    if sound_speed is not None:
+        logger.info("Generating velocity profiles")
+        for key in ("Parallel", "Perpendicular"):
+            if key + " Mach number" not in mach_das:
+                continue
+            if sound_speed_array is None:
+                # Mach and Langmuir grids differ; xarray aligns sound speed to the shared positions
+                mach_das[key + " velocity"] = mach_das[key + " Mach number"] * sound_speed
+            mach_das[key + " velocity"].attrs['units'] = str(u.cm / u.s)
+
+    mach_velocities = xr.Dataset({key: mach_das[key] for key in mach_variable_order if key in mach_das})
+    if confidence_level is not None:
+        confidence_intervals = shot_confidence_intervals(mach_velocities, confidence_level, resampling,
+                                                         num_resamples, seed)
+        # Each variable is followed by its confidence interval
+        mach_velocities = xr.merge([mach_velocities, confidence_intervals])[
+            [name for key in mach_velocities for name in (key, key + " lower CI", key + " upper CI")]]
+
+    return mach_velocities
+
+
+@profiled("get_velocities")
+def get_velocities(mach_numbers_ds, electron_temperature_da):
+    r"""
+    Find velocities from Mach numbers made by get_velocity_profiles without an electron temperature.
+
+    :param mach_numbers_ds: Dataset of Mach numbers
+    :param electron_temperature_da: electron temperature profile
+    :return: Dataset of parallel and (if available) perpendicular velocities
+    """
+
+    sound_speed = get_sound_speed(electron_temperature_da, mach_numbers_ds.port)
+    if 'time' in sound_speed.dims:
+        sound_speed_array = interpolated_sound_speed(sound_speed, mach_numbers_ds["Parallel Mach number"])
+    else:
+        sound_speed_array = broadcastable_sound_speed(sound_speed, mach_numbers_ds["Parallel Mach number"])
+    velocities = {}
+    for key in ("Parallel", "Perpendicular"):
+        if key + " Mach number" not in mach_numbers_ds:
+            continue
+        mach_number = mach_numbers_ds[key + " Mach number"]
+        if sound_speed_array is None:
+            velocities[key + " velocity"] = mach_number * sound_speed
+        else:
+            velocities[key + " velocity"] = mach_number.copy(data=mach_number.data * sound_speed_array)
+        velocities[key + " velocity"].attrs = {'units': str(u.cm / u.s)}
+    return xr.Dataset(velocities)
+
+
+@profiled("shot_confidence_intervals")
+def shot_confidence_intervals(mach_velocities, confidence_level=0.95, resampling="bootstrap", num_resamples=1000,
+                              seed=0, block_size=2 ** 22):
+    r"""
+    Confidence intervals of the mean over shots of each variable, by resampling shots at every port, position and
+    time at once. Resamples are rows of a weights matrix (how many times each shot is drawn), so the means of all
+    resamples are one matrix product per block; the same resamples are used for every variable. NaN shots are
+    left out of means, bootstrap percentiles are those of the resamples that drew a shot with a value, and jackknife
+    standard errors are those of the shots with values.
+
+    :param mach_velocities: Dataset of Mach numbers and velocities with a shot dimension, from get_velocity_profiles
+    :param confidence_level: confidence level of intervals, such as 0.95
+    :param resampling: "bootstrap" for percentile intervals of num_resamples resamples with replacement, or
+        "jackknife" for normal intervals with the standard error of leave-one-out resamples
+    :param num_resamples: number of bootstrap resamples
+    :param seed: seed of random number generator for bootstrap resamples
+    :param block_size: approximate number of resample means held in memory at a time
+    :return: Dataset of "VARIABLE lower CI" and "VARIABLE upper CI" variables without a shot dimension
+    """
+
+    num_shots = mach_velocities.sizes['shot']
+    if resampling == "bootstrap":
+        shot_indexes = np.random.default_rng(seed).integers(0, num_shots, size=(num_resamples, num_shots))
+        resample_offsets = num_shots * np.arange(num_resamples)[:, np.newaxis]
+        weights = np.bincount((shot_indexes + resample_offsets).ravel(), minlength=num_resamples * num_shots
+                              ).reshape(num_resamples, num_shots).astype(float)
+    elif resampling == "jackknife":
+        if num_shots < 2:
+            raise ValueError("Jackknife confidence intervals need at least two shots")
+        weights = 1. - np.eye(num_shots)
+    else:
+        raise ValueError("Unknown resampling method " + repr(resampling) + "; use 'bootstrap' or 'jackknife'")
+    logger.info("Finding %s confidence intervals", resampling)
+
+    def confidence_bounds(values):
+        # values has shots along its last axis; bounds are returned along a new last axis of size 2
+        bounds = np.empty(values.shape[:-1] + (2,))
+        for block in row_blocks(values.shape[:-1], max(block_size // len(weights), 1)):
+            block_values = values[block]
+            is_value = ~np.isnan(block_values)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                if is_value.all():
+                    resample_means = (block_values @ weights.T) / weights.sum(axis=1)
+                else:
+                    resample_means = (np.where(is_value, block_values, 0.) @ weights.T) / (is_value @ weights.T)
+            if resampling == "bootstrap":
+                # Percentiles interpolated as by np.quantile over the resample means that are not NaN (resamples
+                # that drew only NaN shots); a full sort of a few thousand means is faster than its partition, and
+                # sorts NaN last, so those means are the first num_means of each row
+                resample_means.sort(axis=-1)
+                num_means = np.count_nonzero(~np.isnan(resample_means), axis=-1)[..., np.newaxis]
+                last_mean = np.maximum(num_means - 1, 0)
+                for bound, quantile in enumerate(((1 - confidence_level) / 2, (1 + confidence_level) / 2)):
+                    position = last_mean * quantile
+                    below = np.floor(position).astype(int)
+                    above = np.minimum(below + 1, last_mean)
+                    below_means = np.take_along_axis(resample_means, below, axis=-1)
+                    with np.errstate(invalid="ignore"):
+                        percentile = below_means + (position - below) * (
+                            np.take_along_axis(resample_means, above, axis=-1) - below_means)
+                    bounds[block][..., bound] = np.where(num_means > 0, percentile, np.nan)[..., 0]
+            else:
+                # Only resamples leaving out a shot with a value are jackknife resamples of the n shots with values
+                num_values = is_value.sum(axis=-1)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    mean = np.where(is_value, block_values, 0.).sum(axis=-1) / num_values
+                    resample_mean = np.where(is_value, resample_means, 0.).sum(axis=-1) / num_values
+                    standard_error = np.sqrt((num_values - 1) / num_values * np.sum(np.where(
+                        is_value, resample_means - resample_mean[..., np.newaxis], 0.) ** 2, axis=-1))
+                half_width = NormalDist().inv_cdf((1 + confidence_level) / 2) * standard_error
+                bounds[block] = np.stack([mean - half_width, mean + half_width], axis=-1)
+        return bounds
+
+    confidence_intervals = {}
+    with stage("confidence intervals", resampling=resampling, resamples=len(weights),
+               **array_details(mach_velocities, "Mach ")):
+        for key in mach_velocities:
+            bounds = xr.apply_ufunc(confidence_bounds, mach_velocities[key], input_core_dims=[['shot']],
+                                    output_core_dims=[['bound']], dask="parallelized", output_dtypes=[float],
+                                    dask_gufunc_kwargs={"output_sizes": {"bound": 2}})
+            attrs = {**mach_velocities[key].attrs, "confidence level": confidence_level, "resampling": resampling}
+            confidence_intervals[key + " lower CI"] = bounds.isel(bound=0).assign_attrs(attrs)
+            confidence_intervals[key + " upper CI"] = bounds.isel(bound=1).assign_attrs(attrs)
+    return xr.Dataset(confidence_intervals)
+
+
+def row_blocks(shape, rows_per_block):
+    # Index tuples of blocks of an array of the given shape, each of about rows_per_block elements (at least one row
+    # of the last axis), splitting the outermost axes first so that blocks are views
+    for axis in range(len(shape)):
+        inner_rows = int(np.prod(shape[axis + 1:], dtype=int))
+        if inner_rows <= rows_per_block:
+            step = max(rows_per_block // inner_rows, 1)
+            for outer_index in np.ndindex(*shape[:axis]):
+                for start in range(0, shape[axis], step):
+                    yield outer_index + (slice(start, start + step),)
+            return
+    yield ()
+
 
+def get_sound_speed(electron_temperature_da, mach_ports):
     # Velocity calculation constants
     ion_mass = 6.6464764e-27 * u.kg  # Ion mass
     # ion_temperature = 1 * u.eV  # Approximate Ion temperature
@@ -55,40 +259,197 @@ def get_velocity_profiles(mach_isat_da, electron_temperature_da):
     mach_to_velocity_units = np.sqrt(1 * u.eV / u.kg).to(u.cm / u.s).value
     # MATLAB note: "Note that M=v/C_s where C_s = sqrt((T_e+T_i)/M_i), but we will assume that T_i~1ev"
 
-    print("Calculating Mach numbers...")
+    # Sound speed is converted to plain cm / s values once, so each velocity is one multiplication of a Mach number
+    langmuir_with_mach_ports = mach_to_velocity.assign_coords(port=mach_ports)
+    mach_to_velocity = mach_to_velocity.reindex_like(langmuir_with_mach_ports, method="nearest", tolerance=5)
+    return mach_to_velocity.copy(data=mach_to_velocity.values * mach_to_velocity_units)
 
-    """Parallel Mach number"""
-    parallel_mach = magnetization_factor * np.log(mach_isat_da.sel(face=5) / mach_isat_da.sel(face=2)).sortby("port")
-    print(" * Parallel Mach number found ")
 
-    """Parallel steady-state velocity profiles"""
-    print(" * Generating parallel velocity profiles...")
-    langmuir_with_mach_ports = mach_to_velocity.assign_coords(port=parallel_mach.port)
-    mach_to_velocity = mach_to_velocity.reindex_like(langmuir_with_mach_ports, method="nearest", tolerance=5)
-    parallel_velocity = parallel_mach * mach_to_velocity * mach_to_velocity_units
-    parallel_velocity.attrs['units'] = str(u.cm / u.s)
+def broadcastable_sound_speed(sound_speed, mach_grid):
+    # Return sound speed as a numpy array that broadcasts against the Mach grid, or None if grids are not identical
+    if not set(sound_speed.dims) <= set(mach_grid.dims):
+        return None
+    for dim in sound_speed.dims:
+        if not sound_speed.indexes[dim].equals(mach_grid.indexes[dim]):
+            return None
+    sound_speed = sound_speed.transpose(*[dim for dim in mach_grid.dims if dim in sound_speed.dims])
+    return sound_speed.values.reshape([mach_grid.sizes[dim] if dim in sound_speed.dims else 1
+                                       for dim in mach_grid.dims])
+
+
+def interpolated_sound_speed(sound_speed, mach_grid):
+    r"""
+    Sound speed from a time-resolved electron temperature, linearly interpolated in x, y and time onto the Mach grid,
+    found once per temperature and grid. Interpolation weights are found separately for each axis, so the sound
+    speed is interpolated one axis at a time and is never broadcast to the full Mach grid. Positions and times
+    outside those of the temperature are NaN.
+
+    :param sound_speed: sound speed in cm / s with port, x, y and time dimensions, from get_sound_speed
+    :param mach_grid: DataArray with port, x, y and time dimensions, such as a Mach number
+    :return: numpy array of sound speed broadcastable to mach_grid, with size 1 along its other dimensions
+    """
 
-    mach_velocities = xr.Dataset({"Parallel Mach number": parallel_mach,
-                                  "Parallel velocity": parallel_velocity})
+    other_dims = [dim for dim in sound_speed.dims if dim not in ('port', 'x', 'y', 'time')]
+    sound_speed = sound_speed.squeeze([dim for dim in other_dims if sound_speed.sizes[dim] == 1], drop=True)
+    if len(sound_speed.dims) != 4:
+        raise ValueError("Time-resolved electron temperature has dimensions " + str(sound_speed.dims)
+                         + "; only port, x, y and time can be interpolated onto the Mach grid")
 
-    """Perpendicular Mach number"""
-    if np.isin(np.array([1, 3, 4, 6]), mach_isat_da.face).all():
-        mach_correction_fore = magnetization_factor * np.log(mach_isat_da.sel(face=6) / mach_isat_da.sel(face=3))
-        mach_correction_aft = magnetization_factor * np.log(mach_isat_da.sel(face=4) / mach_isat_da.sel(face=1))
+    key = hashlib.sha256()
+    for array in ([sound_speed.values] + [sound_speed.coords[dim].values for dim in sound_speed.dims]
+                  + [mach_grid.coords[dim].values for dim in mach_grid.dims if dim in sound_speed.dims]):
+        key.update(np.ascontiguousarray(array).tobytes())
+    key = key.hexdigest()
+    if key not in sound_speed_fields:
+        sound_speed = sound_speed.sortby(['x', 'y', 'time']).transpose('port', 'x', 'y', 'time')
+        sound_speed_field = sound_speed.values
+        for axis, dim in enumerate(('x', 'y', 'time'), start=1):
+            source, target = sound_speed.coords[dim], mach_grid.coords[dim]
+            if 'units' in source.attrs and 'units' in target.attrs:
+                target_values = target.values * (1. * u.Unit(target.attrs['units'])).to(source.attrs['units']).value
+            else:
+                target_values = target.values
+            lower, upper, fraction = linear_interpolation_weights(source.values, target_values)
+            shape = [1] * sound_speed_field.ndim
+            shape[axis] = len(fraction)
+            fraction = fraction.reshape(shape)
+            sound_speed_field = (np.take(sound_speed_field, lower, axis=axis) * (1 - fraction)
+                                 + np.take(sound_speed_field, upper, axis=axis) * fraction)
+        sound_speed_fields[key] = sound_speed_field
+        while len(sound_speed_fields) > max_sound_speed_fields:
+            sound_speed_fields.popitem(last=False)
+    sound_speed_fields.move_to_end(key)
+    grid_dims = [dim for dim in mach_grid.dims if dim in ('port', 'x', 'y', 'time')]
+    sound_speed_field = np.transpose(sound_speed_fields[key], [('port', 'x', 'y', 'time').index(dim)
+                                                               for dim in grid_dims])
+    return np.expand_dims(sound_speed_field, [axis for axis, dim in enumerate(mach_grid.dims) if dim not in grid_dims])
 
-        perpendicular_mach_fore = (parallel_mach - mach_correction_fore) * np.cos(alpha_fore)
-        perpendicular_mach_aft = (parallel_mach - mach_correction_aft) * np.cos(alpha_aft)
-        perpendicular_mach = xr.concat([perpendicular_mach_fore, perpendicular_mach_aft], 'location').mean('location')
-        print(" * Perpendicular Mach number found ")
 
-        """Perpendicular steady-state velocity profiles"""
-        print(" * Generating perpendicular velocity profiles...")
-        perpendicular_velocity = perpendicular_mach * mach_to_velocity * mach_to_velocity_units
-        perpendicular_velocity.attrs['units'] = str(u.cm / u.s)
+def linear_interpolation_weights(source, target):
+    # Lower and upper source indexes and fraction of the way from lower to upper of each target value; fraction is
+    # NaN outside the source values. A single source value is used for every target value.
+    if len(source) == 1:
+        return np.zeros(len(target), dtype=int), np.zeros(len(target), dtype=int), np.zeros(len(target))
+    upper = np.clip(np.searchsorted(source, target, side='right'), 1, len(source) - 1)
+    lower = upper - 1
+    fraction = (target - source[lower]) / (source[upper] - source[lower])
+    tolerance = 1e-9
+    fraction[(fraction < -tolerance) | (fraction > 1 + tolerance)] = np.nan
+    return lower, upper, np.clip(fraction, 0, 1)
 
-        mach_velocities = mach_velocities.assign({"Perpendicular Mach number": perpendicular_mach,
-                                                  "Perpendicular fore Mach number": perpendicular_mach_fore,
-                                                  "Perpendicular aft Mach number": perpendicular_mach_aft,
-                                                  "Perpendicular velocity": perpendicular_velocity})
 
-    return mach_velocities
+def mach_velocity_kernel(isat, faces, sound_speed_array, magnetization_factor, cos_alpha_fore, cos_alpha_aft,
+                         perpendicular=True, block_size=2 ** 16):
+    r"""
+    Compute all Mach numbers, and velocities if sound speed is given, in one blocked pass over the isat array.
+
+    :param isat: numpy array of isat with dimensions (port, face, x, y, shot, time)
+    :param faces: face number of each index along the face dimension
+    :param sound_speed_array: sound speed in cm / s broadcastable to (port, x, y, shot, time), or None
+    :param magnetization_factor: factor multiplying the log of face isat ratios
+    :param cos_alpha_fore: cosine of angle fore faces make with B-field
+    :param cos_alpha_aft: cosine of angle aft faces make with B-field
+    :param perpendicular: True to also compute perpendicular Mach numbers from faces 1, 3, 4 and 6
+    :param block_size: approximate number of elements of one face processed per block
+    :return: dictionary of numpy arrays keyed by variable name
+    """
+
+    faces = list(faces)
+    output_shape = isat.shape[:1] + isat.shape[2:]
+    dtype = isat.dtype if np.issubdtype(isat.dtype, np.floating) else np.float64
+    keys = mach_kernel_keys(sound_speed_array is not None, perpendicular)
+    mach_arrays = {key: np.empty(output_shape, dtype=dtype) for key in keys}
+
+    # Blocks are slabs of x positions for one port; each face is read once per block
+    x_per_block = max(int(block_size // np.prod(output_shape[2:], dtype=int)), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for port in range(output_shape[0]):
+            for x_start in range(0, output_shape[1], x_per_block):
+                block = (port, slice(x_start, x_start + x_per_block))
+                face_isat = {face: isat[block[0], faces.index(face), block[1]] for face in faces}
+                if sound_speed_array is not None:
+                    sound_speed_block = sound_speed_array[port if sound_speed_array.shape[0] > 1 else 0,
+                                                          block[1] if sound_speed_array.shape[1] > 1 else slice(None)]
+
+                parallel_mach = mach_arrays["Parallel Mach number"][block]
+                face_log_ratio(face_isat[5], face_isat[2], magnetization_factor, out=parallel_mach)
+                if sound_speed_array is not None:
+                    np.multiply(parallel_mach, sound_speed_block, out=mach_arrays["Parallel velocity"][block])
+
+                if perpendicular:
+                    fore_mach = mach_arrays["Perpendicular fore Mach number"][block]
+                    aft_mach = mach_arrays["Perpendicular aft Mach number"][block]
+                    for location_mach, face_pair, cos_alpha in ((fore_mach, (6, 3), cos_alpha_fore),
+                                                                (aft_mach, (4, 1), cos_alpha_aft)):
+                        # (parallel Mach - Mach correction) * cos(alpha)
+                        face_log_ratio(face_isat[face_pair[0]], face_isat[face_pair[1]], -magnetization_factor,
+                                       out=location_mach)
+                        location_mach += parallel_mach
+                        location_mach *= cos_alpha
+
+                    # Mean of fore and aft, skipping NaN values as xarray does: where exactly one is NaN, use the other
+                    perpendicular_mach = mach_arrays["Perpendicular Mach number"][block]
+                    np.add(fore_mach, aft_mach, out=perpendicular_mach)
+                    perpendicular_mach /= 2
+                    nan_index = np.nonzero(np.isnan(perpendicular_mach))
+                    if len(nan_index[0]) > 0:
+                        fore_nan_values = fore_mach[nan_index]
+                        aft_nan_values = aft_mach[nan_index]
+                        perpendicular_mach[nan_index] = np.where(np.isnan(fore_nan_values), aft_nan_values,
+                                                                 np.where(np.isnan(aft_nan_values), fore_nan_values,
+                                                                          perpendicular_mach[nan_index]))
+                    if sound_speed_array is not None:
+                        np.multiply(perpendicular_mach, sound_speed_block,
+                                    out=mach_arrays["Perpendicular velocity"][block])
+
+    return mach_arrays
+
+
+def lazy_mach_velocity_kernel(isat, faces, sound_speed_array, magnetization_factor, cos_alpha_fore, cos_alpha_aft,
+                              perpendicular=True, block_size=2 ** 16):
+    r"""
+    Apply mach_velocity_kernel to each chunk of a dask-backed isat array, without computing anything.
+
+    :param isat: dask array of isat with dimensions (port, face, x, y, shot, time)
+    :return: dictionary of dask arrays keyed by variable name
+    """
+    import dask.array as da
+
+    keys = mach_kernel_keys(sound_speed_array is not None, perpendicular)
+    dtype = isat.dtype if np.issubdtype(isat.dtype, np.floating) else np.float64
+    # All ports and faces are needed in every chunk; the variable axis of the output replaces the face axis
+    isat = isat.rechunk({0: -1, 1: -1})
+
+    def kernel_chunk(isat_chunk, block_info=None):
+        sound_speed_chunk = None
+        if sound_speed_array is not None:
+            chunk_location = [location for axis, location in enumerate(block_info[0]['array-location']) if axis != 1]
+            sound_speed_chunk = sound_speed_array[tuple(slice(*location) if size > 1 else slice(None)
+                                                        for location, size in zip(chunk_location,
+                                                                                  sound_speed_array.shape))]
+        chunk_arrays = mach_velocity_kernel(isat_chunk, faces, sound_speed_chunk, magnetization_factor,
+                                            cos_alpha_fore, cos_alpha_aft, perpendicular, block_size)
+        return np.stack([chunk_arrays[key] for key in keys])
+
+    stacked_arrays = da.map_blocks(kernel_chunk, isat, dtype=dtype,
+                                   chunks=((len(keys),), isat.chunks[0]) + isat.chunks[2:])
+    return {key: stacked_arrays[keys.index(key)] for key in keys}
+
+
+def mach_kernel_keys(has_sound_speed, perpendicular):
+    keys = ["Parallel Mach number"]
+    if has_sound_speed:
+        keys += ["Parallel velocity"]
+    if perpendicular:
+        keys += ["Perpendicular fore Mach number", "Perpendicular aft Mach number", "Perpendicular Mach number"]
+        if has_sound_speed:
+            keys += ["Perpendicular velocity"]
+    return keys
+
+
+def face_log_ratio(numerator_isat, denominator_isat, factor, out):
+    # factor * ln(numerator / denominator), written into out
+    np.divide(numerator_isat, denominator_isat, out=out)
+    np.log(out, out=out)
+    out *= factor
+    return out